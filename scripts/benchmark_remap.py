@@ -0,0 +1,298 @@
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+import duckdb
+import numpy as np
+import polars
+import typer
+
+from divref_index import (
+    with_typed_frequencies,
+    with_variant_intervals,
+    write_remap_sidecar,
+)
+
+app = typer.Typer()
+
+POPS = ["afr", "amr", "eas", "nfe", "sas"]
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+VERSION = "1.1"
+SEQUENCE_ID_PREFIX = f"DR-{VERSION}-"
+
+
+def random_bases(rng: np.random.Generator, n: int) -> str:
+    return BASES[rng.integers(0, 4, n)].tobytes().decode()
+
+
+def synthetic_sequences(
+    n_sequences: int,
+    window_size: int,
+    indel_fraction: float,
+    rng: np.random.Generator,
+) -> polars.DataFrame:
+    """
+    Random DivRef sequences with the `sequences` table schema. A fraction `indel_fraction` of
+    variants are insertions or deletions of 1-12 bases, the rest SNVs; about 60% of sequences
+    are single variants, the rest haplotypes of 2-6 variants.
+    """
+    rows = []
+    for i in range(n_sequences):
+        contig = f"chr{rng.integers(1, 23)}"
+        n_variants = 1 if rng.random() < 0.6 else int(rng.integers(2, 7))
+        position = int(rng.integers(1000, 10_000_000))
+        variants = []
+        for _ in range(n_variants):
+            ref = random_bases(rng, 1)
+            alt = random_bases(rng, 1)
+            if rng.random() < indel_fraction:
+                indel = random_bases(rng, int(rng.integers(1, 13)))
+                if rng.random() < 0.5:
+                    alt = ref + indel
+                else:
+                    ref = ref + indel
+            variants.append((position, ref, alt))
+            position += len(ref) + int(rng.integers(0, window_size))
+        gaps = sum(
+            variants[j + 1][0] - variants[j][0] - len(variants[j][1])
+            for j in range(n_variants - 1)
+        )
+        sequence_length = 2 * window_size + sum(len(v[2]) for v in variants) + gaps
+        rows.append(
+            {
+                "sequence": random_bases(rng, sequence_length),
+                "sequence_length": sequence_length,
+                "sequence_id": f"{SEQUENCE_ID_PREFIX}{i}",
+                "n_variants": n_variants,
+                "popmax_empirical_AF": round(float(rng.random()), 6),
+                "popmax_empirical_AC": int(rng.integers(1, 5000)),
+                "estimated_gnomad_AF": float(rng.random()),
+                "fraction_phased": float(rng.random()),
+                "source": "gnomAD_variant" if n_variants == 1 else "HGDP_haplotype",
+                "max_pop": POPS[rng.integers(0, len(POPS))],
+                "variants": ",".join(f"{contig}:{p}:{r}:{a}" for p, r, a in variants),
+                **{
+                    f"gnomAD_AF_{pop}": ",".join(
+                        f"{rng.random():.5f}" for _ in range(n_variants)
+                    )
+                    for pop in POPS
+                },
+            }
+        )
+    return polars.DataFrame(rows)
+
+
+def write_index(df: polars.DataFrame, path: Path, window_size: int):
+    # same layout as `create_fasta_and_index.py` writes
+    df = with_typed_frequencies(with_variant_intervals(df, window_size)).with_columns(
+        sequence_idx=polars.int_range(polars.len(), dtype=polars.Int64)
+    )
+    con = duckdb.connect(str(path))
+    con.execute("CREATE TABLE sequences AS SELECT * FROM df ORDER BY sequence_idx")
+    con.execute("CREATE INDEX idx_sequence_id ON sequences(sequence_id)")
+    con.execute("CREATE INDEX idx_sequence_idx ON sequences(sequence_idx)")
+    con.execute(
+        f"CREATE TABLE sequence_id_prefix AS SELECT '{SEQUENCE_ID_PREFIX}' AS sequence_id_prefix"
+    )
+    con.execute(f"CREATE TABLE window_size AS SELECT {window_size} AS window_size")
+    con.execute(f"CREATE TABLE pops_legend AS SELECT {POPS} AS pops_legend")
+    con.execute(f"CREATE TABLE VERSION AS SELECT {VERSION} AS version")
+    con.close()
+    write_remap_sidecar(
+        df,
+        str(path.with_suffix(".remap.bin")),
+        VERSION,
+        window_size,
+        SEQUENCE_ID_PREFIX,
+    )
+
+
+def write_calitas(
+    sequence_lengths: np.ndarray,
+    path: Path,
+    n_hits: int,
+    skew: float,
+    rng: np.random.Generator,
+):
+    """
+    Random CALITAS hits. Sequence `k` (in a random order) is hit with weight 1 / (k + 1) ** skew,
+    so 0 is uniform and larger values concentrate hits on fewer sequences.
+    """
+    weights = 1.0 / np.arange(1, len(sequence_lengths) + 1) ** skew
+    ranked = rng.permutation(len(sequence_lengths))
+    hit_sequences = ranked[
+        rng.choice(len(sequence_lengths), n_hits, p=weights / weights.sum())
+    ]
+    lengths = sequence_lengths[hit_sequences]
+    starts = (rng.random(n_hits) * (lengths + 4)).astype(np.int64) - 3
+    ends = starts + rng.integers(0, 24, n_hits)
+    targets = [random_bases(rng, 20) for _ in range(n_hits)]
+    polars.DataFrame(
+        {
+            "guide_id": [f"g{i % 7}" for i in range(n_hits)],
+            "chromosome": [f"{SEQUENCE_ID_PREFIX}{k}" for k in hit_sequences],
+            "coordinate_start": starts,
+            "coordinate_end": ends,
+            "strand": np.where(rng.random(n_hits) < 0.5, "+", "-"),
+            "padded_target": [t + random_bases(rng, 3) for t in targets],
+            "unpadded_target_sequence": targets,
+            "score": np.round(rng.random(n_hits) * 10, 3),
+        }
+    ).write_csv(path, separator="\t")
+
+
+@app.command(
+    help="Remap a synthetic CALITAS workload with remap_divref.py and record its performance"
+)
+def run(
+    output_json: Path = typer.Argument(..., help="Path to write the results to"),
+    work_dir: Path = typer.Option(
+        Path("/tmp/divref-benchmark"), help="Directory for the synthetic inputs"
+    ),
+    sequences: int = typer.Option(100_000, help="Number of sequences in the index"),
+    hits: int = typer.Option(500_000, help="Number of CALITAS hits"),
+    skew: float = typer.Option(
+        1.0, help="Zipf exponent of hits per sequence (0 for uniform)"
+    ),
+    indel_fraction: float = typer.Option(
+        0.3, help="Fraction of variants that are indels"
+    ),
+    window_size: int = typer.Option(25, help="Base window size"),
+    seed: int = typer.Option(0, help="Random seed"),
+    sidecar: bool = typer.Option(
+        False, help="Remap against the binary remap sidecar instead of DuckDB"
+    ),
+    batch_size: int = typer.Option(25000, help="remap_divref.py -b"),
+    workers: int = typer.Option(1, help="remap_divref.py --workers"),
+    cache_size: int = typer.Option(0, help="remap_divref.py --cache-size"),
+    output_format: str = typer.Option("tsv", help="remap_divref.py --output-format"),
+    label: Optional[str] = typer.Option(None, help="Label stored with the results"),
+):
+    # inputs are reused across runs with the same parameters
+    work_dir.mkdir(parents=True, exist_ok=True)
+    name = f"s{sequences}-w{window_size}-i{indel_fraction}-seed{seed}"
+    index_path = work_dir / f"{name}.index.duckdb"
+    calitas_path = work_dir / f"{name}-h{hits}-skew{skew}.calitas.tsv"
+    if not index_path.exists():
+        typer.echo(f"creating synthetic index {index_path}")
+        df = synthetic_sequences(
+            sequences, window_size, indel_fraction, np.random.default_rng(seed)
+        )
+        write_index(df, index_path, window_size)
+    if not calitas_path.exists():
+        typer.echo(f"creating synthetic CALITAS hits {calitas_path}")
+        sequence_lengths = (
+            duckdb.connect(str(index_path), read_only=True)
+            .execute("SELECT sequence_length FROM sequences ORDER BY sequence_idx")
+            .fetchnumpy()["sequence_length"]
+        )
+        write_calitas(
+            sequence_lengths,
+            calitas_path,
+            hits,
+            skew,
+            np.random.default_rng(seed + 1),
+        )
+
+    stats_path = work_dir / "stats.json"
+    command = [
+        sys.executable,
+        str(Path(__file__).parent / "remap_divref.py"),
+        "calitas",
+        str(calitas_path),
+        str(work_dir / f"remapped.{output_format}"),
+        "-i",
+        str(index_path.with_suffix(".remap.bin") if sidecar else index_path),
+        "-b",
+        str(batch_size),
+        "--workers",
+        str(workers),
+        "--cache-size",
+        str(cache_size),
+        "--stats-json",
+        str(stats_path),
+        "--output-format",
+        output_format,
+    ]
+    typer.echo(" ".join(command))
+    started = time.perf_counter()
+    # output is captured rather than shown, as stderr carries remap_divref.py's progress bar;
+    # its unexpected-error report goes to stdout
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        typer.secho(
+            f"ERROR: remap_divref.py exited with status {result.returncode}:\n"
+            f"{result.stdout}{result.stderr}",
+            fg=typer.colors.BRIGHT_RED,
+            err=True,
+        )
+        raise typer.Exit(result.returncode)
+    wall_seconds = time.perf_counter() - started
+    with open(stats_path) as f:
+        stats = json.load(f)
+
+    # ru_maxrss of waited-for children is the largest of them, in KiB on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    batch_ms = np.array(stats["batch_seconds"]) * 1000
+    results = {
+        "label": label,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "parameters": {
+            "sequences": sequences,
+            "hits": hits,
+            "skew": skew,
+            "indel_fraction": indel_fraction,
+            "window_size": window_size,
+            "seed": seed,
+            "sidecar": sidecar,
+            "batch_size": batch_size,
+            "workers": workers,
+            "cache_size": cache_size,
+            "output_format": output_format,
+        },
+        "metrics": {
+            "rows": stats["rows"],
+            "wall_seconds": wall_seconds,
+            "remap_seconds": stats["seconds"],
+            "rows_per_second": stats["rows"] / stats["seconds"],
+            "batch_ms_p50": float(np.percentile(batch_ms, 50)),
+            "batch_ms_p99": float(np.percentile(batch_ms, 99)),
+            "peak_rss_mb": peak_rss_mb,
+            "cache_hits": stats["cache_hits"],
+            "cache_misses": stats["cache_misses"],
+        },
+    }
+    with open(output_json, "w") as f:
+        json.dump(results, f, indent=2)
+    for metric, value in results["metrics"].items():
+        typer.echo(f"{metric}: {value:.6g}")
+
+
+@app.command(help="Compare the metrics of two benchmark results")
+def compare(
+    baseline_json: Path = typer.Argument(..., help="Baseline results"),
+    candidate_json: Path = typer.Argument(..., help="Candidate results"),
+):
+    with open(baseline_json) as f:
+        baseline = json.load(f)
+    with open(candidate_json) as f:
+        candidate = json.load(f)
+    if baseline["parameters"] != candidate["parameters"]:
+        typer.secho(
+            "WARNING: benchmarks were run with different parameters",
+            fg=typer.colors.YELLOW,
+        )
+    for metric, before in baseline["metrics"].items():
+        after = candidate["metrics"][metric]
+        change = f"{after / before:.2f}x" if before else "-"
+        typer.echo(f"{metric:>16}: {before:>12.6g} -> {after:>12.6g} ({change})")
+
+
+if __name__ == "__main__":
+    app()
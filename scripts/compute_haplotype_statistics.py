@@ -1,7 +1,12 @@
+import os
+
 import hail as hl
+import polars
 import typer
 from pydantic import BaseModel
 
+from divref_haplotypes import haplotype_window_counts
+
 app = typer.Typer()
 
 
@@ -37,35 +42,6 @@ def get_haplo_sequence(context_size, variants):
             hl.delimit(hl.range(hl.len(sorted_variants)).map(lambda i: get_chunk_until_next_variant(i)), ''))
 
 
-def variant_distance(v1, v2):
-    # 1:1:A:T and 1:3:A:T have distance 1 (1 base in between)
-    # 1:1:AA:T and 1:3:A:T have distance 0
-
-    return v2.locus.position - v1.locus.position - hl.len(v1.alleles[0])
-
-
-def split_haplotypes(ht, window_size):
-    # generate indices where the distance between variants is greater than the window size
-
-    breakpoints = hl.range(1, hl.len(ht.variants)).filter(
-        lambda i: (i == 0) | (variant_distance(ht.variants[i - 1], ht.variants[i]) >= window_size))
-
-    def get_range(i):
-        start_index = hl.if_else(i == 0, 0, breakpoints[i - 1])
-        end_index = hl.if_else(i == hl.len(breakpoints), hl.len(ht.variants), breakpoints[i])
-        return hl.range(start_index, end_index)
-
-    split_hap_indices = hl.range(0, hl.len(breakpoints) + 1).map(get_range).filter(lambda r: hl.len(r) > 1)
-    ht = ht.annotate(haplotype_indices=split_hap_indices)
-    ht = ht.explode('haplotype_indices')
-    ht = ht.annotate(
-        haplotype=ht.haplotype_indices.map(lambda i: ht.haplotype[i]),
-        variants=ht.haplotype_indices.map(lambda i: ht.variants[i]),
-        gnomad_freqs=ht.haplotype_indices.map(lambda i: ht.gnomad_freqs[i]),
-    )
-    return ht.drop('haplotype_indices')
-
-
 @app.command()
 def main(
         haplotypes_table_path: str = typer.Option(default=..., help="haplotypes table path"),
@@ -73,6 +49,7 @@ def main(
         window_sizes: str = typer.Option(default=..., help="Base window sizes, delimited by comma"),
         frequency_cutoffs: str = typer.Option(default=..., help="Frequency thresholds, delimited by comma"),
         output_base: str = typer.Option(default=..., help="Output file path"),
+        tmp_dir: str = typer.Option(default="/tmp", help="Temporary directory"),
 ):
     """
     Process VCF files with gnomAD annotations and output filtered results.
@@ -96,20 +73,26 @@ def main(
     hgdp_results = []
     gnomad_results = []
 
-    for frequency_str in frequency_cutoffs.split(','):
-        frequency = float(frequency_str)
-        for window_size_str in window_sizes.split(','):
-            window_size = int(window_size_str)
-            ht2 = ht.filter(ht.max_pop_freq >= frequency)
-            ht2 = split_haplotypes(ht2, window_size)
-            n_unique_haplotypes = ht2.key_by('haplotype').distinct().key_by().count()
-            print(f'for frequency {frequency} and window size {window_size}, found {n_unique_haplotypes} haplotypes')
-            hgdp_results.append(HGDPResult(
-                frequency_cutoff=frequency,
-                window_size=window_size,
-                hgdp_haplotype_count=n_unique_haplotypes))
-
-        gnomad_count = va.filter(hl.max(va.pop_freqs.map(lambda x: hl.max(x.AF))) >= frequency).count()
+    frequencies = [float(x) for x in frequency_cutoffs.split(',')]
+    windows = [int(x) for x in window_sizes.split(',')]
+
+    # the whole sweep is counted from one scan of the haplotype table, handed to polars as
+    # Parquet, rather than filtering, splitting and counting it once per combination
+    parquet_path = os.path.join(tmp_dir, 'haplotype_statistics.parquet')
+    ht.select('haplotype', 'variants', 'max_pop_freq').to_spark().write.mode('overwrite').parquet(parquet_path)
+    counts = haplotype_window_counts(
+        polars.read_parquet(os.path.join(parquet_path, '*.parquet')), 'max_pop_freq', frequencies, windows)
+    for frequency, window_size, n_unique_haplotypes in counts.iter_rows():
+        print(f'for frequency {frequency} and window size {window_size}, found {n_unique_haplotypes} haplotypes')
+        hgdp_results.append(HGDPResult(
+            frequency_cutoff=frequency,
+            window_size=window_size,
+            hgdp_haplotype_count=n_unique_haplotypes))
+
+    # and the gnomAD counts for every cutoff from one aggregation
+    max_AF = hl.max(va.pop_freqs.map(lambda x: hl.max(x.AF)))
+    gnomad_counts = va.aggregate(hl.agg.array_sum([hl.int64(max_AF >= frequency) for frequency in frequencies]))
+    for frequency, gnomad_count in zip(frequencies, gnomad_counts):
         print(f'for frequency {frequency}, found {gnomad_count} gnomAD variants')
         gnomad_results.append(GnomADResult(
             frequency_cutoff=frequency,
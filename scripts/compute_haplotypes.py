@@ -22,6 +22,10 @@ def main(
         default=..., help="Frequency threshold for keeping haplotypes"
     ),
     output_base: str = typer.Option(default=..., help="Output base path"),
+    window_offsets: int = typer.Option(
+        default=2,
+        help="Number of staggered window offsets, evenly spaced across the window",
+    ),
     temp_dir: str = typer.Option(default="/tmp", help="Temporary directory"),
 ):
     """
@@ -52,66 +56,87 @@ def main(
     # don't consider sites where the variant is not above a frequency threshold in gnomAD
     mt = mt.filter_entries(mt.freq[mt.pop_int].AF >= freq_threshold)
 
+    def carriers(allele):
+        # samples carrying the alternate allele on one haplotype, as a sorted array of int32
+        # sample indices per population (indexed by pop_int), rather than a struct per carrier
+        by_pop = hl.agg.filter(
+            allele != 0,
+            hl.agg.group_by(mt.pop_int, hl.agg.collect(hl.int32(mt.col_idx))),
+        )
+        return hl.range(len(pop_legend)).map(
+            lambda pop: hl.sorted(by_pop.get(pop, hl.empty_array(hl.tint32)))
+        )
+
     mt = mt.annotate_rows(
-        pops_and_ids_left=hl.agg.filter(
-            mt.GT[0] != 0, hl.agg.collect(hl.struct(pop=mt.pop_int, sample=mt.col_idx))
-        ),
-        pops_and_ids_right=hl.agg.filter(
-            mt.GT[1] != 0, hl.agg.collect(hl.struct(pop=mt.pop_int, sample=mt.col_idx))
-        ),
+        carriers_left=carriers(mt.GT[0]),
+        carriers_right=carriers(mt.GT[1]),
         frequencies_by_pop=hl.agg.group_by(mt.pop_int, hl.agg.call_stats(mt.GT, 2)),
     )
     ht = mt.rows().select(
         "freq",
-        "pops_and_ids_left",
-        "pops_and_ids_right",
+        "carriers_left",
+        "carriers_right",
         "row_idx",
         "frequencies_by_pop",
     )
 
     # ht = ht.checkpoint(f"{temp_dir}/xht.ht", overwrite=True)
 
-    def get_haplotypes(ht, windower_f, idx):
-        new_locus = windower_f(ht.locus)
-        ht = ht.annotate(new_locus=new_locus)
-
-        def agg_haplos(arr):
-            flat = hl.agg.explode(
-                lambda elt: hl.agg.collect(elt.annotate(row_idx=ht.row_idx)), arr
+    def get_haplotypes(ht, offsets):
+        # each site is in one window per offset; all windows are grouped in a single shuffle
+        ht = ht.annotate(
+            new_locus=hl.set(
+                hl.literal(offsets).map(
+                    lambda offset: ht.locus - ((ht.locus.position + offset) % window_size)
+                )
             )
-            pop_grouped = hl.group_by(lambda x: x.pop, flat)
-            pop_to_haps_array = pop_grouped.map_values(
-                lambda arr_per_pop: hl.array(
-                    hl.array(
-                        hl.group_by(lambda inner_elt: inner_elt.sample, arr_per_pop)
-                    )
+        )
+        ht = ht.explode("new_locus")
+
+        def haplos(sites, side):
+            # within a population, a sample's haplotype is the set of sites whose carrier
+            # arrays contain it; sites is array<struct(row_idx, carriers_left, carriers_right)>
+            def pop_haplos(pop):
+                by_sample = hl.group_by(
+                    lambda x: x[0],
+                    sites.flatmap(
+                        lambda site: site[side][pop].map(
+                            lambda sample: (sample, site.row_idx)
+                        )
+                    ),
+                )
+                return hl.array(
+                    hl.array(by_sample)
                     # remove single variants
-                    .filter(
-                        lambda sample_and_records: hl.len(sample_and_records[1]) > 1
-                    )
+                    .filter(lambda sample_and_sites: hl.len(sample_and_sites[1]) > 1)
                     # after this map, the inner array per pop is a list of observed haplotypes: array<array<int64>>
                     .map(
-                        lambda sample_and_records: hl.sorted(
-                            sample_and_records[1].map(lambda e: e.row_idx)
+                        lambda sample_and_sites: hl.sorted(
+                            sample_and_sites[1].map(lambda x: x[1])
                         )
                     )
                     # group by the identity now
                     .group_by(lambda x: x)
                     .map_values(lambda arr: hl.len(arr))
                 )
-            )
-
-            return pop_to_haps_array
 
+            return hl.dict(
+                hl.range(len(pop_legend)).map(lambda pop: (pop, pop_haplos(pop)))
+            )
 
         ht_grouped = ht.group_by("new_locus").aggregate(
             row_map=hl.dict(
                 hl.agg.collect((ht.row_idx, ht.row.select("locus", "alleles", "freq", "frequencies_by_pop")))
             ),
-            left_haplos=agg_haplos(ht.pops_and_ids_left),
-            right_haplos=agg_haplos(ht.pops_and_ids_right),
+            sites=hl.agg.collect(
+                ht.row.select("row_idx", "carriers_left", "carriers_right")
+            ),
+        )
+        ht_grouped = ht_grouped.annotate(
+            left_haplos=haplos(ht_grouped.sites, "carriers_left"),
+            right_haplos=haplos(ht_grouped.sites, "carriers_right"),
         )
-        # left_haplos and right_haplos are array<(pop_id, array<(sample_id, array<row_idx>)>)>
+        # left_haplos and right_haplos are dict<pop_id, array<(array<row_idx>, n_samples)>>
 
         # operates on inner array
         def collapse_haplos_across_samples(pop, arr1, arr2):
@@ -180,27 +205,18 @@ def main(
             ),
         )
 
-        # Select the haplotype with the highest empirical_AF across all populations
+        # a haplotype can be found in a window of each offset; keep the one with the highest
+        # empirical_AF across all populations
         hte = hte.group_by("haplotype").aggregate(**hl.sorted(hl.agg.collect(hte.row.drop('haplotype')), key=lambda row: -row.max_empirical_AF)[0])
+        return hte
 
-        typer.echo(f"Writing {output_base}.{idx}.ht...")
-        return hte.checkpoint(f"{output_base}.{idx}.ht", overwrite=True)
-
-    # compute staggered windows
-    window1 = get_haplotypes(
-        ht, lambda locus: locus - (locus.position % window_size), 1
-    )
-    window2 = get_haplotypes(
-        ht, lambda locus: locus - ((locus.position + window_size // 2) % window_size), 2
-    )
-
-    htu = window1.union(window2)
+    # compute staggered windows: offset 0 and window_size // 2 by default
+    offsets = [i * window_size // window_offsets for i in range(window_offsets)]
+    htu = get_haplotypes(ht, offsets)
     htu.describe()
     typer.echo(f"Writing final {output_base}.ht...")
 
-    htu.key_by("haplotype").naive_coalesce(64).write(
-        f"{output_base}.ht", overwrite=True
-    )
+    htu.naive_coalesce(64).write(f"{output_base}.ht", overwrite=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import glob
+
+import typer
+
+from divref_haplotypes import discover_haplotypes, gnomad_pops
+
+app = typer.Typer(pretty_exceptions_enable=False)
+
+
+@app.command()
+def main(
+    vcfs_path: str = typer.Option(
+        default=..., help="phased VCF (or BCF, read with bcftools) path or glob"
+    ),
+    gnomad_va_file: str = typer.Option(
+        default=...,
+        help="gnomAD computed variant frequencies, as Parquet (extract_gnomad_afs.py --parquet)",
+    ),
+    gnomad_sa_file: str = typer.Option(
+        default=...,
+        help="gnomAD HGDP sample metadata, as Parquet (extract_gnomad_afs.py --parquet)",
+    ),
+    window_size: int = typer.Option(default=..., help="Base window size"),
+    freq_threshold: float = typer.Option(
+        default=..., help="Frequency threshold for keeping haplotypes"
+    ),
+    output_base: str = typer.Option(default=..., help="Output base path"),
+    window_offsets: int = typer.Option(
+        default=2,
+        help="Number of staggered window offsets, evenly spaced across the window",
+    ),
+    workers: int = typer.Option(
+        default=1, help="Number of VCF files processed in parallel"
+    ),
+    bcftools: str = typer.Option(default="bcftools", help="bcftools executable"),
+):
+    """
+    Compute the haplotype table of `compute_haplotypes.py` locally, without Hail, and write it
+    to {output_base}.parquet, which `create_fasta_and_index.py` reads in place of the Hail
+    table.
+    """
+    vcf_paths = sorted(glob.glob(vcfs_path))
+    if not vcf_paths:
+        raise typer.BadParameter(f"no files match {vcfs_path}")
+    typer.echo(f"computing haplotypes from {len(vcf_paths)} files")
+    ht = discover_haplotypes(
+        vcf_paths,
+        gnomad_va_file,
+        gnomad_sa_file,
+        gnomad_pops(gnomad_va_file),
+        window_size,
+        freq_threshold,
+        offsets=[i * window_size // window_offsets for i in range(window_offsets)],
+        workers=workers,
+        bcftools=bcftools,
+    )
+    typer.echo(f"Writing {output_base}.parquet with {len(ht)} haplotypes...")
+    ht.write_parquet(f"{output_base}.parquet")
+
+
+if __name__ == "__main__":
+    app()
@@ -1,9 +1,31 @@
 import os
+from typing import Optional
 
 import duckdb
 import hail as hl
 import polars
 import typer
+from pyspark.sql import SparkSession
+
+from divref_haplotypes import split_haplotypes as split_haplotypes_local
+from divref_index import (
+    ReferenceFasta,
+    assign_sequence_ids,
+    build_contig_partitions,
+    fasta_rows,
+    haplotype_sequences,
+    read_previous_sequences,
+    sequence_spans,
+    sequence_id_mapping,
+    with_fasta_records,
+    with_typed_frequencies,
+    with_variant_intervals,
+    write_contig_fastas,
+    write_fasta,
+    write_remap_sidecar,
+    write_sequence_store,
+    write_tsv,
+)
 
 app = typer.Typer()
 
@@ -87,15 +109,95 @@ def split_haplotypes(ht, window_size):
     return ht.drop("haplotype_indices")
 
 
+def read_haplotypes_table(path: str) -> hl.Table:
+    """
+    Reads the haplotype table of `compute_haplotypes.py`, or the Parquet equivalent written by
+    `compute_haplotypes_local.py` (a path ending in `.parquet`), whose loci are plain
+    (contig, position) structs.
+    """
+    if not path.endswith(".parquet"):
+        return hl.read_table(path)
+    ht = hl.Table.from_spark(SparkSession.builder.getOrCreate().read.parquet(path))
+    return ht.annotate(
+        variants=ht.variants.map(
+            lambda v: v.annotate(
+                locus=hl.locus(
+                    v.locus.contig, v.locus.position, reference_genome="GRCh38"
+                )
+            )
+        )
+    )
+
+
+def write_outputs(
+    df: polars.DataFrame,
+    output_prefix: str,
+    reference_fasta: str,
+    window_size: int,
+    local_sequences: bool,
+    export_tsv: bool,
+    split_contigs: bool,
+    fasta_workers: int,
+    fasta_dict: bool,
+    tmp_dir: str,
+    dedup_sequences: bool,
+) -> polars.DataFrame:
+    # builds everything from scratch; `build_contig_partitions` is the incremental counterpart
+    if local_sequences:
+        typer.echo("building sequences from the reference FASTA")
+        sequence = haplotype_sequences(
+            ReferenceFasta(reference_fasta), df["variants"], window_size
+        )
+        df = df.select(
+            sequence,
+            sequence.str.len_chars().alias("sequence_length"),
+            polars.all(),
+        )
+    if export_tsv:
+        typer.echo("exporting TSV")
+        write_tsv(df, f"{output_prefix}.tsv.bgz")
+    if dedup_sequences:
+        df = with_fasta_records(df)
+    if split_contigs:
+        df = df.with_columns(contig=df["variants"].str.split(":").list.get(0))
+
+        contigs = df["contig"].unique().to_list()
+        typer.echo(
+            f"creating FASTAs for {len(contigs)} chromosomes with {fasta_workers} processes"
+        )
+        # each process reads its own contig's records back from this file
+        records_path = os.path.join(
+            tmp_dir, f"{os.path.basename(output_prefix)}.fasta_records.parquet"
+        )
+        fasta_rows(df).select("contig", "sequence_id", "sequence").write_parquet(
+            records_path
+        )
+        write_contig_fastas(
+            records_path,
+            {chr: f"{output_prefix}.{chr}.fasta" for chr in contigs},
+            fasta_workers,
+            fasta_dict,
+        )
+        os.remove(records_path)
+    else:
+        typer.echo("creating FASTA")
+        write_fasta(fasta_rows(df), f"{output_prefix}.fasta", fasta_dict)
+    return df
+
+
 @app.command()
 def main(
     haplotypes_table_path: str = typer.Option(
-        default=..., help="haplotypes table path"
+        default=...,
+        help="haplotypes table path, a Hail table or the .parquet of compute_haplotypes_local.py",
     ),
     gnomad_va_file: str = typer.Option(
         default=..., help="gnomAD computed variant frequencies"
     ),
-    reference_fasta: str = typer.Option(default=..., help="fasta path"),
+    reference_fasta: str = typer.Option(
+        default=...,
+        help="fasta path (uncompressed, with a .fai index, for --local-sequences)",
+    ),
     window_size: int = typer.Option(default=..., help="Base window size"),
     output_base: str = typer.Option(default=..., help="Output base path"),
     merge: bool = typer.Option(default=False, help="Merge gnomad variants"),
@@ -103,23 +205,76 @@ def main(
         default=0.005, help="Frequency cutoff for gnomAD truncation"
     ),
     split_contigs: bool = typer.Option(default=False, help="Split contigs"),
+    fasta_workers: int = typer.Option(
+        default=8, help="Number of processes writing per-contig FASTAs"
+    ),
+    fasta_dict: bool = typer.Option(
+        default=False,
+        help="Also write a sequence dictionary (as `samtools dict -u NA`) next to each FASTA",
+    ),
     version_str: str = typer.Option(default=..., help="Version string"),
     tmp_dir: str = typer.Option(default="/tmp", help="Temporary directory"),
+    local_sequences: bool = typer.Option(
+        default=False,
+        help="Build sequences locally from the memory-mapped reference FASTA instead of in Hail",
+    ),
+    export_tsv: bool = typer.Option(
+        default=False,
+        help="Also export all sequences and frequencies as a bgzipped TSV, as included in the bundle",
+    ),
+    incremental: bool = typer.Option(
+        default=False,
+        help="Only rebuild the per-contig outputs whose inputs changed since the last build "
+        "into --output-base, whose index is the default --previous-index "
+        "(requires --split-contigs and --local-sequences)",
+    ),
+    previous_index: Optional[str] = typer.Option(
+        default=None,
+        help="DuckDB index of a previous DivRef build; sequences it contains keep their ID "
+        "numbers, and new sequences are numbered after them. Without it, sequences are "
+        "numbered afresh and IDs don't carry over between releases",
+    ),
+    remap_sidecar: bool = typer.Option(
+        default=False,
+        help="Also write a memory-mapped binary index for remap_divref.py",
+    ),
+    sequence_store: bool = typer.Option(
+        default=False,
+        help="Also write a 2-bit packed sequence store for random access to sequences",
+    ),
+    dedup_sequences: bool = typer.Option(
+        default=False,
+        help="Write sequences with the same bases once to the FASTA; the index maps each "
+        "sequence to its FASTA record, and remap_divref.py reports a hit for all of them",
+    ),
+    local_split: bool = typer.Option(
+        default=False,
+        help="Split haplotypes at --window-size in polars after the table is exported, "
+        "rather than in Hail (requires --local-sequences)",
+    ),
 ):
     """
     Process VCF files with gnomAD annotations and output filtered results.
     """
+    if incremental and not (split_contigs and local_sequences):
+        raise typer.BadParameter(
+            "--incremental requires --split-contigs and --local-sequences"
+        )
+    if local_split and not local_sequences:
+        raise typer.BadParameter("--local-split requires --local-sequences")
+
     # Initialize Hail
     hl.init()
     #
-    ht = hl.read_table(haplotypes_table_path).key_by()
+    ht = read_haplotypes_table(haplotypes_table_path).key_by()
     va = hl.read_table(gnomad_va_file)
     pops_legend = va.pops.collect()[0]
 
     va.describe()
     ht.describe()
 
-    hl.get_reference("GRCh38").add_sequence(reference_fasta)
+    if not local_sequences:
+        hl.get_reference("GRCh38").add_sequence(reference_fasta)
 
     ht.describe()
 
@@ -136,21 +291,30 @@ def main(
     )
 
     ht = ht.filter(ht.estimated_gnomad_AF >= frequency_cutoff)
-    ht = ht.rename({"max_empirical_AN": "max_empirical_AC"})
+    # tables from older versions of compute_haplotypes.py name the allele counts AN
+    if "max_empirical_AN" in ht.row:
+        ht = ht.rename({"max_empirical_AN": "max_empirical_AC"})
+        ht = ht.annotate(
+            all_pop_freqs=ht.all_pop_freqs.map(
+                lambda x: x.rename({"empirical_AN": "empirical_AC"})
+            )
+        )
 
-    ht = split_haplotypes(ht, window_size)
-    ht = ht.key_by("haplotype").distinct().key_by().drop("haplotype")
+    if not local_split:
+        ht = split_haplotypes(ht, window_size)
+        ht = ht.key_by("haplotype").distinct().key_by()
     ht = ht.annotate(
         source="HGDP_haplotype",
         all_pop_freqs=ht.all_pop_freqs.map(
             lambda x: hl.struct(
-                pop=x.pop, empirical_AC=x.empirical_AN, empirical_AF=x.empirical_AF
+                pop=x.pop, empirical_AC=x.empirical_AC, empirical_AF=x.empirical_AF
             )
         ),
     )
-    print(
-        f"after splitting at window size {window_size}, haplotype table contains {ht.count()} unique haplotypes above frequency threshold"
-    )
+    if not local_split:
+        print(
+            f"after splitting at window size {window_size}, haplotype table contains {ht.count()} unique haplotypes above frequency threshold"
+        )
 
     # now add in gnomAD variants if merging
     if merge:
@@ -186,71 +350,162 @@ def main(
 
     ht.describe()
 
-    ht = ht.add_index()
-    ht = ht.annotate(sequence=get_haplo_sequence(window_size, ht.variants))
-    ht = ht.annotate(variant_strs=ht.variants.map(lambda x: hl.variant_str(x)))
-
-    ht = ht.annotate(
-        sequence_length=hl.len(ht.sequence),
-        sequence_id=hl.str(f"DR-{version_str}-") + hl.str(ht.idx),
-        n_variants=hl.len(ht.variants),
-    ).drop("idx")
-
+    if not local_sequences:
+        ht = ht.annotate(sequence=get_haplo_sequence(window_size, ht.variants))
+        ht = ht.annotate(sequence_length=hl.len(ht.sequence))
     file_suffix = ".haplotypes" if not merge else ".haplotypes_gnomad_merge"
 
     ht = ht.checkpoint(os.path.join(tmp_dir, f"{file_suffix}.ht"), overwrite=True)
 
+    # hand the table to polars and DuckDB as Parquet, rather than a text export that has to
+    # be decompressed, parsed and type-inferred again; with --local-sequences, sequences are
+    # added after it's read back, and with --local-split haplotypes are split there too.
+    # Per-variant columns stay lists until then (`haplotype` is missing for gnomAD variants)
+    af_columns = [f"gnomAD_AF_{pop}" for pop in pops_legend]
+    parquet_path = os.path.join(tmp_dir, f"{file_suffix}.parquet")
     ht.select(
-        "sequence",
-        "sequence_length",
-        "sequence_id",
-        "n_variants",
+        *([] if local_sequences else ["sequence", "sequence_length"]),
+        "haplotype",
         "popmax_empirical_AF",
         "popmax_empirical_AC",
         "estimated_gnomad_AF",
         "fraction_phased",
         "source",
+        "variants",
         max_pop=hl.literal(pops_legend)[ht.max_pop],
-        variants=hl.delimit(ht.variant_strs, ","),
         **{
-            f"gnomAD_AF_{pop}": hl.delimit(
-                ht.gnomad_freqs.map(lambda x: hl.format("%.5f", x[i].AF)), ","
-            )
-            for i, pop in enumerate(pops_legend)
+            column: ht.gnomad_freqs.map(lambda x: hl.format("%.5f", x[i].AF))
+            for i, column in enumerate(af_columns)
         },
-    ).export(output_base + f"{file_suffix}.tsv.bgz")
+    ).to_spark().write.mode("overwrite").parquet(parquet_path)
+
+    df = polars.read_parquet(os.path.join(parquet_path, "*.parquet"))
+    if local_split:
+        haplotypes = split_haplotypes_local(
+            df.filter(polars.col("haplotype").is_not_null()),
+            window_size,
+            ["haplotype", "variants", *af_columns],
+        )
+        # one row per distinct piece, as Hail's `distinct()`, keeping the piece of the
+        # haplotype with the highest popmax_empirical_AF
+        haplotypes = haplotypes.sort(
+            "popmax_empirical_AF", descending=True, maintain_order=True
+        ).unique("haplotype", keep="first", maintain_order=True)
+        typer.echo(
+            f"after splitting at window size {window_size}, haplotype table contains {len(haplotypes)} unique haplotypes above frequency threshold"
+        )
+        df = polars.concat([haplotypes, df.filter(polars.col("haplotype").is_null())])
 
-    df = polars.read_csv(
-        output_base + f"{file_suffix}.tsv.bgz",
-        separator="\t",
-        schema_overrides={"sequence_id": polars.String},
+    locus = polars.element().struct.field("locus")
+    alleles = polars.element().struct.field("alleles")
+    df = df.select(
+        *([] if local_sequences else ["sequence", "sequence_length"]),
+        polars.col("variants").list.len().cast(polars.Int32).alias("n_variants"),
+        "popmax_empirical_AF",
+        "popmax_empirical_AC",
+        "estimated_gnomad_AF",
+        "fraction_phased",
+        "source",
+        "max_pop",
+        # as hl.variant_str
+        polars.col("variants")
+        .list.eval(
+            polars.concat_str(
+                locus.struct.field("contig"),
+                locus.struct.field("position"),
+                alleles.list.get(0),
+                alleles.list.get(1),
+                separator=":",
+            )
+        )
+        .list.join(","),
+        *(polars.col(column).list.join(",") for column in af_columns),
     )
-    if split_contigs:
-        df = df.with_columns(contig=df["variants"].str.split(":").list.get(0))
 
-        for chr in df["contig"].unique().to_list():
-            typer.echo("creating FASTA for chromosome " + chr)
-            df2 = df.filter(df["contig"] == chr)
+    duckdb_file = output_base + f"{file_suffix}.index.duckdb"
+    if previous_index is None and incremental and os.path.exists(duckdb_file):
+        previous_index = duckdb_file
+    # read before the index is rebuilt, as it may be the same file
+    previous, previous_window_size = None, None
+    if previous_index is not None:
+        previous, previous_window_size, previous_prefix = read_previous_sequences(
+            previous_index
+        )
 
-            with open(output_base + f"{file_suffix}.{chr}.fasta", "w") as f:
-                for sequence, sequence_id in df2.select(
-                    "sequence", "sequence_id"
-                ).iter_rows():
-                    f.write(f">{sequence_id}\n{sequence}\n")
+    # sequence IDs are a fixed prefix and an integer, which remapping looks up by, numbered
+    # in a deterministic order rather than Hail's partition order and kept from the previous
+    # build, so that a changed sequence doesn't renumber the others
+    sequence_id_prefix = f"DR-{version_str}-"
+    df = assign_sequence_ids(
+        df, sequence_id_prefix, window_size, previous, previous_window_size
+    )
+
+    if incremental:
+        typer.echo("building changed contigs")
+        df = build_contig_partitions(
+            df,
+            output_base + file_suffix,
+            ReferenceFasta(reference_fasta),
+            window_size,
+            fasta_workers,
+            fasta_dict,
+            export_tsv,
+            dedup_sequences,
+        )
     else:
-        typer.echo("creating FASTA")
-        with open(output_base + f"{file_suffix}.fasta", "w") as f:
-            for sequence, sequence_id in df.select(
-                "sequence", "sequence_id"
-            ).iter_rows():
-                f.write(f">{sequence_id}\n{sequence}\n")
+        df = write_outputs(
+            df,
+            output_base + file_suffix,
+            reference_fasta,
+            window_size,
+            local_sequences,
+            export_tsv,
+            split_contigs,
+            fasta_workers,
+            fasta_dict,
+            tmp_dir,
+            dedup_sequences,
+        )
 
-    duckdb_file = output_base + f"{file_suffix}.index.duckdb"
     if os.path.exists(duckdb_file):
         os.remove(duckdb_file)
+    # precompute variant intervals so remapping doesn't re-parse `variants` for every hit
+    df = with_variant_intervals(df, window_size)
+    # and store frequencies as float lists, so remapping doesn't parse them either
+    df = with_typed_frequencies(df)
+
+    df = df.with_columns(
+        sequence_idx=polars.col("sequence_id")
+        .str.strip_prefix(sequence_id_prefix)
+        .cast(polars.Int64)
+    )
+
+    fasta_records = None
+    if dedup_sequences:
+        # sequences written as another sequence's FASTA record; the rest are their own
+        fasta_records = df.filter(
+            polars.col("fasta_record") != polars.col("sequence_id")
+        ).select(
+            "sequence_idx",
+            fasta_record_idx=polars.col("fasta_record")
+            .str.strip_prefix(sequence_id_prefix)
+            .cast(polars.Int64),
+        )
+        typer.echo(
+            f"{len(df) - len(fasta_records)} FASTA records for {len(df)} sequences"
+        )
+        df = df.drop("fasta_record")
+
     con = duckdb.connect(output_base + f"{file_suffix}.index.duckdb")
-    con.execute("CREATE TABLE sequences AS SELECT * FROM df")
+    con.execute("CREATE TABLE sequences AS SELECT * FROM df ORDER BY sequence_idx")
     con.execute("CREATE INDEX idx_sequence_id ON sequences(sequence_id)")
+    con.execute("CREATE INDEX idx_sequence_idx ON sequences(sequence_idx)")
+    # sorted by contig and start, so region lookups scan a narrow range of each contig
+    spans = sequence_spans(df, window_size)
+    con.execute("CREATE TABLE sequence_spans AS SELECT * FROM spans")
+    con.execute(
+        f"CREATE TABLE sequence_id_prefix AS SELECT '{sequence_id_prefix}' AS sequence_id_prefix"
+    )
 
     # create a single window_size value
     con.execute(f"CREATE TABLE window_size AS SELECT {window_size} AS window_size")
@@ -259,8 +514,56 @@ def main(
     con.execute(f"CREATE TABLE pops_legend AS SELECT {pops_legend} AS pops_legend")
     con.execute(f"CREATE TABLE VERSION AS SELECT {version_str} AS version")
 
+    if fasta_records is not None:
+        con.execute("CREATE TABLE fasta_records AS SELECT * FROM fasta_records")
+        con.execute("""
+            CREATE VIEW fasta_records_ids AS
+            SELECT sequence_id_prefix || sequence_idx AS sequence_id,
+                   sequence_id_prefix || fasta_record_idx AS fasta_record
+            FROM fasta_records, sequence_id_prefix
+            """)
+
+    if previous_index is not None:
+        # sequences are matched across builds by stable ID and keep their index, so this
+        # lists only the previous build's sequences that were renumbered
+        id_mapping = sequence_id_mapping(previous, previous_window_size, df)
+        kept = df["sequence_idx"].is_in(previous["sequence_idx"].implode()).sum()
+        typer.echo(
+            f"{kept} of {len(previous)} sequences in {previous_index} keep their numbers, "
+            f"{len(id_mapping)} more are renumbered"
+        )
+        con.execute("CREATE TABLE id_mapping AS SELECT * FROM id_mapping")
+        con.execute(
+            f"CREATE TABLE previous_sequence_id_prefix AS SELECT '{previous_prefix}' AS previous_sequence_id_prefix"
+        )
+        con.execute("""
+            CREATE VIEW id_mapping_ids AS
+            SELECT previous_sequence_id_prefix || previous_sequence_idx AS previous_sequence_id,
+                   sequence_id_prefix || sequence_idx AS sequence_id
+            FROM id_mapping, previous_sequence_id_prefix, sequence_id_prefix
+            """)
+
     con.close()
 
+    if remap_sidecar:
+        typer.echo("creating remap sidecar")
+        write_remap_sidecar(
+            df,
+            output_base + f"{file_suffix}.remap.bin",
+            version_str,
+            window_size,
+            sequence_id_prefix,
+            fasta_records,
+        )
+
+    if sequence_store:
+        typer.echo("creating sequence store")
+        write_sequence_store(
+            df,
+            output_base + f"{file_suffix}.sequences.bin",
+            sequence_id_prefix,
+        )
+
 
 if __name__ == "__main__":
     app()
@@ -0,0 +1,586 @@
+"""
+Hail-free haplotype discovery over phased VCF/BCF files, used by `compute_haplotypes_local.py` to
+build the haplotype table of `compute_haplotypes.py` on a single machine, and helpers to split
+and count haplotype tables.
+"""
+
+import gzip
+import json
+import multiprocessing
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, NamedTuple, Sequence
+
+import numpy as np
+import polars
+import pyarrow as pa
+
+ALT = ord("1")
+MISSING = ord(".")
+TAB = ord("\t")
+PHASED = ord("|")
+UNPHASED = ord("/")
+
+POP_FREQ_SCHEMA = polars.Struct(
+    {
+        "pop": polars.Int32,
+        "empirical_AC": polars.Int64,
+        "min_variant_frequency": polars.Float64,
+        "empirical_AF": polars.Float64,
+    }
+)
+POP_FREQ_FIELDS = [field.name for field in POP_FREQ_SCHEMA.fields]
+
+
+def contig_sort_key(contig: str) -> tuple:
+    # GRCh38 order (chr1..chr22, chrX, chrY, chrM), the order Hail numbers rows in
+    name = contig.removeprefix("chr")
+    if name.isdigit():
+        return (0, int(name), "")
+    if name in ("X", "Y", "M"):
+        return (0, 23 + "XYM".index(name), "")
+    return (1, 0, contig)
+
+
+def scan_parquet(path: str) -> polars.LazyFrame:
+    # Spark (`Table.to_spark().write.parquet`) writes a directory of part files
+    if os.path.isdir(path):
+        path = os.path.join(path, "*.parquet")
+    return polars.scan_parquet(path)
+
+
+def gnomad_pops(va_path: str) -> list[str]:
+    """
+    The populations of `pop_freqs` in a Parquet export of the gnomAD variant table, in order, from
+    the `_pops.json` legend that `extract_gnomad_afs.py --parquet` writes into it.
+    """
+    with open(os.path.join(va_path, "_pops.json")) as f:
+        return json.load(f)
+
+
+def common_gnomad_sites(
+    va_path: str, contig: str, freq_threshold: float
+) -> polars.DataFrame:
+    """
+    gnomAD sites on `contig` with AF >= `freq_threshold` in at least one population, from a
+    Parquet export of the gnomAD variant table (`extract_gnomad_afs.py --parquet`).
+    """
+    return (
+        scan_parquet(va_path)
+        .filter(polars.col("contig") == contig)
+        .filter(
+            polars.col("pop_freqs")
+            .list.eval(polars.element().struct.field("AF"))
+            .list.max()
+            >= freq_threshold
+        )
+        .select("position", "ref", "alt", "pop_freqs")
+        .collect()
+    )
+
+
+def sample_populations(sa_path: str, samples: list[str], pops: list[str]) -> np.ndarray:
+    """
+    Population index of each VCF sample in `pops`, or -1 for samples without a population in it,
+    from a Parquet export of the gnomAD sample table.
+    """
+    pop_of = dict(scan_parquet(sa_path).select("s", "pop").collect().iter_rows())
+    pop_index = {pop: i for i, pop in enumerate(pops)}
+    return np.array(
+        [pop_index.get(pop_of.get(sample), -1) for sample in samples], dtype=np.int64
+    )
+
+
+class ContigGenotypes(NamedTuple):
+    """
+    Phased genotypes of one contig at the sites of a VCF that are common in gnomAD.
+
+    `haplotypes` has one bit-packed row per site and two columns (left, right) per sample, set
+    where that haplotype carries the alternate allele. As in `compute_haplotypes.py`, genotypes
+    of samples whose population has gnomAD AF below the frequency threshold at a site are
+    dropped; `AC` and `AN` are the alternate allele and called allele counts per population of
+    the genotypes that remain.
+    """
+
+    contig: str
+    sites: polars.DataFrame
+    haplotypes: np.ndarray
+    AC: np.ndarray
+    AN: np.ndarray
+
+
+def open_vcf(path: str, bcftools: str = "bcftools"):
+    if path.endswith(".bcf"):
+        # BCF is binary; bcftools decodes it to VCF text as it is read
+        process = subprocess.Popen(
+            [bcftools, "view", "--no-version", path], stdout=subprocess.PIPE
+        )
+        return process.stdout
+    with open(path, "rb") as f:
+        gzipped = f.read(2) == b"\x1f\x8b"
+    return gzip.open(path, "rb") if gzipped else open(path, "rb")
+
+
+def parse_genotypes(samples: bytes, n_samples: int) -> tuple[np.ndarray, ...]:
+    """
+    Left and right alleles (as ASCII codes) and ploidy of each sample field of a VCF line.
+
+    GT is always the first FORMAT field, so for a biallelic site the alleles are the first and
+    third bytes of each field; haploid calls have no separator and get a missing right allele.
+    """
+    data = np.frombuffer(samples.rstrip(b"\r\n") + b"\t\t", dtype=np.uint8)
+    starts = np.empty(n_samples, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = np.flatnonzero(data[:-2] == TAB)[: n_samples - 1] + 1
+    separator = data[starts + 1]
+    diploid = (separator == PHASED) | (separator == UNPHASED)
+    right = np.where(diploid, data[starts + 2], MISSING)
+    return data[starts], right, diploid
+
+
+def read_contig_genotypes(
+    vcf_path: str,
+    va_path: str,
+    sample_pops: np.ndarray,
+    n_pops: int,
+    freq_threshold: float,
+    bcftools: str = "bcftools",
+) -> Iterator[ContigGenotypes]:
+    """
+    Stream the biallelic sites of a phased VCF that are common in gnomAD, one contig at a time.
+    `sample_pops` is the population index of each VCF sample (-1 to exclude it).
+    """
+    keep = np.flatnonzero(sample_pops >= 0)
+    pops = sample_pops[keep]
+    n_samples = len(sample_pops)
+
+    contig = None
+    rows, acs, ans, site_idx = [], [], [], []
+
+    def contig_genotypes():
+        return ContigGenotypes(
+            contig,
+            sites[site_idx],
+            np.array(rows, dtype=np.uint8).reshape(len(rows), (2 * len(keep) + 7) // 8),
+            np.array(acs, dtype=np.int64).reshape(len(acs), n_pops),
+            np.array(ans, dtype=np.int64).reshape(len(ans), n_pops),
+        )
+
+    with open_vcf(vcf_path, bcftools) as f:
+        for line in f:
+            if line.startswith(b"#"):
+                continue
+            chrom, pos, _, ref, alt, rest = line.split(b"\t", 5)
+            if chrom.decode() != contig:
+                if contig is not None:
+                    yield contig_genotypes()
+                contig = chrom.decode()
+                sites = common_gnomad_sites(va_path, contig, freq_threshold)
+                site_keys = {
+                    (str(p).encode(), r.encode(), a.encode()): i
+                    for i, (p, r, a) in enumerate(
+                        sites.select("position", "ref", "alt").iter_rows()
+                    )
+                }
+                pop_common = (
+                    sites["pop_freqs"]
+                    .list.eval(polars.element().struct.field("AF"))
+                    .list.to_array(n_pops)
+                    .to_numpy()
+                    >= freq_threshold
+                )
+                rows, acs, ans, site_idx = [], [], [], []
+            i = site_keys.get((pos, ref, alt))
+            if i is None:
+                continue
+
+            left, right, diploid = parse_genotypes(rest.split(b"\t", 4)[4], n_samples)
+            left, right, diploid = left[keep], right[keep], diploid[keep]
+            called = (
+                pop_common[i][pops]
+                & (left != MISSING)
+                & (~diploid | (right != MISSING))
+            )
+            carriers = np.empty(2 * len(keep), dtype=bool)
+            carriers[0::2] = called & (left == ALT)
+            carriers[1::2] = called & (right == ALT)
+            rows.append(np.packbits(carriers))
+            acs.append(
+                np.bincount(
+                    pops,
+                    weights=carriers[0::2].astype(np.int64) + carriers[1::2],
+                    minlength=n_pops,
+                )
+            )
+            ans.append(
+                np.bincount(pops, weights=called * (1 + diploid), minlength=n_pops)
+            )
+            site_idx.append(i)
+    if contig is not None:
+        yield contig_genotypes()
+
+
+def window_starts(positions: np.ndarray, window_size: int, offset: int) -> np.ndarray:
+    # the staggered windows of `compute_haplotypes.py` are offset 0 and window_size // 2
+    return positions - (positions + offset) % window_size
+
+
+def _window_haplotypes(
+    haplotypes: np.ndarray, start: int, end: int, column_pops: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Each distinct set of 2+ alternate alleles carried together on a haplotype within sites
+    [start, end), per population: its population, its (sites, sets) carried alleles and the
+    number of haplotypes carrying it.
+    """
+    carried = np.unpackbits(haplotypes[start:end], axis=1, count=len(column_pops))
+    columns = np.flatnonzero(carried.sum(axis=0, dtype=np.int64) >= 2)
+    # haplotypes carrying the same alleles have the same population byte and packed bits
+    keys = np.ascontiguousarray(
+        np.concatenate(
+            [column_pops[columns, None], np.packbits(carried[:, columns], axis=0).T],
+            axis=1,
+        )
+    )
+    keys = keys.view(np.dtype((np.void, keys.shape[1]))).ravel()
+    _, first, counts = np.unique(keys, return_index=True, return_counts=True)
+    columns = columns[first]
+    return column_pops[columns], carried[:, columns].astype(bool), counts
+
+
+def contig_haplotypes(
+    genotypes: ContigGenotypes,
+    column_pops: np.ndarray,
+    window_size: int,
+    offsets: list[int],
+) -> polars.DataFrame:
+    """
+    Haplotypes of 2+ common variants observed within the staggered windows of one contig, with
+    the per-population statistics of `compute_haplotypes.py`. `haplotype` holds indices into
+    `genotypes.sites`.
+
+    A haplotype found in more than one window offset is kept once, with the statistics of the
+    window it has the highest `max_empirical_AF` in.
+    """
+    positions = genotypes.sites["position"].to_numpy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        AF = genotypes.AC / genotypes.AN
+    column_pops = column_pops.astype(np.uint8)
+
+    found = {}
+    for offset in offsets:
+        windows = window_starts(positions, window_size, offset)
+        bounds = np.flatnonzero(np.diff(windows)) + 1
+        for start, end in zip(
+            np.concatenate([[0], bounds]), np.concatenate([bounds, [len(positions)]])
+        ):
+            if end - start < 2:
+                continue
+            pops, carried, counts = _window_haplotypes(
+                genotypes.haplotypes, start, end, column_pops
+            )
+            if len(pops) == 0:
+                continue
+            # minimum AN and AF in each haplotype's population over the sites it carries
+            min_AN = np.where(carried, genotypes.AN[start:end, pops], np.inf).min(
+                axis=0
+            )
+            min_AF = np.where(carried, AF[start:end, pops], np.inf).min(axis=0)
+            pop_freqs = {}
+            _, sites = np.nonzero(carried.T)
+            sites = (start + sites).tolist()
+            ends = np.cumsum(carried.sum(axis=0)).tolist()
+            for j, (pop, count, AF_j, AN_j) in enumerate(
+                zip(pops.tolist(), counts.tolist(), min_AF.tolist(), min_AN.tolist())
+            ):
+                haplotype = tuple(sites[ends[j - 1] if j else 0 : ends[j]])
+                pop_freqs.setdefault(haplotype, []).append(
+                    (pop, count, AF_j, count / AN_j)
+                )
+            for haplotype, freqs in pop_freqs.items():
+                freqs.sort(key=lambda x: -x[3])
+                if haplotype not in found or freqs[0][3] > found[haplotype][0][3]:
+                    found[haplotype] = freqs
+
+    haplotypes = sorted(found)
+    pop_freqs = polars.DataFrame(
+        [(i, *f) for i, h in enumerate(haplotypes) for f in found[h]],
+        schema={"_row": polars.Int64, **POP_FREQ_SCHEMA.to_schema()},
+        orient="row",
+    )
+    return (
+        pop_freqs.group_by("_row", maintain_order=True)
+        .agg(
+            polars.col("pop").first().alias("max_pop"),
+            polars.col("empirical_AF").first().alias("max_empirical_AF"),
+            polars.col("empirical_AC").first().alias("max_empirical_AC"),
+            polars.col("min_variant_frequency").first(),
+            polars.struct(*POP_FREQ_FIELDS).alias("all_pop_freqs"),
+        )
+        .select(
+            polars.from_arrow(
+                pa.ListArray.from_arrays(
+                    np.cumsum([0] + [len(h) for h in haplotypes]),
+                    pa.array([i for h in haplotypes for i in h], type=pa.int64()),
+                )
+            ).alias("haplotype"),
+            polars.exclude("_row"),
+        )
+    )
+
+
+def with_variants(
+    haplotypes: polars.DataFrame, contig: str, sites: polars.DataFrame
+) -> polars.DataFrame:
+    # the `variants` and `gnomad_freqs` of each haplotype, from its indices into `sites`
+    variants = (
+        haplotypes.select(polars.int_range(polars.len()).alias("_row"), "haplotype")
+        .explode("haplotype")
+        .join(
+            sites.with_row_index("haplotype").with_columns(
+                polars.col("haplotype").cast(polars.Int64)
+            ),
+            on="haplotype",
+            maintain_order="left",
+        )
+        .group_by("_row", maintain_order=True)
+        .agg(
+            variants=polars.struct(
+                locus=polars.struct(
+                    contig=polars.lit(contig),
+                    position=polars.col("position").cast(polars.Int32),
+                ),
+                alleles=polars.concat_list("ref", "alt"),
+            ),
+            gnomad_freqs=polars.col("pop_freqs"),
+        )
+    )
+    return haplotypes.hstack(variants.drop("_row"))
+
+
+def _file_haplotypes(
+    vcf_path: str,
+    va_path: str,
+    sample_pops: np.ndarray,
+    n_pops: int,
+    window_size: int,
+    freq_threshold: float,
+    offsets: list[int],
+    bcftools: str,
+) -> list[tuple[str, int, polars.DataFrame]]:
+    results = []
+    column_pops = np.repeat(sample_pops[sample_pops >= 0], 2)
+    for genotypes in read_contig_genotypes(
+        vcf_path, va_path, sample_pops, n_pops, freq_threshold, bcftools
+    ):
+        haplotypes = contig_haplotypes(genotypes, column_pops, window_size, offsets)
+        results.append(
+            (
+                genotypes.contig,
+                len(genotypes.sites),
+                with_variants(haplotypes, genotypes.contig, genotypes.sites),
+            )
+        )
+    return results
+
+
+def vcf_samples(vcf_path: str, bcftools: str = "bcftools") -> list[str]:
+    with open_vcf(vcf_path, bcftools) as f:
+        for line in f:
+            if line.startswith(b"#CHROM"):
+                return line.rstrip(b"\r\n").decode().split("\t")[9:]
+    raise ValueError(f"{vcf_path} has no #CHROM header line")
+
+
+def discover_haplotypes(
+    vcf_paths: list[str],
+    va_path: str,
+    sa_path: str,
+    pops: list[str],
+    window_size: int,
+    freq_threshold: float,
+    offsets: list[int] | None = None,
+    workers: int = 1,
+    bcftools: str = "bcftools",
+) -> polars.DataFrame:
+    """
+    The haplotype table `compute_haplotypes.py` computes from phased VCFs, gnomAD variant
+    frequencies and sample populations, computed one file at a time on `workers` processes.
+
+    `haplotype` holds row indices of the common sites of all VCFs in GRCh38 order, as Hail numbers
+    them; each contig must be in a single file.
+    """
+    if offsets is None:
+        offsets = [0, window_size // 2]
+    samples = vcf_samples(vcf_paths[0], bcftools)
+    sample_pops = sample_populations(sa_path, samples, pops)
+
+    # spawn rather than fork: forking a process with polars' thread pool running is unsafe
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = [
+            executor.submit(
+                _file_haplotypes,
+                path,
+                va_path,
+                sample_pops,
+                len(pops),
+                window_size,
+                freq_threshold,
+                offsets,
+                bcftools,
+            )
+            for path in vcf_paths
+        ]
+        results = [r for future in futures for r in future.result()]
+
+    results.sort(key=lambda r: contig_sort_key(r[0]))
+    tables = []
+    first_row = 0
+    for contig, n_sites, haplotypes in results:
+        tables.append(
+            haplotypes.with_columns(
+                polars.col("haplotype").list.eval(polars.element() + first_row)
+            )
+        )
+        first_row += n_sites
+    if not tables:
+        raise ValueError(f"no variants found in {vcf_paths}")
+    return polars.concat(tables)
+
+
+def variant_gaps(variants: polars.Expr) -> polars.Expr:
+    """
+    Number of reference bases between each pair of consecutive variants of a haplotype (its
+    `variants` list of struct(locus, alleles)), as `variant_distance` in the Hail scripts:
+    1:1:A:T and 1:3:A:T have distance 1, 1:1:AA:T and 1:3:A:T distance 0.
+    """
+    position = polars.element().struct.field("locus").struct.field("position")
+    ref_end = (
+        position + polars.element().struct.field("alleles").list.first().str.len_chars()
+    )
+    return variants.list.eval((position.shift(-1) - ref_end).drop_nulls())
+
+
+def split_ranges(df: polars.DataFrame) -> polars.DataFrame:
+    """
+    Every run of 2+ consecutive variants `split_haplotypes` can split a haplotype into, with the
+    window sizes it does so for. `df` needs a `variants` column.
+
+    Splitting at window size `w` breaks a haplotype between variants whose distance is at least
+    `w`, so run [first, last] is one of its pieces exactly when `lo < w <= hi`, where `lo` is the
+    largest distance within the run and `hi` the smallest distance to the variants either side of
+    it (unbounded at either end of the haplotype). Returns `_row` (the row of `df`), `first`,
+    `last`, `lo` and `hi`.
+    """
+    unbounded = np.iinfo(np.int64).max
+    gaps = polars.col("gaps")
+    return (
+        df.select(
+            polars.int_range(polars.len()).alias("_row"),
+            variant_gaps(polars.col("variants")).alias("gaps"),
+        )
+        .with_columns(first=polars.int_ranges(0, gaps.list.len()))
+        .explode("first")
+        .drop_nulls("first")
+        .with_columns(
+            last=polars.int_ranges(polars.col("first") + 1, gaps.list.len() + 1)
+        )
+        .explode("last")
+        .select(
+            "_row",
+            "first",
+            "last",
+            lo=gaps.list.slice(
+                "first", polars.col("last") - polars.col("first")
+            ).list.max(),
+            hi=polars.min_horizontal(
+                polars.when(polars.col("first") > 0)
+                .then(gaps.list.get(polars.col("first") - 1))
+                .otherwise(unbounded),
+                gaps.list.get("last", null_on_oob=True).fill_null(unbounded),
+            ),
+        )
+        .filter(polars.col("lo") < polars.col("hi"))
+    )
+
+
+def split_haplotypes(
+    df: polars.DataFrame,
+    window_size: int,
+    list_columns: Sequence[str] = ("haplotype", "variants", "gnomad_freqs"),
+) -> polars.DataFrame:
+    """
+    `split_haplotypes` of the Hail scripts: each haplotype is split between consecutive variants
+    at least `window_size` apart into one row per piece of 2+ variants. `list_columns` hold one
+    element per variant and are sliced to the piece; other columns are repeated.
+    """
+    pieces = split_ranges(df).filter(
+        (polars.col("lo") < window_size) & (window_size <= polars.col("hi"))
+    )
+    length = polars.col("last") - polars.col("first") + 1
+    return (
+        pieces.join(
+            df.with_columns(polars.int_range(polars.len()).alias("_row")),
+            on="_row",
+            maintain_order="left",
+        )
+        .with_columns(
+            polars.col(column).list.slice("first", length) for column in list_columns
+        )
+        .select(df.columns)
+    )
+
+
+def haplotype_window_counts(
+    df: polars.DataFrame,
+    frequency_column: str,
+    frequency_cutoffs: list[float],
+    window_sizes: list[int],
+) -> polars.DataFrame:
+    """
+    For every frequency cutoff and window size, the number of distinct haplotypes left after
+    filtering `df` to `frequency_column >= cutoff` and splitting it at that window size, as
+    `compute_haplotype_statistics.py` counts them. `df` needs `haplotype` and `variants` columns.
+
+    All combinations come from one pass: each distinct piece is grouped once with the highest
+    frequency of a haplotype it is split from at each window size.
+    """
+    ranges = split_ranges(df).join(
+        df.select(
+            polars.int_range(polars.len()).alias("_row"),
+            "haplotype",
+            polars.col(frequency_column).alias("_frequency"),
+        ),
+        on="_row",
+    )
+    pieces = ranges.group_by(
+        polars.col("haplotype").list.slice(
+            "first", polars.col("last") - polars.col("first") + 1
+        )
+    ).agg(
+        polars.when((polars.col("lo") < w) & (w <= polars.col("hi")))
+        .then(polars.col("_frequency"))
+        .max()
+        .alias(str(w))
+        for w in window_sizes
+    )
+    counts = pieces.select(
+        (polars.col(str(w)) >= f).sum().alias(f"{i},{w}")
+        for i, f in enumerate(frequency_cutoffs)
+        for w in window_sizes
+    ).row(0)
+    return polars.DataFrame(
+        {
+            "frequency": [f for f in frequency_cutoffs for _ in window_sizes],
+            "window_size": [w for _ in frequency_cutoffs for w in window_sizes],
+            "hgdp_haplotype_count": counts,
+        },
+        schema={
+            "frequency": polars.Float64,
+            "window_size": polars.Int64,
+            "hgdp_haplotype_count": polars.Int64,
+        },
+    )
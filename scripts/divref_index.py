@@ -0,0 +1,910 @@
+"""
+Hail-free helpers used by `create_fasta_and_index.py` to build the DivRef FASTA and DuckDB index.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import duckdb
+import numpy as np
+import polars
+import pyarrow as pa
+
+from divref_haplotypes import contig_sort_key
+from divref_io import (
+    SEQUENCE_STORE_MAGIC,
+    SIDECAR_MAGIC,
+    BgzfWriter,
+    write_array_file,
+)
+
+
+def _explode_variants(variants: polars.Series) -> polars.DataFrame:
+    # one row per variant of each `variants` string, with `_row` the index of the string
+    return (
+        polars.DataFrame({"variants": variants})
+        .select(
+            polars.int_range(polars.len()).alias("_row"),
+            polars.col("variants").str.split(","),
+        )
+        .explode("variants")
+        .select(
+            "_row",
+            polars.col("variants").str.strip_chars().str.split_exact(":", 3).alias("v"),
+        )
+        .select(
+            "_row",
+            contig=polars.col("v").struct.field("field_0"),
+            position=polars.col("v").struct.field("field_1").cast(polars.Int64),
+            ref=polars.col("v").struct.field("field_2"),
+            alt=polars.col("v").struct.field("field_3"),
+        )
+    )
+
+
+def with_variant_intervals(df: polars.DataFrame, context_size: int) -> polars.DataFrame:
+    """
+    Add per-sequence variant interval list columns, computed from the `variants` column:
+
+    - `variant_starts`, `variant_ends`: [start, end) of each alternate allele in 0-indexed
+      haplotype sequence space
+    - `variant_ref_starts`, `variant_ref_ends`: [start, end) of each reference allele on GRCh38
+
+    These match the intervals `remap_divref.py` would otherwise derive by parsing `variants`.
+    """
+    variants = _explode_variants(df["variants"]).select(
+        "_row",
+        "position",
+        ref_len=polars.col("ref").str.len_chars().cast(polars.Int64),
+        alt_len=polars.col("alt").str.len_chars().cast(polars.Int64),
+    )
+
+    # each variant shifts the haplotype coordinates of all following variants by len(ref) - len(alt)
+    size_change = polars.col("ref_len") - polars.col("alt_len")
+    index_translation = (
+        polars.col("position").first().over("_row")
+        - context_size
+        + (size_change.cum_sum().over("_row") - size_change)
+    )
+    intervals = (
+        variants.with_columns(variant_start=polars.col("position") - index_translation)
+        .group_by("_row", maintain_order=True)
+        .agg(
+            variant_starts=polars.col("variant_start"),
+            variant_ends=polars.col("variant_start") + polars.col("alt_len"),
+            variant_ref_starts=polars.col("position"),
+            variant_ref_ends=polars.col("position") + polars.col("ref_len"),
+        )
+        .drop("_row")
+        .select(polars.all().cast(polars.List(polars.Int32)))
+    )
+    return df.hstack(intervals)
+
+
+def with_typed_frequencies(df: polars.DataFrame) -> polars.DataFrame:
+    """
+    Convert the comma-joined `gnomAD_AF_<pop>` columns, as written to the TSV export, to
+    `Float32` lists with one element per variant, null where gnomAD has no frequency.
+    """
+    return df.with_columns(
+        polars.col(c).str.split(",").cast(polars.List(polars.Float32), strict=False)
+        for c in df.columns
+        if c.startswith("gnomAD_AF_")
+    )
+
+
+def sequence_spans(df: polars.DataFrame, context_size: int) -> polars.DataFrame:
+    """
+    The GRCh38 interval each sequence covers, for looking sequences up by region: `contig`,
+    `span_start` and `span_end` (0-based, half-open, as BED) and `sequence_idx`, sorted by
+    contig and start. Spans include the `context_size` bases either side of the variants, and
+    aren't truncated at the ends of contigs.
+    """
+    variants = _explode_variants(df["variants"])
+    return (
+        variants.group_by("_row", maintain_order=True)
+        .agg(
+            polars.col("contig").first(),
+            span_start=(polars.col("position").min() - 1 - context_size).clip(0),
+            span_end=(
+                polars.col("position")
+                + polars.col("ref").str.len_chars().cast(polars.Int64)
+            ).max()
+            - 1
+            + context_size,
+        )
+        .drop("_row")
+        .with_columns(df["sequence_idx"])
+        .sort("contig", "span_start", "sequence_idx")
+    )
+
+
+def _string_arrays(column: polars.Series) -> tuple[np.ndarray, np.ndarray]:
+    # (offsets, utf-8 data) of a string column, as Arrow lays it out
+    arr = column.rechunk().to_arrow().cast(pa.large_string())
+    _, offsets, data = arr.buffers()
+    offsets = np.frombuffer(offsets, dtype=np.int64)[
+        arr.offset : arr.offset + len(arr) + 1
+    ]
+    data = np.frombuffer(data, dtype=np.uint8)[offsets[0] : offsets[-1]]
+    return offsets - offsets[0], data
+
+
+def _record_count(sequence_idx: np.ndarray) -> int:
+    # records in a file keyed by the sorted `sequence_idx`, from 0 to the largest
+    if len(sequence_idx) and (
+        sequence_idx[0] < 0 or (np.diff(sequence_idx) == 0).any()
+    ):
+        raise ValueError("sequence_idx must be unique and non-negative")
+    return int(sequence_idx[-1]) + 1 if len(sequence_idx) else 0
+
+
+def _by_index(
+    values: np.ndarray, sequence_idx: np.ndarray, n_records: int
+) -> np.ndarray:
+    # per-sequence `values` placed at record `sequence_idx`, zero for unused indices
+    records = np.zeros(n_records, dtype=values.dtype)
+    records[sequence_idx] = values
+    return records
+
+
+def _offsets_by_index(
+    offsets: np.ndarray, sequence_idx: np.ndarray, n_records: int
+) -> np.ndarray:
+    # offsets of rows sorted by `sequence_idx`, with empty records for unused indices
+    lengths = _by_index(np.diff(offsets), sequence_idx, n_records)
+    records = np.zeros(n_records + 1, dtype=np.int64)
+    np.cumsum(lengths, out=records[1:])
+    return records
+
+
+def _list_arrays(column: polars.Series) -> tuple[np.ndarray, np.ndarray]:
+    # (offsets, values) of an Int32 list column
+    offsets = np.zeros(len(column) + 1, dtype=np.int64)
+    np.cumsum(column.list.len().to_numpy(), out=offsets[1:])
+    return offsets, column.explode().to_numpy().astype(np.int32)
+
+
+def write_remap_sidecar(
+    df: polars.DataFrame,
+    path: str,
+    version_str: str,
+    window_size: int,
+    sequence_id_prefix: str,
+    fasta_records: Optional[polars.DataFrame] = None,
+):
+    """
+    Write the columns `remap_divref.py` needs into a compact binary file it can memory-map.
+    Record `i` of its arrays is the sequence with `sequence_idx` i; `present` marks the indices
+    in use, as indices of sequences dropped since a previous build are not reused.
+
+    `df` must have the variant interval columns from `with_variant_intervals`, the frequency
+    columns of `with_typed_frequencies`, and a unique `sequence_idx` column. The spans of
+    `sequence_spans` are stored per contig, for region lookups. `fasta_records`, as the index's
+    `fasta_records` table, lists the sequences written as another sequence's FASTA record.
+    """
+    df = df.sort("sequence_idx")
+    sequence_idx = df["sequence_idx"].to_numpy()
+    n_records = _record_count(sequence_idx)
+
+    max_pop_values = sorted(df["max_pop"].unique().to_list())
+    source_values = sorted(df["source"].unique().to_list())
+    arrays = {
+        name: _by_index(values, sequence_idx, n_records)
+        for name, values in {
+            "present": np.ones(len(df), dtype=np.uint8),
+            "popmax_empirical_AF": df["popmax_empirical_AF"]
+            .to_numpy()
+            .astype(np.float64),
+            "popmax_empirical_AC": df["popmax_empirical_AC"]
+            .to_numpy()
+            .astype(np.int64),
+            "max_pop": df["max_pop"]
+            .replace_strict(max_pop_values, range(len(max_pop_values)))
+            .to_numpy()
+            .astype(np.uint8),
+            "source": df["source"]
+            .replace_strict(source_values, range(len(source_values)))
+            .to_numpy()
+            .astype(np.uint8),
+        }.items()
+    }
+    offsets, arrays["variant_starts"] = _list_arrays(df["variant_starts"])
+    arrays["variant_offsets"] = _offsets_by_index(offsets, sequence_idx, n_records)
+    for name in ["variant_ends", "variant_ref_starts", "variant_ref_ends"]:
+        _, arrays[name] = _list_arrays(df[name])
+    offsets, arrays["variants_data"] = _string_arrays(df["variants"])
+    arrays["variants_offsets"] = _offsets_by_index(offsets, sequence_idx, n_records)
+    # one row per variant and column per population, aligned with the interval arrays
+    af_pops = [
+        c.removeprefix("gnomAD_AF_") for c in df.columns if c.startswith("gnomAD_AF_")
+    ]
+    arrays["population_AFs"] = np.column_stack(
+        [
+            df[f"gnomAD_AF_{pop}"].explode().to_numpy().astype(np.float32)
+            for pop in af_pops
+        ]
+    ).ravel()
+    spans = sequence_spans(df, window_size)
+    span_contigs = {}
+    position = 0
+    for (contig,), part in spans.partition_by(
+        "contig", as_dict=True, maintain_order=True
+    ).items():
+        max_length = (part["span_end"] - part["span_start"]).max()
+        span_contigs[contig] = [position, position + len(part), max_length]
+        position += len(part)
+    arrays["span_starts"] = spans["span_start"].to_numpy().astype(np.int64)
+    arrays["span_ends"] = spans["span_end"].to_numpy().astype(np.int64)
+    arrays["span_sequence_idx"] = spans["sequence_idx"].to_numpy().astype(np.int64)
+    if fasta_records is not None:
+        fasta_records = fasta_records.sort("fasta_record_idx", "sequence_idx")
+        for name in ["fasta_record_idx", "sequence_idx"]:
+            arrays[f"shared_{name}"] = fasta_records[name].to_numpy().astype(np.int64)
+
+    write_array_file(
+        path,
+        SIDECAR_MAGIC,
+        {
+            "version": version_str,
+            "window_size": window_size,
+            "sequence_id_prefix": sequence_id_prefix,
+            "n_sequences": n_records,
+            "max_pop_values": max_pop_values,
+            "source_values": source_values,
+            "span_contigs": span_contigs,
+            "af_pops": af_pops,
+        },
+        arrays,
+    )
+
+
+# 2-bit codes of A, C, G and T, of either case, in the sequence store; 255 marks bases the store
+# keeps as exception runs
+_BASE_CODES = np.full(256, 255, dtype=np.uint8)
+for _code, _base in enumerate(b"ACGT"):
+    _BASE_CODES[_base] = _BASE_CODES[_base + 32] = _code
+
+
+def _runs(mask: np.ndarray, values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # [start, end) of each run of consecutive positions in `mask` with the same value
+    same = np.zeros(len(mask), dtype=bool)
+    same[1:] = mask[1:] & mask[:-1] & (values[1:] == values[:-1])
+    starts = np.flatnonzero(mask & ~same)
+    ends = np.flatnonzero(mask & ~np.append(same[1:], False)) + 1
+    return starts, ends
+
+
+def write_sequence_store(df: polars.DataFrame, path: str, sequence_id_prefix: str):
+    """
+    Write the `sequence` of each row of `df` into a 2-bit packed store that `SequenceStore` in
+    `remap_divref.py` can slice without reading whole records, keyed by the unique
+    `sequence_idx` column of `df`. As in the remap sidecar, `present` marks the indices in use.
+
+    Sequences are concatenated and packed four bases to a byte, the first in the high bits, and
+    `offsets` holds the position of each sequence's first base. Bases other than A, C, G and T
+    (N, other IUPAC codes) are stored as [start, end) runs of one character over the
+    concatenation, and lowercase bases as [start, end) mask runs.
+    """
+    df = df.sort("sequence_idx")
+    sequence_idx = df["sequence_idx"].to_numpy()
+    n_records = _record_count(sequence_idx)
+
+    offsets, data = _string_arrays(df["sequence"])
+    codes = _BASE_CODES[data]
+    exception = codes == 255
+    lowercase = (data >= ord("a")) & (data <= ord("z"))
+    upper = np.where(lowercase, data - 32, data).astype(np.uint8)
+    exception_starts, exception_ends = _runs(exception, upper)
+    mask_starts, mask_ends = _runs(lowercase, lowercase)
+
+    codes[exception] = 0
+    codes = np.append(codes, np.zeros(-len(codes) % 4, dtype=np.uint8)).reshape(-1, 4)
+    packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+
+    write_array_file(
+        path,
+        SEQUENCE_STORE_MAGIC,
+        {"sequence_id_prefix": sequence_id_prefix, "n_sequences": n_records},
+        {
+            "present": _by_index(
+                np.ones(len(df), dtype=np.uint8), sequence_idx, n_records
+            ),
+            "offsets": _offsets_by_index(offsets, sequence_idx, n_records),
+            "packed": packed,
+            "exception_starts": exception_starts,
+            "exception_ends": exception_ends,
+            "exception_bases": upper[exception_starts],
+            "mask_starts": mask_starts,
+            "mask_ends": mask_ends,
+        },
+    )
+
+
+class ReferenceFasta:
+    """
+    An uncompressed FASTA file, memory-mapped for random access through its samtools `.fai`
+    index.
+    """
+
+    def __init__(self, path: str):
+        if path.endswith((".gz", ".bgz")):
+            raise ValueError(
+                f"{path} is compressed; local sequence lookup needs an uncompressed FASTA "
+                "with a .fai index (`samtools faidx`)"
+            )
+        names = []
+        fields = []
+        with open(path + ".fai") as f:
+            for line in f:
+                name, length, offset, linebases, linewidth = line.split("\t")[:5]
+                names.append(name)
+                fields.append(
+                    (int(length), int(offset), int(linebases), int(linewidth))
+                )
+        self.contig_index = {name: i for i, name in enumerate(names)}
+        self.lengths, self.offsets, self.linebases, self.linewidths = (
+            np.array(x, dtype=np.int64) for x in zip(*fields)
+        )
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+
+    def contig_digest(self, contig: str) -> str:
+        """
+        SHA-256 of the contig's bytes as laid out in the FASTA file.
+        """
+        i = self.contig_index[contig]
+        n_lines = -(-self.lengths[i] // self.linebases[i])
+        start = self.offsets[i]
+        return hashlib.sha256(
+            self.data[start : start + n_lines * self.linewidths[i]]
+        ).hexdigest()
+
+    def gather(self, contigs: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        """
+        Returns the bases at 0-indexed `positions` on `contigs` (indices into `contig_index`).
+        """
+        linebases = self.linebases[contigs]
+        return self.data[
+            self.offsets[contigs]
+            + (positions // linebases) * self.linewidths[contigs]
+            + positions % linebases
+        ]
+
+
+def _concat_ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    # concatenation of arange(start, start + length) for each range
+    ends = np.cumsum(lengths)
+    return np.arange(ends[-1] if len(ends) else 0) + np.repeat(
+        starts - (ends - lengths), lengths
+    )
+
+
+def _haplotype_sequences_batch(
+    reference: ReferenceFasta, variants: polars.Series, context_size: int
+) -> list[str]:
+    exploded = _explode_variants(variants).sort(
+        ["_row", "position"], maintain_order=True
+    )
+    row = exploded["_row"].to_numpy().astype(np.int64)
+    position = exploded["position"].to_numpy()
+    contig = (
+        exploded["contig"]
+        .replace_strict(reference.contig_index, return_dtype=polars.Int64)
+        .to_numpy()
+    )
+    ref_len = exploded["ref"].str.len_bytes().to_numpy().astype(np.int64)
+    alt_offsets, alt_data = _string_arrays(exploded["alt"])
+    alt_len = np.diff(alt_offsets)
+
+    n_haplotypes = len(variants)
+    offsets = np.zeros(n_haplotypes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row, minlength=n_haplotypes), out=offsets[1:])
+    first = offsets[:-1]
+    last = offsets[1:] - 1
+    hap_contig = contig[first]
+
+    # as in `get_haplo_sequence`: the full context spans context_size bases either side of the
+    # variants, and is truncated at contig boundaries. Haplotype index k in the full context is
+    # reference position (context_start + k), while variant offsets are computed relative to
+    # (min_pos - context_size), so truncation at the contig start shifts them the same way
+    index_translation = position[first] - context_size
+    context_start = np.maximum(index_translation, 1)
+    context_end = np.minimum(
+        position[last] + ref_len[last] + context_size - 1,
+        reference.lengths[hap_contig],
+    )
+    context_len = np.maximum(context_end - context_start + 1, 0)
+
+    # reference bases after each variant, up to the next variant or context_size for the last
+    is_last = np.zeros(len(row), dtype=bool)
+    is_last[last] = True
+    next_position = np.append(position[1:], 0)
+    after_start = position - index_translation[row] + ref_len
+    after_len = np.where(is_last, context_size, next_position - (position + ref_len))
+
+    def clamp(start, length, limit):
+        # python slice semantics of full_context[start : start + length]
+        start = np.minimum(start, limit)
+        return start, np.maximum(np.minimum(start + length, limit) - start, 0)
+
+    prefix_start, prefix_len = clamp(
+        np.zeros(n_haplotypes, dtype=np.int64), context_size, context_len
+    )
+    after_start, after_len = clamp(after_start, after_len, context_len[row])
+
+    # segments of each haplotype in order: reference prefix, then (alt, reference) per variant
+    variant_index = np.arange(len(row))
+    prefix_segment = 2 * first + np.arange(n_haplotypes)
+    alt_segment = 2 * variant_index + row + 1
+    segment_len = np.empty(n_haplotypes + 2 * len(row), dtype=np.int64)
+    segment_len[prefix_segment] = prefix_len
+    segment_len[alt_segment] = alt_len
+    segment_len[alt_segment + 1] = after_len
+    segment_start = np.cumsum(segment_len) - segment_len
+
+    out = np.empty(segment_len.sum(), dtype=np.uint8)
+    for segments, lengths, contigs, starts in [
+        (prefix_segment, prefix_len, hap_contig, context_start - 1 + prefix_start),
+        (
+            alt_segment + 1,
+            after_len,
+            hap_contig[row],
+            context_start[row] - 1 + after_start,
+        ),
+    ]:
+        out[_concat_ranges(segment_start[segments], lengths)] = reference.gather(
+            np.repeat(contigs, lengths), _concat_ranges(starts, lengths)
+        )
+    out[_concat_ranges(segment_start[alt_segment], alt_len)] = alt_data[
+        _concat_ranges(alt_offsets[:-1], alt_len)
+    ]
+
+    text = out.tobytes().decode()
+    hap_len = prefix_len + np.bincount(
+        row, weights=alt_len + after_len, minlength=n_haplotypes
+    ).astype(np.int64)
+    ends = np.cumsum(hap_len)
+    return [text[a:b] for a, b in zip((ends - hap_len).tolist(), ends.tolist())]
+
+
+def haplotype_sequences(
+    reference: ReferenceFasta,
+    variants: polars.Series,
+    context_size: int,
+    batch_size: int = 100_000,
+) -> polars.Series:
+    """
+    Local equivalent of `get_haplo_sequence` in `create_fasta_and_index.py`: the DivRef
+    sequence of each comma-separated `variants` string, spliced from `reference` with
+    `context_size` bases of context. Processed `batch_size` haplotypes at a time.
+    """
+    sequences = []
+    for start in range(0, len(variants), batch_size):
+        sequences.extend(
+            _haplotype_sequences_batch(
+                reference, variants.slice(start, batch_size), context_size
+            )
+        )
+    return polars.Series("sequence", sequences, dtype=polars.String)
+
+
+def write_fasta(
+    records: polars.DataFrame,
+    path: str,
+    write_dict: bool = False,
+    chunk_size: int = 200_000,
+):
+    """
+    Write `records` (`sequence_id` and `sequence` columns) as a FASTA file with one line per
+    sequence, and its samtools `.fai` index, `chunk_size` records at a time. With `write_dict`,
+    also write the `.dict` that `samtools dict -u NA` would.
+    """
+    position = 0
+    with (
+        open(path, "wb") as fasta,
+        open(path + ".fai", "wb") as fai,
+        open(path + ".dict", "wb") if write_dict else nullcontext() as dict_file,
+    ):
+        if write_dict:
+            dict_file.write(b"@HD\tVN:1.0\tSO:unsorted\n")
+        for chunk in records.select("sequence_id", "sequence").iter_slices(chunk_size):
+            id_len = chunk["sequence_id"].str.len_bytes().cast(polars.Int64)
+            seq_len = chunk["sequence"].str.len_bytes().cast(polars.Int64)
+            # '>' id '\n' sequence '\n'
+            record_len = id_len + seq_len + 3
+            record_start = position + record_len.cum_sum() - record_len
+            fasta.write(
+                chunk.select(
+                    polars.concat_str(
+                        polars.lit(">"),
+                        "sequence_id",
+                        polars.lit("\n"),
+                        "sequence",
+                        polars.lit("\n"),
+                    ).str.join("")
+                )
+                .item()
+                .encode()
+            )
+            fai.write(
+                polars.DataFrame(
+                    {
+                        "name": chunk["sequence_id"],
+                        "length": seq_len,
+                        "offset": record_start + id_len + 2,
+                        "linebases": seq_len,
+                        "linewidth": seq_len + 1,
+                    }
+                )
+                .write_csv(separator="\t", include_header=False)
+                .encode()
+            )
+            if write_dict:
+                # samtools computes M5 over the upper-cased sequence
+                md5 = [
+                    hashlib.md5(sequence.upper().encode()).hexdigest()
+                    for sequence in chunk["sequence"].to_list()
+                ]
+                dict_file.write(
+                    chunk.select(
+                        polars.concat_str(
+                            polars.lit("@SQ\tSN:"),
+                            "sequence_id",
+                            polars.lit("\tLN:"),
+                            seq_len.cast(polars.String),
+                            polars.lit("\tM5:"),
+                            polars.Series(md5),
+                            polars.lit("\tUR:NA\n"),
+                        ).str.join("")
+                    )
+                    .item()
+                    .encode()
+                )
+            position += int(record_len.sum())
+
+
+def with_fasta_records(df: polars.DataFrame) -> polars.DataFrame:
+    """
+    Add `fasta_record`, the `sequence_id` of the FASTA record each sequence is written as: the
+    first sequence in `df` on the same contig with the same bases. Staggered windows and the
+    gnomAD merge can give distinct sequences the same bases, which only need aligning once.
+    """
+    contig = polars.col("variants").str.split(":").list.get(0)
+    return df.with_columns(
+        fasta_record=polars.col("sequence_id").first().over(contig, "sequence")
+    )
+
+
+def fasta_rows(df: polars.DataFrame) -> polars.DataFrame:
+    # the rows of `df` that are written to the FASTA, one per `fasta_record` if it has them
+    if "fasta_record" not in df.columns:
+        return df
+    return df.filter(polars.col("sequence_id") == polars.col("fasta_record"))
+
+
+def _write_contig_fasta(records_path: str, contig: str, path: str, write_dict: bool):
+    records = (
+        polars.scan_parquet(records_path)
+        .filter(polars.col("contig") == contig)
+        .select("sequence_id", "sequence")
+        .collect()
+    )
+    write_fasta(records, path, write_dict)
+
+
+def write_contig_fastas(
+    records_path: str, paths: dict[str, str], workers: int, write_dict: bool = False
+):
+    """
+    Write one FASTA (with its `.fai` and optionally `.dict`, see `write_fasta`) per contig, in
+    parallel processes. `records_path` is a
+    Parquet file with `contig`, `sequence_id` and `sequence` columns, and `paths` maps each
+    contig to its FASTA path.
+    """
+    # spawn rather than fork: forking a process with polars' thread pool running is unsafe
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        futures = [
+            executor.submit(_write_contig_fasta, records_path, contig, path, write_dict)
+            for contig, path in paths.items()
+        ]
+        for future in futures:
+            future.result()
+
+
+def content_hash(df: polars.DataFrame, *parameters) -> str:
+    """
+    SHA-256 of the JSON-serialized `parameters` and the CSV serialization of `df`.
+    """
+    digest = hashlib.sha256(json.dumps(parameters).encode())
+    for chunk in df.iter_slices(500_000):
+        digest.update(chunk.write_csv().encode())
+    return digest.hexdigest()
+
+
+def write_tsv(df: polars.DataFrame, path: str, header: bool = True):
+    # bgzipped; BGZF files can be concatenated, so headerless partitions can be joined with `cat`
+    out = BgzfWriter(path)
+    if header:
+        out.write(df.head(0).write_csv(separator="\t").encode())
+    for chunk in df.iter_slices(500_000):
+        out.write(chunk.write_csv(separator="\t", include_header=False).encode())
+    out.close()
+
+
+def _with_sequences(df: polars.DataFrame, sequence: polars.Series) -> polars.DataFrame:
+    # `sequence` and `sequence_length` first, as in the non-incremental outputs
+    return df.select(
+        sequence, sequence.str.len_chars().alias("sequence_length"), polars.all()
+    )
+
+
+def build_contig_partitions(
+    df: polars.DataFrame,
+    output_prefix: str,
+    reference: ReferenceFasta,
+    window_size: int,
+    workers: int,
+    write_dict: bool,
+    export_tsv: bool,
+    dedup_sequences: bool = False,
+) -> polars.DataFrame:
+    """
+    Incrementally build sequences, per-contig FASTAs and (with `export_tsv`) the TSV export
+    from `df`, the sequences table without `sequence` and `sequence_length`.
+
+    Each contig's outputs are `{output_prefix}.{contig}.fasta` (with its `.fai` and, with
+    `write_dict`, `.dict`), and a Parquet and headerless TSV partition in
+    `{output_prefix}.partitions/`. `{output_prefix}.manifest.json` records a hash of each
+    contig's inputs: its rows of `df` other than `sequence_id`, the reference contig,
+    `window_size` and `dedup_sequences`. Contigs whose inputs hash the same as in the previous
+    build are read back from their partition rather than rebuilt; if their sequence IDs changed
+    (as in a new release, whose IDs have a new version prefix), only the partition and the FASTA
+    are rewritten with the new IDs.
+
+    With `dedup_sequences`, sequences with the same bases share a FASTA record (see
+    `with_fasta_records`).
+
+    Returns the complete table, with sequences and a `contig` column (and with
+    `dedup_sequences`, `fasta_record`), grouped by contig.
+    """
+    manifest_path = output_prefix + ".manifest.json"
+    partitions_dir = output_prefix + ".partitions"
+    os.makedirs(partitions_dir, exist_ok=True)
+    previous = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)["contigs"]
+
+    def outputs(contig):
+        fasta_path = f"{output_prefix}.{contig}.fasta"
+        return {
+            "parquet": os.path.join(partitions_dir, f"{contig}.parquet"),
+            "tsv": os.path.join(partitions_dir, f"{contig}.tsv.bgz"),
+            "fasta": fasta_path,
+            "fai": fasta_path + ".fai",
+            **({"dict": fasta_path + ".dict"} if write_dict else {}),
+        }
+
+    df = df.with_columns(contig=polars.col("variants").str.split(":").list.get(0))
+    manifest = {}
+    parts = []
+    # contigs whose FASTA is rewritten: those rebuilt, and those whose sequence IDs changed
+    changed = []
+    for (contig,), part in df.partition_by(
+        "contig", as_dict=True, maintain_order=True
+    ).items():
+        # sequence IDs are left out, so a contig whose sequences are renumbered (as when
+        # another contig gains a sequence) keeps its spliced sequences
+        input_hash = content_hash(
+            part.drop("sequence_id"),
+            window_size,
+            dedup_sequences,
+            reference.contig_digest(contig),
+        )
+        paths = outputs(contig)
+        if previous.get(contig, {}).get("input_hash") == input_hash and all(
+            os.path.exists(path) for path in paths.values()
+        ):
+            cached = polars.read_parquet(paths["parquet"])
+            # the rows are in the same order, which the hash covers
+            if not cached["sequence_id"].equals(part["sequence_id"]):
+                cached = cached.with_columns(part["sequence_id"])
+                cached.write_parquet(paths["parquet"])
+                write_tsv(cached.drop("contig"), paths["tsv"], header=False)
+                changed.append(contig)
+            part = cached
+        else:
+            part = _with_sequences(
+                part, haplotype_sequences(reference, part["variants"], window_size)
+            )
+            part.write_parquet(paths["parquet"])
+            write_tsv(part.drop("contig"), paths["tsv"], header=False)
+            changed.append(contig)
+        manifest[contig] = {"input_hash": input_hash, "sequences": len(part)}
+        parts.append(part)
+
+    # contigs that are no longer present
+    for contig in previous.keys() - manifest.keys():
+        for path in outputs(contig).values():
+            if os.path.exists(path):
+                os.remove(path)
+
+    if parts:
+        df = polars.concat(parts)
+    else:
+        # no sequences left; the result and the TSV export still have every column
+        df = _with_sequences(df, polars.Series("sequence", [], dtype=polars.String))
+    tsv_header = df.drop("contig").head(0)
+    if dedup_sequences:
+        df = with_fasta_records(df)
+
+    if changed:
+        records_path = os.path.join(partitions_dir, "fasta_records.parquet")
+        fasta_rows(df).select("contig", "sequence_id", "sequence").filter(
+            polars.col("contig").is_in(changed)
+        ).write_parquet(records_path)
+        write_contig_fastas(
+            records_path,
+            {contig: outputs(contig)["fasta"] for contig in changed},
+            workers,
+            write_dict,
+        )
+        os.remove(records_path)
+
+    if export_tsv:
+        write_tsv(tsv_header, output_prefix + ".tsv.bgz")
+        with open(output_prefix + ".tsv.bgz", "ab") as out:
+            for contig in manifest:
+                with open(outputs(contig)["tsv"], "rb") as f:
+                    while block := f.read(1 << 24):
+                        out.write(block)
+
+    # written last, so an interrupted build is redone rather than partially reused
+    with open(manifest_path, "w") as f:
+        json.dump({"contigs": manifest}, f, indent=2)
+    return df
+
+
+def stable_sequence_ids(variants: polars.Series, window_size: int) -> polars.Series:
+    """
+    Content-derived sequence IDs, which stay the same across DivRef builds: a hash of the
+    window size and the variants, sorted by position.
+    """
+    canonical = (
+        _explode_variants(variants)
+        .sort(["_row", "position", "ref", "alt"])
+        .group_by("_row", maintain_order=True)
+        .agg(
+            polars.concat_str(
+                "contig", "position", "ref", "alt", separator=":"
+            ).str.join(",")
+        )
+        .get_column("contig")
+    )
+    return polars.Series(
+        "stable_id",
+        [
+            "DRS-" + hashlib.sha256(f"{window_size}|{key}".encode()).hexdigest()[:20]
+            for key in canonical.to_list()
+        ],
+        dtype=polars.String,
+    )
+
+
+def assign_sequence_ids(
+    df: polars.DataFrame,
+    sequence_id_prefix: str,
+    window_size: int,
+    previous: Optional[polars.DataFrame] = None,
+    previous_window_size: Optional[int] = None,
+) -> polars.DataFrame:
+    """
+    Add `sequence_id` and `stable_id` (see `stable_sequence_ids`) columns to the sequences
+    table, before `n_variants`, and sort it by contig (in GRCh38 order), first variant position
+    and stable ID.
+
+    Without a previous build, sequences are numbered densely in that order. Given one
+    (`sequence_idx` and `variants` columns, as from `read_previous_sequences`, and its window
+    size), the sequences it contains keep their `sequence_idx` and new ones are numbered after
+    its largest, so adding or removing a sequence doesn't renumber the others. The indices of
+    removed sequences are not reused.
+    """
+    df = df.with_columns(
+        stable_id=stable_sequence_ids(df["variants"], window_size),
+        _first=polars.col("variants").str.split(",").list.first().str.strip_chars(),
+    )
+    contig = polars.col("_first").str.split(":").list.get(0)
+    contigs = sorted(
+        df.select(contig.unique())["_first"].to_list(), key=contig_sort_key
+    )
+    df = df.sort(
+        contig.replace_strict(contigs, range(len(contigs))),
+        polars.col("_first").str.split(":").list.get(1).cast(polars.Int64),
+        "stable_id",
+    ).drop("_first")
+
+    if previous is None:
+        sequence_idx = polars.int_range(polars.len())
+    else:
+        previous = previous.select(
+            "sequence_idx",
+            stable_id=stable_sequence_ids(previous["variants"], previous_window_size),
+        ).unique("stable_id", keep="first")
+        df = df.join(previous, on="stable_id", how="left", maintain_order="left")
+        # a stable ID repeated within this build keeps the previous index only once
+        new = (
+            polars.col("sequence_idx").is_null()
+            | ~polars.col("stable_id").is_first_distinct()
+        )
+        first_new = 0 if previous.is_empty() else previous["sequence_idx"].max() + 1
+        sequence_idx = (
+            polars.when(new)
+            .then(first_new + new.cum_sum() - 1)
+            .otherwise(polars.col("sequence_idx"))
+        )
+    df = df.with_columns(
+        sequence_id=polars.lit(sequence_id_prefix) + sequence_idx.cast(polars.String)
+    )
+    columns = [
+        c for c in df.columns if c not in ("sequence_id", "stable_id", "sequence_idx")
+    ]
+    i = columns.index("n_variants")
+    return df.select(*columns[:i], "sequence_id", "stable_id", *columns[i:])
+
+
+def read_previous_sequences(index_path: str) -> tuple[polars.DataFrame, int, str]:
+    """
+    Reads the `sequence_idx` and `variants` of every sequence in a previous DuckDB index, with
+    its window size and sequence ID prefix. Works with indices from before `sequence_idx` was
+    stored.
+    """
+    con = duckdb.connect(index_path, read_only=True)
+    window_size = con.execute("SELECT * FROM window_size").fetchone()[0]
+    tables = {row[0] for row in con.execute("SHOW TABLES").fetchall()}
+    if "sequence_id_prefix" in tables:
+        prefix = con.execute("SELECT * FROM sequence_id_prefix").fetchone()[0]
+    else:
+        prefix = f"DR-{con.execute('SELECT * FROM VERSION').fetchone()[0]}-"
+    previous = polars.from_arrow(
+        con.execute("SELECT sequence_id, variants FROM sequences")
+        .fetch_record_batch()
+        .read_all()
+    )
+    con.close()
+    previous = previous.select(
+        sequence_idx=polars.col("sequence_id")
+        .str.strip_prefix(prefix)
+        .cast(polars.Int64),
+        variants="variants",
+    )
+    return previous, window_size, prefix
+
+
+def sequence_id_mapping(
+    previous: polars.DataFrame,
+    previous_window_size: int,
+    current: polars.DataFrame,
+) -> polars.DataFrame:
+    """
+    Maps the `sequence_idx` of each sequence in a previous build (with `sequence_idx` and
+    `variants` columns) to its `sequence_idx` in `current`, for sequences in both whose
+    `sequence_idx` differs. Where `current` was numbered from the previous build (see
+    `assign_sequence_ids`) most sequences keep theirs, so this is usually short.
+    """
+    previous = previous.select(
+        previous_sequence_idx="sequence_idx",
+        stable_id=stable_sequence_ids(previous["variants"], previous_window_size),
+    )
+    return (
+        previous.join(current.select("stable_id", "sequence_idx"), on="stable_id")
+        .select("previous_sequence_idx", "sequence_idx")
+        .filter(polars.col("previous_sequence_idx") != polars.col("sequence_idx"))
+        .sort("previous_sequence_idx")
+    )
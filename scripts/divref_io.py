@@ -0,0 +1,121 @@
+"""
+File formats shared by the build side (`divref_index.py`) and `remap_divref.py`: the memory-mapped
+array files and BGZF output. Depends only on NumPy and the standard library, so both sides can
+import it without pulling in the other's dependencies; it ships next to `remap_divref.py` in the
+bundle.
+"""
+
+import json
+import struct
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+# Layout of the binary files `remap_divref.py` memory-maps (the remap sidecar and the sequence
+# store):
+#
+#   magic (8 bytes) | header length (uint64 LE) | JSON header | arrays
+#
+# The header records the file's metadata and, for each array, its dtype, byte offset from the
+# start of the file and element count. Arrays are 8-byte aligned so they can be viewed in place
+# from a memory map.
+SIDECAR_MAGIC = b"DRREMAP\x01"
+SEQUENCE_STORE_MAGIC = b"DRSEQ2B\x01"
+
+
+def write_array_file(
+    path: str, magic: bytes, metadata: dict, arrays: dict[str, np.ndarray]
+):
+    def header_bytes(layout):
+        return json.dumps({**metadata, "arrays": layout}).encode()
+
+    def align(n):
+        return (n + 7) & ~7
+
+    # array offsets depend on the header size, which depends on the offsets; lay out
+    # twice, the second time with the header padded to the width of the first estimate
+    layout = {name: {"dtype": "", "offset": 0, "length": 0} for name in arrays}
+    header_size = len(header_bytes(layout)) + 32 * len(arrays)
+    position = align(len(magic) + 8 + header_size)
+    for name, array in arrays.items():
+        layout[name] = {
+            "dtype": array.dtype.str,
+            "offset": position,
+            "length": len(array),
+        }
+        position = align(position + array.nbytes)
+    header = header_bytes(layout)
+    if len(header) > header_size:
+        raise ValueError(
+            f"header of {path} is {len(header)} bytes, more than the {header_size} reserved"
+        )
+    header = header.ljust(header_size)
+
+    with open(path, "wb") as f:
+        f.write(magic)
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        for name, array in arrays.items():
+            f.write(b"\0" * (layout[name]["offset"] - f.tell()))
+            f.write(array.tobytes())
+
+
+def read_array_file(
+    path: Path, magic: bytes, description: str
+) -> tuple[dict, dict[str, np.ndarray]]:
+    """
+    Memory-maps a file written by `write_array_file`, returning its header and its arrays,
+    viewed in place.
+    """
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    if bytes(data[: len(magic)]) != magic:
+        raise ValueError(f"{path} is not a {description}")
+    header_start = len(magic) + 8
+    header_size = int.from_bytes(bytes(data[len(magic) : header_start]), "little")
+    header = json.loads(bytes(data[header_start : header_start + header_size]))
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        start = spec["offset"]
+        arrays[name] = data[start : start + spec["length"] * dtype.itemsize].view(dtype)
+    return header, arrays
+
+
+_BGZF_BLOCK_SIZE = 0xFF00
+_BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+class BgzfWriter:
+    """
+    Minimal BGZF (blocked gzip) writer, so outputs can be indexed and read with htslib tools.
+    """
+
+    def __init__(self, path: Path, compresslevel: int = 6):
+        self._file = open(path, "wb")
+        self._buffer = bytearray()
+        self._compresslevel = compresslevel
+
+    def write(self, data: bytes):
+        self._buffer += data
+        while len(self._buffer) >= _BGZF_BLOCK_SIZE:
+            self._write_block(bytes(self._buffer[:_BGZF_BLOCK_SIZE]))
+            del self._buffer[:_BGZF_BLOCK_SIZE]
+
+    def _write_block(self, data: bytes):
+        compressor = zlib.compressobj(self._compresslevel, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        # gzip header with the BGZF 'BC' extra subfield holding the total block size - 1
+        header = struct.pack(
+            "<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(compressed) + 25
+        )
+        self._file.write(header)
+        self._file.write(compressed)
+        self._file.write(struct.pack("<2I", zlib.crc32(data), len(data)))
+
+    def close(self):
+        if self._buffer:
+            self._write_block(bytes(self._buffer))
+            self._buffer.clear()
+        self._file.write(_BGZF_EOF)
+        self._file.close()
@@ -1,4 +1,6 @@
 #!/usr/bin/env python
+import json
+
 import hail as hl
 import typer
 
@@ -7,6 +9,9 @@ app = typer.Typer()
 GNOMAD_SITES_TABLE_PATH = 'gs://gcp-public-data--gnomad/release/3.1.2/ht/genomes/gnomad.genomes.v3.1.2.hgdp_1kg_subset_variant_annotations.ht'
 GNOMAD_HGDP_SAMPLE_DATA_PATH = 'gs://gcp-public-data--gnomad/release/3.1.2/ht/genomes/gnomad.genomes.v3.1.2.hgdp_1kg_subset_sample_meta.ht'
 HGDP_REPRESENTED_POPS = ['afr', 'amr', 'eas', 'sas', 'nfe']
+# written into the variant Parquet directory, as Parquet has no table globals; the leading
+# underscore keeps Spark from reading it as data
+POPS_LEGEND_FILE = '_pops.json'
 
 
 def to_hashable_items(d):
@@ -17,7 +22,8 @@ def to_hashable_items(d):
 def main(
         output_file_va: str = typer.Argument(..., help="Output table path for variant frequencies"),
         output_file_sa: str = typer.Argument(..., help="Output table path for sample metadata"),
-        freq_threshold: float = typer.Option(0.001, help="Frequency threshold for filtering variants")
+        freq_threshold: float = typer.Option(0.001, help="Frequency threshold for filtering variants"),
+        parquet: bool = typer.Option(False, help="Also export both tables as Parquet, for compute_haplotypes_local.py")
 ):
     """
     Process VCF files with gnomAD annotations and output filtered results.
@@ -54,6 +60,21 @@ def main(
     sa = sa.select(pop=sa.gnomad_population_inference.pop)
     sa.naive_coalesce(4).write(output_file_sa, overwrite=True)
 
+    if parquet:
+        va = hl.read_table(output_file_va).key_by()
+        va.select(
+            contig=va.locus.contig,
+            position=va.locus.position,
+            ref=va.alleles[0],
+            alt=va.alleles[1],
+            pop_freqs=va.pop_freqs,
+        ).to_spark().write.mode('overwrite').parquet(f'{output_file_va}.parquet')
+        # the populations of `pop_freqs`, in order, as the `pops` global of the Hail table
+        with hl.hadoop_open(f'{output_file_va}.parquet/{POPS_LEGEND_FILE}', 'w') as f:
+            json.dump(HGDP_REPRESENTED_POPS, f)
+        sa = hl.read_table(output_file_sa).key_by()
+        sa.select('s', 'pop').to_spark().write.mode('overwrite').parquet(f'{output_file_sa}.parquet')
+
 
 if __name__ == "__main__":
     app()
@@ -4,23 +4,40 @@
 #     "duckdb",
 #     "numpy",
 #     "pandas",
+#     "pyarrow",
 #     "pydantic",
 #     "tqdm",
 #     "typer",
 # ]
 # ///
+import abc
 import csv
 import json
+import multiprocessing
 import sys
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import NamedTuple, Optional
 
 import duckdb
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import typer
 from pydantic import BaseModel
 from tqdm import tqdm
 
+from divref_io import (
+    SEQUENCE_STORE_MAGIC,
+    SIDECAR_MAGIC,
+    BgzfWriter,
+    read_array_file,
+)
+
 app = typer.Typer(pretty_exceptions_enable=False)
 
 
@@ -63,11 +80,17 @@ class Haplotype(BaseModel):
     max_pop: str
     variants: str
     source: str
-    gnomAD_AF_afr: str
-    gnomAD_AF_amr: str
-    gnomAD_AF_eas: str
-    gnomAD_AF_nfe: str
-    gnomAD_AF_sas: str
+    # one frequency per variant: a list in current indices, comma-joined in older ones
+    gnomAD_AF_afr: list[Optional[float]] | str
+    gnomAD_AF_amr: list[Optional[float]] | str
+    gnomAD_AF_eas: list[Optional[float]] | str
+    gnomAD_AF_nfe: list[Optional[float]] | str
+    gnomAD_AF_sas: list[Optional[float]] | str
+    # precomputed by create_fasta_and_index.py, absent in older indices
+    variant_starts: Optional[list[int]] = None
+    variant_ends: Optional[list[int]] = None
+    variant_ref_starts: Optional[list[int]] = None
+    variant_ref_ends: Optional[list[int]] = None
 
     _variants: Optional[list[Variant]] = None
 
@@ -86,85 +109,35 @@ class Haplotype(BaseModel):
         return vs
 
     def contig(self):
-        variants = self.parsed_variants()
-        return variants[0].chromosome
+        return self.variants.split(":", 1)[0].strip()
+
+    def variant_intervals(
+        self, context_size: int
+    ) -> tuple[list[int], list[int], list[int], list[int]]:
+        """
+        Returns [start, end) intervals of each variant in haplotype sequence space, and the
+        [start, end) interval of its reference allele on the reference genome.
+        """
+        if self.variant_starts is not None:
+            return (
+                self.variant_starts,
+                self.variant_ends,
+                self.variant_ref_starts,
+                self.variant_ref_ends,
+            )
+        return parse_variant_intervals(self.variants, context_size)
 
     def reference_mapping(
         self, start: int, end: int, context_size: int
     ) -> ReferenceMapping:
         vs = self.parsed_variants()
 
-        # translate a locus position into an index in the string
-        # as examples:
-        #   2-6 for 1:500:AAA:T with context window 0 should be 502-503
-        #   2-6 for 1:500:AAA:T with context window 2 should be 500-501
-
-        # translate variants into [start, end) intervals in 0-indexed haplotype sequence space
-        variant_intervals = []
-
-        # update index_translation based on variant size as we go
-        index_translation = vs[0].position - context_size
-        for i, v in enumerate(vs):
-            v_start = v.position - index_translation
-            v_end = v_start + len(v.alternate)
-            index_translation += len(v.reference) - len(v.alternate)
-            variant_intervals.append((v_start, v_end))
-
-        first_variant_index = None
-        last_variant_index = None
-        for i, (v_start, v_end) in enumerate(variant_intervals):
-            if intervals_overlap(start, end, v_start, v_end):
-                if first_variant_index is None:
-                    first_variant_index = i
-                last_variant_index = i
-
-        def translate_coordinate_to_ref(coord: int, sign: int) -> int:
-            # Either the coordinate is contained within a variant interval, or it isn't
-            # if it is, (1) return the start of the variant if sign<0 or end of variant if sign>0
-            # if it isn't, (2) return add the distance from the previous variant interval end to that variant's position
-            # unless (3) the coordinate is before than the first variant, in which case we translate from the first variant's position
-
-            first_variant_start = variant_intervals[0][0]
-            if coord < first_variant_start:
-                # path (3)
-                return vs[0].position - (first_variant_start - coord)
-
-            last_smaller_variant = 0
-            for i, (v_start, v_end) in enumerate(variant_intervals):
-                # if contained in an interval, path (1)
-                if v_start <= coord < v_end:
-                    # if the coordinate is contained in a variant interval, return the start or end based on the sign
-                    if sign < 0:
-                        return vs[i].position
-                    else:
-                        return vs[i].position + len(vs[i].reference)
-
-                if v_start > coord:
-                    break
-
-                last_smaller_variant = i
-
-            # if we're here, we know that the coordinate is not contained in any variant interval
-            v = vs[last_smaller_variant]
-            v_end = v.position + len(v.reference)
-            return v_end + (coord - variant_intervals[last_smaller_variant][1])
-
-        reference_coord_start = translate_coordinate_to_ref(start, -1)
-        reference_coord_end = translate_coordinate_to_ref(end, 1)
-
-        def get_freqs(a):
-            def parse_one(x):
-                return 0 if x == "null" else float(x)
-
-            return [parse_one(v) for v in a.split(",")]
-
-        all_pop_freqs = {
-            "afr": get_freqs(self.gnomAD_AF_afr),
-            "amr": get_freqs(self.gnomAD_AF_amr),
-            "eas": get_freqs(self.gnomAD_AF_eas),
-            "nfe": get_freqs(self.gnomAD_AF_nfe),
-            "sas": get_freqs(self.gnomAD_AF_sas),
-        }
+        (
+            reference_coord_start,
+            reference_coord_end,
+            first_variant_index,
+            last_variant_index,
+        ) = map_to_reference(*self.variant_intervals(context_size), start, end)
 
         rm = ReferenceMapping(
             chromosome=self.contig(),
@@ -175,13 +148,336 @@ class Haplotype(BaseModel):
             else [],
             first_variant_index=first_variant_index,
             last_variant_index=last_variant_index,
-            population_frequencies=all_pop_freqs,
+            population_frequencies=self.population_frequencies(),
         )
 
         return rm
 
+    def population_frequencies(self) -> dict[str, list[float]]:
+        return parse_population_frequencies(
+            [getattr(self, f"gnomAD_AF_{pop}") for pop in POPS]
+        )
 
-def get_index_path(path: Optional[Path]):
+
+POPS = ["afr", "amr", "eas", "nfe", "sas"]
+
+
+def parse_population_frequencies(
+    freqs: list[list[Optional[float]] | str],
+) -> dict[str, list[float]]:
+    def get_freqs(a):
+        if not isinstance(a, str):
+            return [0.0 if x is None else x for x in a]
+
+        def parse_one(x):
+            return 0.0 if x == "null" else float(x)
+
+        return [parse_one(v) for v in a.split(",")]
+
+    return {pop: get_freqs(a) for pop, a in zip(POPS, freqs)}
+
+
+def population_AFs_from_strings(freq_strs: list[np.ndarray]) -> np.ndarray:
+    # the (variant, population) frequency matrix of comma-joined `gnomAD_AF_<pop>` columns,
+    # in `POPS` order, NaN for "null"
+    return np.column_stack(
+        [
+            np.array(
+                [
+                    np.nan if x == "null" else float(x)
+                    for freqs in column
+                    for x in freqs.split(",")
+                ],
+                dtype=np.float32,
+            )
+            for column in freq_strs
+        ]
+    ).reshape(-1, len(POPS))
+
+
+def population_frequencies_json(offsets: np.ndarray, afs: np.ndarray) -> np.ndarray:
+    """
+    The `population_frequencies_json` of each haplotype, from its rows `offsets[i]` to
+    `offsets[i + 1]` of `afs`, a (variant, population) matrix of frequencies in `POPS` order
+    that is NaN where gnomAD has none. Matches `parse_population_frequencies` of the
+    frequencies formatted to 5 decimal places.
+    """
+    # float32 holds 5 decimal places of a frequency exactly enough to round back to them
+    values = np.round(np.nan_to_num(afs.astype(np.float64), nan=0.0), 5)
+    reprs = [[repr(x) for x in values[:, j].tolist()] for j in range(len(POPS))]
+    return np.array(
+        [
+            "{"
+            + ",".join(f'"{pop}":[{",".join(r[a:b])}]' for pop, r in zip(POPS, reprs))
+            + "}"
+            for a, b in zip(offsets[:-1].tolist(), offsets[1:].tolist())
+        ],
+        dtype=object,
+    )
+
+
+def parse_variant_intervals(
+    variants: str, context_size: int
+) -> tuple[list[int], list[int], list[int], list[int]]:
+    # translate a locus position into an index in the string
+    # as examples:
+    #   2-6 for 1:500:AAA:T with context window 0 should be 502-503
+    #   2-6 for 1:500:AAA:T with context window 2 should be 500-501
+
+    # translate variants into [start, end) intervals in 0-indexed haplotype sequence space
+    hap_starts = []
+    hap_ends = []
+    ref_starts = []
+    ref_ends = []
+
+    # update index_translation based on variant size as we go
+    index_translation = None
+    for v_str in variants.split(","):
+        _, pos, ref, alt = v_str.strip().split(":")
+        position = int(pos)
+        if index_translation is None:
+            index_translation = position - context_size
+        v_start = position - index_translation
+        index_translation += len(ref) - len(alt)
+        hap_starts.append(v_start)
+        hap_ends.append(v_start + len(alt))
+        ref_starts.append(position)
+        ref_ends.append(position + len(ref))
+    return hap_starts, hap_ends, ref_starts, ref_ends
+
+
+def map_to_reference(
+    hap_starts: list[int],
+    hap_ends: list[int],
+    ref_starts: list[int],
+    ref_ends: list[int],
+    start: int,
+    end: int,
+) -> tuple[int, int, Optional[int], Optional[int]]:
+    """
+    Maps [start, end) in haplotype sequence space to the reference genome, given the variant
+    intervals from `parse_variant_intervals`. Returns the reference start and end, and the
+    indices of the first and last variants overlapping the interval (None if there are none).
+    """
+    first_variant_index = None
+    last_variant_index = None
+    for i, (v_start, v_end) in enumerate(zip(hap_starts, hap_ends)):
+        if intervals_overlap(start, end, v_start, v_end):
+            if first_variant_index is None:
+                first_variant_index = i
+            last_variant_index = i
+
+    def translate_coordinate_to_ref(coord: int, sign: int) -> int:
+        # Either the coordinate is contained within a variant interval, or it isn't
+        # if it is, (1) return the start of the variant if sign<0 or end of variant if sign>0
+        # if it isn't, (2) return add the distance from the previous variant interval end to that variant's position
+        # unless (3) the coordinate is before than the first variant, in which case we translate from the first variant's position
+
+        first_variant_start = hap_starts[0]
+        if coord < first_variant_start:
+            # path (3)
+            return ref_starts[0] - (first_variant_start - coord)
+
+        last_smaller_variant = 0
+        for i, (v_start, v_end) in enumerate(zip(hap_starts, hap_ends)):
+            # if contained in an interval, path (1)
+            if v_start <= coord < v_end:
+                # if the coordinate is contained in a variant interval, return the start or end based on the sign
+                if sign < 0:
+                    return ref_starts[i]
+                else:
+                    return ref_ends[i]
+
+            if v_start > coord:
+                break
+
+            last_smaller_variant = i
+
+        # if we're here, we know that the coordinate is not contained in any variant interval
+        return ref_ends[last_smaller_variant] + (coord - hap_ends[last_smaller_variant])
+
+    return (
+        translate_coordinate_to_ref(start, -1),
+        translate_coordinate_to_ref(end, 1),
+        first_variant_index,
+        last_variant_index,
+    )
+
+
+def gather_ranges(
+    offsets: np.ndarray, rows: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    For rows of a flat array laid out by `offsets` (row `r` at `offsets[r]:offsets[r + 1]`),
+    returns the offsets of `rows` concatenated in that order and their positions in the array.
+    """
+    first = offsets[rows]
+    lengths = offsets[rows + 1] - first
+    gathered = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=gathered[1:])
+    positions = np.repeat(first - gathered[:-1], lengths) + np.arange(gathered[-1])
+    return gathered, positions
+
+
+class VariantIntervals:
+    """
+    Variant intervals (see `parse_variant_intervals`) of many haplotypes, flattened into arrays.
+    The intervals of haplotype `h` are at `offsets[h]:offsets[h + 1]`.
+    """
+
+    __slots__ = ("offsets", "hap_starts", "hap_ends", "ref_starts", "ref_ends")
+
+    def __init__(self, offsets, hap_starts, hap_ends, ref_starts, ref_ends):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.hap_starts = np.asarray(hap_starts, dtype=np.int64)
+        self.hap_ends = np.asarray(hap_ends, dtype=np.int64)
+        self.ref_starts = np.asarray(ref_starts, dtype=np.int64)
+        self.ref_ends = np.asarray(ref_ends, dtype=np.int64)
+
+    @staticmethod
+    def from_lists(
+        intervals: list[tuple[list[int], list[int], list[int], list[int]]],
+    ) -> "VariantIntervals":
+        offsets = np.zeros(len(intervals) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(x[0]) for x in intervals])
+        return VariantIntervals(
+            offsets,
+            *(
+                [v for x in intervals for v in x[field]] if intervals else []
+                for field in range(4)
+            ),
+        )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def take(self, haps: np.ndarray) -> "VariantIntervals":
+        """
+        The intervals of haplotypes `haps`, in that order.
+        """
+        offsets, positions = gather_ranges(self.offsets, haps)
+        return VariantIntervals(
+            offsets,
+            self.hap_starts[positions],
+            self.hap_ends[positions],
+            self.ref_starts[positions],
+            self.ref_ends[positions],
+        )
+
+    @staticmethod
+    def concat(parts: list["VariantIntervals"]) -> "VariantIntervals":
+        ends = np.cumsum([0] + [p.offsets[-1] for p in parts[:-1]])
+        return VariantIntervals(
+            np.concatenate(
+                [parts[0].offsets[:1]]
+                + [p.offsets[1:] + end for p, end in zip(parts, ends)]
+            ),
+            *(
+                np.concatenate([getattr(p, name) for p in parts])
+                for name in ("hap_starts", "hap_ends", "ref_starts", "ref_ends")
+            ),
+        )
+
+    def intervals(self, h: int) -> tuple[list[int], list[int], list[int], list[int]]:
+        lo, hi = self.offsets[h], self.offsets[h + 1]
+        return (
+            self.hap_starts[lo:hi].tolist(),
+            self.hap_ends[lo:hi].tolist(),
+            self.ref_starts[lo:hi].tolist(),
+            self.ref_ends[lo:hi].tolist(),
+        )
+
+
+# haplotype-space coordinates are biased into the low 32 bits of an int64 key, with the
+# haplotype's batch position in the high bits, so a single sorted array covers a whole batch
+_COORD_BIAS = 1 << 31
+
+
+class BatchRemapping(NamedTuple):
+    start: np.ndarray
+    end: np.ndarray
+    first_variant_index: np.ndarray
+    last_variant_index: np.ndarray
+
+
+def remap_batch(
+    intervals: VariantIntervals,
+    hap_index: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+) -> BatchRemapping:
+    """
+    Vectorized equivalent of `map_to_reference` for a batch of hits.
+
+    `hap_index[i]` is the haplotype in `intervals` that hit `i` aligned to. Variant indices are
+    -1 where no variant overlaps the hit.
+    """
+    offsets = intervals.offsets
+    hap_starts = intervals.hap_starts
+    hap_ends = intervals.hap_ends
+    ref_starts = intervals.ref_starts
+    ref_ends = intervals.ref_ends
+
+    variant_hap = np.repeat(np.arange(len(intervals), dtype=np.int64), np.diff(offsets))
+
+    # the search below assumes disjoint, sorted intervals
+    overlapping = np.zeros(len(intervals), dtype=bool)
+    same_hap = variant_hap[1:] == variant_hap[:-1]
+    overlapping[variant_hap[1:][same_hap & (hap_starts[1:] < hap_ends[:-1])]] = True
+
+    key_starts = (variant_hap << 32) + hap_starts + _COORD_BIAS
+    key_ends = (variant_hap << 32) + hap_ends + _COORD_BIAS
+
+    hap_index = np.asarray(hap_index, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    hit_base = (hap_index << 32) + _COORD_BIAS
+    first_in_hap = offsets[hap_index]
+    past_hap = offsets[hap_index + 1]
+
+    def translate_coordinate_to_ref(coord, sign):
+        # index of the last variant starting at or before the coordinate
+        k = np.searchsorted(key_starts, hit_base + coord, side="right") - 1
+        before_first = k < first_in_hap
+        k = np.where(before_first, first_in_hap, k)
+        contained = ~before_first & (coord < hap_ends[k])
+        return np.select(
+            [before_first, contained],
+            [
+                ref_starts[k] - (hap_starts[k] - coord),
+                ref_starts[k] if sign < 0 else ref_ends[k],
+            ],
+            ref_ends[k] + (coord - hap_ends[k]),
+        )
+
+    first = np.searchsorted(key_ends, hit_base + starts, side="right")
+    last = np.searchsorted(key_starts, hit_base + ends, side="left") - 1
+    any_overlap = (first < past_hap) & (last >= first_in_hap) & (first <= last)
+    result = BatchRemapping(
+        start=translate_coordinate_to_ref(starts, -1),
+        end=translate_coordinate_to_ref(ends, 1),
+        first_variant_index=np.where(any_overlap, first - first_in_hap, -1),
+        last_variant_index=np.where(any_overlap, last - first_in_hap, -1),
+    )
+
+    # haplotypes with overlapping variants are rare, fall back to the scalar path for them
+    for i in np.flatnonzero(overlapping[hap_index]):
+        start, end, first_variant_index, last_variant_index = map_to_reference(
+            *intervals.intervals(hap_index[i]), int(starts[i]), int(ends[i])
+        )
+        result.start[i] = start
+        result.end[i] = end
+        result.first_variant_index[i] = (
+            -1 if first_variant_index is None else first_variant_index
+        )
+        result.last_variant_index[i] = (
+            -1 if last_variant_index is None else last_variant_index
+        )
+
+    return result
+
+
+def find_index_path(path: Optional[Path]) -> Path:
     # if None, look in the same directory as this file
     if path is None:
         import os
@@ -199,141 +495,1239 @@ def get_index_path(path: Optional[Path]):
             fg=typer.colors.YELLOW,
         )
         sys.exit(1)
-    conn = duckdb.connect(path)
+    return path
+
+
+def get_index_path(path: Optional[Path]):
+    # remapping only reads the index, which lets several processes share it
+    conn = duckdb.connect(str(find_index_path(path)), read_only=True)
     return conn
 
 
+def _fetch_arrow(cursor) -> pa.Table:
+    # newer DuckDB versions return a RecordBatchReader from `arrow()`
+    result = cursor.arrow()
+    if isinstance(result, pa.RecordBatchReader):
+        result = result.read_all()
+    return result
+
+
+class HaplotypeColumns:
+    """
+    The `sequences` rows needed for remapping, as one array per column. Used instead of
+    `Haplotype` in the remap loop so no per-row objects are created.
+
+    `population_AFs` is a (variant, population) matrix of frequencies in `POPS` order, NaN
+    where gnomAD has none, whose rows line up with the variants of `intervals`.
+    """
+
+    __slots__ = (
+        "sequence_id",
+        "contig",
+        "variants",
+        "popmax_empirical_AF",
+        "popmax_empirical_AC",
+        "max_pop",
+        "source",
+        "intervals",
+        "population_AFs",
+    )
+
+    def __init__(
+        self,
+        sequence_id: np.ndarray,
+        contig: np.ndarray,
+        variants: np.ndarray,
+        popmax_empirical_AF: np.ndarray,
+        popmax_empirical_AC: np.ndarray,
+        max_pop: np.ndarray,
+        source: np.ndarray,
+        intervals: VariantIntervals,
+        population_AFs: np.ndarray,
+    ):
+        self.sequence_id = sequence_id
+        self.contig = contig
+        self.variants = variants
+        self.popmax_empirical_AF = popmax_empirical_AF
+        self.popmax_empirical_AC = popmax_empirical_AC
+        self.max_pop = max_pop
+        self.source = source
+        self.intervals = intervals
+        self.population_AFs = population_AFs
+
+    @staticmethod
+    def from_arrow(table: pa.Table, context_size: int) -> "HaplotypeColumns":
+        def column(name):
+            return table.column(name).to_numpy(zero_copy_only=False)
+
+        variants = column("variants")
+        if pa.types.is_list(table.schema.field("gnomAD_AF_afr").type):
+            population_AFs = np.column_stack(
+                [
+                    pc.list_flatten(table.column(f"gnomAD_AF_{pop}")).to_numpy(
+                        zero_copy_only=False
+                    )
+                    for pop in POPS
+                ]
+            ).reshape(-1, len(POPS))
+        else:
+            # older indices store frequencies as comma-joined strings
+            population_AFs = population_AFs_from_strings(
+                [column(f"gnomAD_AF_{pop}") for pop in POPS]
+            )
+        if "variant_starts" in table.column_names:
+            lengths = pc.list_value_length(table.column("variant_starts")).to_numpy()
+            offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            intervals = VariantIntervals(
+                offsets,
+                *(
+                    pc.list_flatten(table.column(name)).to_numpy()
+                    for name in INTERVAL_COLUMNS
+                ),
+            )
+        else:
+            intervals = VariantIntervals.from_lists(
+                [parse_variant_intervals(v, context_size) for v in variants]
+            )
+        return HaplotypeColumns.from_fields(
+            sequence_id=column("sequence_id"),
+            variants=variants,
+            popmax_empirical_AF=column("popmax_empirical_AF"),
+            popmax_empirical_AC=column("popmax_empirical_AC"),
+            max_pop=column("max_pop"),
+            source=column("source"),
+            intervals=intervals,
+            population_AFs=population_AFs,
+        )
+
+    @staticmethod
+    def from_fields(
+        sequence_id: np.ndarray,
+        variants: np.ndarray,
+        popmax_empirical_AF: np.ndarray,
+        popmax_empirical_AC: np.ndarray,
+        max_pop: np.ndarray,
+        source: np.ndarray,
+        intervals: VariantIntervals,
+        population_AFs: np.ndarray,
+    ) -> "HaplotypeColumns":
+        """
+        Builds the derived columns from the index fields.
+        """
+        return HaplotypeColumns(
+            sequence_id=sequence_id,
+            contig=np.array(
+                [v.split(":", 1)[0].strip() for v in variants], dtype=object
+            ),
+            variants=variants,
+            popmax_empirical_AF=popmax_empirical_AF,
+            popmax_empirical_AC=popmax_empirical_AC,
+            max_pop=max_pop,
+            source=source,
+            intervals=intervals,
+            population_AFs=population_AFs,
+        )
+
+    def __len__(self):
+        return len(self.sequence_id)
+
+    def take(self, rows: np.ndarray) -> "HaplotypeColumns":
+        """
+        The haplotypes at `rows`, in that order.
+        """
+        _, positions = gather_ranges(self.intervals.offsets, rows)
+        return HaplotypeColumns(
+            *(getattr(self, name)[rows] for name in self.__slots__[:-2]),
+            intervals=self.intervals.take(rows),
+            population_AFs=self.population_AFs[positions],
+        )
+
+    @staticmethod
+    def concat(parts: list["HaplotypeColumns"]) -> "HaplotypeColumns":
+        return HaplotypeColumns(
+            *(
+                np.concatenate([getattr(p, name) for p in parts])
+                for name in HaplotypeColumns.__slots__[:-2]
+            ),
+            intervals=VariantIntervals.concat([p.intervals for p in parts]),
+            population_AFs=np.concatenate([p.population_AFs for p in parts]),
+        )
+
+
+class SequenceCache:
+    """
+    Index rows kept across batches, as one `HaplotypeColumns` so a batch gathers its cached
+    rows with array indexing rather than rebuilding them. Holds about `max_size` sequences:
+    when it would grow past that, the sequences least recently fetched are evicted, though
+    never those of the current batch.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.columns: Optional[HaplotypeColumns] = None
+        self.rows: dict[str, int] = {}
+        # the batch each cached row was last fetched in
+        self.last_used = np.zeros(0, dtype=np.int64)
+        self.batch = 0
+
+    def fetch(self, sequence_ids: np.ndarray, query) -> HaplotypeColumns:
+        """
+        The rows for the distinct `sequence_ids`, with those not cached read by `query`.
+        """
+        self.batch += 1
+        rows = np.array(
+            [self.rows.get(sequence_id, -1) for sequence_id in sequence_ids.tolist()],
+            dtype=np.int64,
+        )
+        missing = rows < 0
+        self.hits += int(len(rows) - missing.sum())
+        self.misses += int(missing.sum())
+        self.last_used[rows[~missing]] = self.batch
+        if missing.any():
+            self._add(sequence_ids[missing], query(sequence_ids[missing]))
+            rows = np.array(
+                [self.rows[sequence_id] for sequence_id in sequence_ids.tolist()],
+                dtype=np.int64,
+            )
+        return self.columns.take(rows)
+
+    def _add(self, sequence_ids: np.ndarray, columns: HaplotypeColumns):
+        if self.columns is not None:
+            excess = len(self.columns) + len(columns) - self.max_size
+            if excess > 0:
+                self._evict(excess)
+        start = len(self.rows)
+        self.rows.update(
+            (sequence_id, start + i)
+            for i, sequence_id in enumerate(sequence_ids.tolist())
+        )
+        self.columns = (
+            columns
+            if self.columns is None
+            else HaplotypeColumns.concat([self.columns, columns])
+        )
+        self.last_used = np.concatenate(
+            [self.last_used, np.full(len(columns), self.batch, dtype=np.int64)]
+        )
+
+    def _evict(self, n: int):
+        in_batch = int((self.last_used == self.batch).sum())
+        n_keep = max(len(self.columns) - n, in_batch)
+        keep = np.sort(np.argsort(-self.last_used, kind="stable")[:n_keep])
+        self.columns = self.columns.take(keep)
+        self.last_used = self.last_used[keep]
+        self.rows = {
+            sequence_id: i
+            for i, sequence_id in enumerate(self.columns.sequence_id.tolist())
+        }
+
+
+class MissingSequencesError(Exception):
+    def __init__(self, sequence_ids: set[str]):
+        super().__init__(f"sequences not found in index: {sorted(sequence_ids)}")
+        self.sequence_ids = sequence_ids
+
+
+REMAP_COLUMNS = [
+    "sequence_id",
+    "variants",
+    "popmax_empirical_AF",
+    "popmax_empirical_AC",
+    "max_pop",
+    "source",
+    *(f"gnomAD_AF_{pop}" for pop in POPS),
+]
+INTERVAL_COLUMNS = [
+    "variant_starts",
+    "variant_ends",
+    "variant_ref_starts",
+    "variant_ref_ends",
+]
+
+
+def sequence_keys(sequence_ids: np.ndarray, prefix: str) -> np.ndarray:
+    """
+    Returns the integer `sequence_idx` of each of `sequence_ids`, or -1 for IDs that aren't
+    `prefix` followed by an index.
+    """
+    keys = np.full(len(sequence_ids), -1, dtype=np.int64)
+    for i, sequence_id in enumerate(sequence_ids):
+        suffix = sequence_id[len(prefix) :]
+        if (
+            sequence_id.startswith(prefix)
+            and suffix.isdigit()
+            and str(int(suffix)) == suffix
+        ):
+            keys[i] = int(suffix)
+    return keys
+
+
+class ContigSpans(NamedTuple):
+    """
+    The GRCh38 spans of the sequences on one contig (0-based, half-open), sorted by start.
+    """
+
+    starts: np.ndarray
+    ends: np.ndarray
+    sequence_idx: np.ndarray
+    max_length: int
+
+
+def overlapping_spans(
+    spans: ContigSpans, starts: np.ndarray, ends: np.ndarray, covering: bool = False
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the spans overlapping each of the regions [starts, ends), or with `covering`, the
+    spans containing them. Returns pairs of (region index, span index), ordered by region and
+    then span start.
+    """
+    # no span is longer than max_length, so only spans starting within max_length of a
+    # region's start can reach it
+    lo = np.searchsorted(spans.starts, starts - spans.max_length, side="right")
+    if covering:
+        hi = np.searchsorted(spans.starts, starts, side="right")
+    else:
+        hi = np.searchsorted(spans.starts, ends, side="left")
+    counts = np.maximum(hi - lo, 0)
+    region = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    span = lo[region] + np.arange(offsets[-1]) - offsets[region]
+    if covering:
+        keep = spans.ends[span] >= ends[region]
+    else:
+        keep = spans.ends[span] > starts[region]
+    return region[keep], span[keep]
+
+
+class SequenceIndex(abc.ABC):
+    """
+    Base class for index readers; subclasses set `cache`, `version` and `window_size`, and
+    implement `_query` and `contig_spans`.
+    """
+
+    cache: Optional[SequenceCache]
+    sequence_id_prefix: Optional[str]
+    # (fasta_record_idx, sequence_idx) of the sequences written as another sequence's FASTA
+    # record, sorted; None for indices built without --dedup-sequences
+    shared_records: Optional[tuple[np.ndarray, np.ndarray]] = None
+
+    def record_sequences(self, record_ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Expands FASTA record IDs into the IDs of every sequence written as each record. Returns
+        the sequence IDs, grouped by record with the record's own ID first, and the index into
+        `record_ids` of each one's record. IDs that aren't in the index expand to themselves.
+        """
+        if self.shared_records is None:
+            return record_ids, np.arange(len(record_ids))
+        records, sequences = self.shared_records
+        keys = sequence_keys(record_ids, self.sequence_id_prefix)
+        first = np.searchsorted(records, keys, side="left")
+        counts = np.searchsorted(records, keys, side="right") - first + 1
+        record_index = np.repeat(np.arange(len(record_ids)), counts)
+        offsets = np.zeros(len(record_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        within = np.arange(len(record_index)) - offsets[record_index]
+        shared = within > 0
+        ids = record_ids[record_index]
+        ids[shared] = [
+            f"{self.sequence_id_prefix}{k}"
+            for k in sequences[
+                first[record_index[shared]] + within[shared] - 1
+            ].tolist()
+        ]
+        return ids, record_index
+
+    def fetch(self, sequence_ids: np.ndarray) -> HaplotypeColumns:
+        """
+        Returns the rows for `sequence_ids`, in the same order. Raises `MissingSequencesError`
+        if any are not in the index.
+        """
+        if self.cache is None:
+            return self._query(sequence_ids)
+        return self.cache.fetch(sequence_ids, self._query)
+
+    @abc.abstractmethod
+    def _query(self, sequence_ids: np.ndarray) -> HaplotypeColumns:
+        """
+        Reads the rows for `sequence_ids` from the index, bypassing the cache.
+        """
+
+    @abc.abstractmethod
+    def contig_spans(self, contig: str) -> Optional[ContigSpans]:
+        """
+        The spans of the sequences on `contig`, or None if it has none.
+        """
+
+
+class DivRefIndex(SequenceIndex):
+    """
+    Read access to the DuckDB index for remapping.
+    """
+
+    def __init__(self, conn: duckdb.DuckDBPyConnection, cache_size: int = 0):
+        self.conn = conn
+        # hits cluster on a small fraction of sequences, so rows are kept across batches
+        self.cache = SequenceCache(cache_size) if cache_size > 0 else None
+        self.version = conn.execute("SELECT * FROM VERSION").fetchone()[0]
+        self.window_size: int = conn.execute("SELECT * FROM window_size").fetchone()[0]
+        columns = {
+            row[0]
+            for row in conn.execute(
+                "SELECT column_name FROM information_schema.columns WHERE table_name = 'sequences'"
+            ).fetchall()
+        }
+        # only fetch what remapping needs; older indices lack the precomputed intervals
+        self.columns = REMAP_COLUMNS + [c for c in INTERVAL_COLUMNS if c in columns]
+        # newer indices key sequences by the integer suffix of their ID
+        self.sequence_id_prefix = None
+        self.has_spans = False
+        self.spans: dict[str, Optional[ContigSpans]] = {}
+        if "sequence_idx" in columns:
+            self.sequence_id_prefix = conn.execute(
+                "SELECT * FROM sequence_id_prefix"
+            ).fetchone()[0]
+            self.columns.append("sequence_idx")
+            tables = {
+                row[0]
+                for row in conn.execute(
+                    "SELECT table_name FROM information_schema.tables"
+                ).fetchall()
+            }
+            self.has_spans = "sequence_spans" in tables
+            if "fasta_records" in tables:
+                shared = conn.execute(
+                    "SELECT fasta_record_idx, sequence_idx FROM fasta_records ORDER BY ALL"
+                ).fetchnumpy()
+                self.shared_records = (
+                    np.asarray(shared["fasta_record_idx"], dtype=np.int64),
+                    np.asarray(shared["sequence_idx"], dtype=np.int64),
+                )
+
+    def _query(self, sequence_ids: np.ndarray) -> HaplotypeColumns:
+        if self.sequence_id_prefix is not None:
+            key_column = "sequence_idx"
+            keys = sequence_keys(sequence_ids, self.sequence_id_prefix)
+            query_keys = keys[keys >= 0].tolist()
+            key_type = "BIGINT"
+        else:
+            key_column = "sequence_id"
+            keys = sequence_ids
+            query_keys = sequence_ids.tolist()
+            key_type = "STRING"
+        table = _fetch_arrow(
+            self.conn.execute(
+                f"""
+                SELECT {", ".join(self.columns)} FROM sequences 
+                WHERE sequences.{key_column} IN (SELECT unnest($1::{key_type}[]))
+                """,
+                [query_keys],
+            )
+        )
+        found = table.column(key_column).to_numpy(zero_copy_only=False)
+        order = np.argsort(found)
+        found = found[order]
+        position = np.searchsorted(found, keys)
+        matches = position < len(found)
+        matches[matches] = found[position[matches]] == keys[matches]
+        if not matches.all():
+            raise MissingSequencesError(set(sequence_ids[~matches].tolist()))
+        return HaplotypeColumns.from_arrow(
+            table.take(order[position]), self.window_size
+        )
+
+    def contig_spans(self, contig: str) -> Optional[ContigSpans]:
+        if not self.has_spans:
+            raise ValueError(
+                "this index has no sequence spans; rebuild it with create_fasta_and_index.py"
+            )
+        if contig not in self.spans:
+            spans = self.conn.execute(
+                """
+                SELECT span_start, span_end, sequence_idx FROM sequence_spans
+                WHERE contig = $1 ORDER BY span_start, sequence_idx
+                """,
+                [contig],
+            ).fetchnumpy()
+            starts = np.asarray(spans["span_start"], dtype=np.int64)
+            ends = np.asarray(spans["span_end"], dtype=np.int64)
+            self.spans[contig] = (
+                ContigSpans(
+                    starts,
+                    ends,
+                    np.asarray(spans["sequence_idx"], dtype=np.int64),
+                    int((ends - starts).max()),
+                )
+                if len(starts)
+                else None
+            )
+        return self.spans[contig]
+
+
+SIDECAR_SUFFIX = ".bin"
+
+
+class SidecarIndex(SequenceIndex):
+    """
+    Read access to the binary remap sidecar written by `create_fasta_and_index.py
+    --remap-sidecar`, as an alternative to the DuckDB index. The file is memory-mapped and
+    read in place, so opening it is instant and its pages are shared between processes.
+    """
+
+    def __init__(self, path: Path, cache_size: int = 0):
+        header, self.arrays = read_array_file(
+            path, SIDECAR_MAGIC, "DivRef remap sidecar"
+        )
+        self.cache = SequenceCache(cache_size) if cache_size > 0 else None
+        self.version = header["version"]
+        self.window_size: int = header["window_size"]
+        self.sequence_id_prefix: str = header["sequence_id_prefix"]
+        self.n_sequences: int = header["n_sequences"]
+        self.max_pop_values = np.array(header["max_pop_values"], dtype=object)
+        self.source_values = np.array(header["source_values"], dtype=object)
+        self.span_contigs: Optional[dict[str, list[int]]] = header.get("span_contigs")
+        # columns of the population_AFs matrix to read, in `POPS` order
+        self.af_columns = None
+        if "population_AFs" in self.arrays:
+            af_pops = header["af_pops"]
+            self.af_columns = np.array([af_pops.index(pop) for pop in POPS])
+            self.arrays["population_AFs"] = self.arrays["population_AFs"].reshape(
+                -1, len(af_pops)
+            )
+        if "shared_fasta_record_idx" in self.arrays:
+            self.shared_records = (
+                self.arrays["shared_fasta_record_idx"],
+                self.arrays["shared_sequence_idx"],
+            )
+
+    def _strings(self, name: str, keys: np.ndarray) -> np.ndarray:
+        offsets = self.arrays[f"{name}_offsets"]
+        data = self.arrays[f"{name}_data"]
+        return np.array(
+            [
+                data[offsets[k] : offsets[k + 1]].tobytes().decode()
+                for k in keys.tolist()
+            ],
+            dtype=object,
+        )
+
+    def _query(self, sequence_ids: np.ndarray) -> HaplotypeColumns:
+        keys = sequence_keys(sequence_ids, self.sequence_id_prefix)
+        found = (keys >= 0) & (keys < self.n_sequences)
+        # older sidecars number sequences densely, without `present`
+        if "present" in self.arrays:
+            found[found] = self.arrays["present"][keys[found]].astype(bool)
+        if not found.all():
+            raise MissingSequencesError(set(sequence_ids[~found].tolist()))
+
+        # gather each sequence's slice of the flat interval arrays
+        offsets, positions = gather_ranges(self.arrays["variant_offsets"], keys)
+        intervals = VariantIntervals(
+            offsets, *(self.arrays[name][positions] for name in INTERVAL_COLUMNS)
+        )
+        if self.af_columns is not None:
+            population_AFs = self.arrays["population_AFs"][positions][
+                :, self.af_columns
+            ]
+        else:
+            # older sidecars store frequencies as comma-joined strings
+            population_AFs = population_AFs_from_strings(
+                [self._strings(f"gnomAD_AF_{pop}", keys) for pop in POPS]
+            )
+
+        return HaplotypeColumns.from_fields(
+            sequence_id=np.asarray(sequence_ids, dtype=object),
+            variants=self._strings("variants", keys),
+            popmax_empirical_AF=self.arrays["popmax_empirical_AF"][keys],
+            popmax_empirical_AC=self.arrays["popmax_empirical_AC"][keys],
+            max_pop=self.max_pop_values[self.arrays["max_pop"][keys]],
+            source=self.source_values[self.arrays["source"][keys]],
+            intervals=intervals,
+            population_AFs=population_AFs,
+        )
+
+    def contig_spans(self, contig: str) -> Optional[ContigSpans]:
+        if self.span_contigs is None:
+            raise ValueError(
+                "this sidecar has no sequence spans; rebuild it with create_fasta_and_index.py"
+            )
+        if contig not in self.span_contigs:
+            return None
+        first, last, max_length = self.span_contigs[contig]
+        return ContigSpans(
+            self.arrays["span_starts"][first:last],
+            self.arrays["span_ends"][first:last],
+            self.arrays["span_sequence_idx"][first:last],
+            max_length,
+        )
+
+
+class SequenceStore:
+    """
+    Random access to the 2-bit packed sequence store written by `create_fasta_and_index.py
+    --sequence-store`. Like the remap sidecar, the file is memory-mapped and read in place, so
+    fetching a slice of a sequence only touches the bytes that hold it.
+    """
+
+    BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+    SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+
+    def __init__(self, path: Path):
+        header, self.arrays = read_array_file(
+            path, SEQUENCE_STORE_MAGIC, "DivRef sequence store"
+        )
+        self.sequence_id_prefix: str = header["sequence_id_prefix"]
+        self.n_sequences: int = header["n_sequences"]
+
+    def _bounds(self, sequence_id: str) -> tuple[int, int]:
+        # [first, last) of the sequence's bases in the concatenation
+        key = int(
+            sequence_keys(
+                np.array([sequence_id], dtype=object), self.sequence_id_prefix
+            )[0]
+        )
+        if not 0 <= key < self.n_sequences or (
+            "present" in self.arrays and not self.arrays["present"][key]
+        ):
+            raise MissingSequencesError({sequence_id})
+        offsets = self.arrays["offsets"]
+        return int(offsets[key]), int(offsets[key + 1])
+
+    def length(self, sequence_id: str) -> int:
+        first, last = self._bounds(sequence_id)
+        return last - first
+
+    def fetch(self, sequence_id: str, start: int = 0, end: Optional[int] = None) -> str:
+        """
+        Bases [start, end) of a sequence, with Python slice semantics.
+        """
+        first, last = self._bounds(sequence_id)
+        start, end, _ = slice(start, end).indices(last - first)
+        if end <= start:
+            return ""
+        start, end = first + start, first + end
+
+        packed = self.arrays["packed"][start >> 2 : (end + 3) >> 2]
+        codes = ((packed[:, None] >> self.SHIFTS) & 3).ravel()
+        bases = self.BASES[codes[start & 3 : (start & 3) + end - start]]
+
+        # runs are sorted and disjoint, so those overlapping [start, end) are contiguous
+        for kind in ["exception", "mask"]:
+            starts = self.arrays[f"{kind}_starts"]
+            ends = self.arrays[f"{kind}_ends"]
+            for i in range(
+                np.searchsorted(ends, start, side="right"),
+                np.searchsorted(starts, end),
+            ):
+                run = slice(max(starts[i], start) - start, min(ends[i], end) - start)
+                if kind == "exception":
+                    bases[run] = self.arrays["exception_bases"][i]
+                else:
+                    bases[run] |= 0x20
+        return bases.tobytes().decode()
+
+
+def open_index(path: Path, cache_size: int = 0) -> SequenceIndex:
+    """
+    Opens a DuckDB index, or a remap sidecar if `path` ends in `SIDECAR_SUFFIX`.
+    """
+    if path.suffix == SIDECAR_SUFFIX:
+        return SidecarIndex(path, cache_size)
+    return DivRefIndex(get_index_path(path), cache_size)
+
+
+def is_gzipped(path: Path) -> bool:
+    return path.suffix in (".gz", ".bgz")
+
+
+class RecordBatchOutput:
+    """
+    Writes record batches with `schema` to a Parquet file, one row group per batch, or to an
+    Arrow IPC file. If no batch is written, the file holds an empty table.
+    """
+
+    def __init__(self, path: Path, output_format: str, schema: pa.Schema):
+        self.path = path
+        self.output_format = output_format
+        self.schema = schema
+        self.writer = None
+
+    def _open(self):
+        if self.output_format == "parquet":
+            self.writer = pq.ParquetWriter(self.path, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(self.path, self.schema)
+
+    def write(self, batch: pa.RecordBatch):
+        if self.writer is None:
+            self._open()
+        self.writer.write_batch(batch)
+
+    def close(self):
+        if self.writer is None:
+            self._open()
+            self.writer.write_table(self.schema.empty_table())
+        self.writer.close()
+
+
+OUTPUT_FORMATS = ["tsv", "parquet", "arrow"]
+
+
+def open_output(
+    path: Path, output_format: str = "tsv", schema: Optional[pa.Schema] = None
+):
+    if output_format != "tsv":
+        return RecordBatchOutput(path, output_format, schema)
+    if is_gzipped(path):
+        return BgzfWriter(path)
+    return open(path, "wb")
+
+
+CHROM_FIELD = "chromosome"
+START_FIELD = "coordinate_start"
+END_FIELD = "coordinate_end"
+
+
+class RemappedChunk(NamedTuple):
+    """
+    One chunk of remapped CALITAS hits, before formatting. `df` holds the input columns, the
+    remapped coordinates and the scalar annotations; the per-variant annotations are built
+    from `haps`, where row `i` of `df` is haplotype `hap_index[i]`, by `calitas_tsv` or
+    `calitas_record_batch`.
+    """
+
+    df: pd.DataFrame
+    columns: list[str]
+    haps: HaplotypeColumns
+    hap_index: np.ndarray
+    first_variant_index: np.ndarray
+    last_variant_index: np.ndarray
+
+
+def remap_calitas_chunk(index: SequenceIndex, df: pd.DataFrame) -> RemappedChunk:
+    """
+    Remaps one chunk of CALITAS hits.
+    """
+    record_ids, record_index = np.unique(
+        df[CHROM_FIELD].to_numpy(dtype=object), return_inverse=True
+    )
+    # with --dedup-sequences, a hit on a FASTA record is a hit on every sequence written as it,
+    # so each row is repeated once per sequence
+    batch_hap_ids, hap_record = index.record_sequences(record_ids)
+    counts = np.bincount(hap_record, minlength=len(record_ids))
+    hap_index = np.zeros(len(record_ids), dtype=np.int64)
+    np.cumsum(counts[:-1], out=hap_index[1:])
+    hap_index = hap_index[record_index]
+    if len(batch_hap_ids) > len(record_ids):
+        repeats = counts[record_index]
+        rows = np.repeat(np.arange(len(df)), repeats)
+        row_offsets = np.zeros(len(df), dtype=np.int64)
+        np.cumsum(repeats[:-1], out=row_offsets[1:])
+        hap_index = hap_index[rows] + np.arange(len(rows)) - row_offsets[rows]
+        df = df.iloc[rows].reset_index(drop=True)
+
+    try:
+        haps = index.fetch(batch_hap_ids)
+    except MissingSequencesError as e:
+        hap_id = next(x for x in df[CHROM_FIELD] if x in e.sequence_ids)
+        typer.secho(
+            f"ERROR: Unable to find haplotype for {hap_id} - ensure you are aligning against the same version of DivRef as this index (DivRef-v{index.version})",
+            fg=typer.colors.BRIGHT_RED,
+        )
+        sys.exit(1)
+
+    start = df[START_FIELD].to_numpy(dtype=np.int64)
+    end = df[END_FIELD].to_numpy(dtype=np.int64)
+    padded_len_adj = (
+        df["padded_target"].str.len() - df["unpadded_target_sequence"].str.len()
+    ).to_numpy(dtype=np.int64)
+
+    # account for PAM in protospacer sequence
+    plus_strand = (df["strand"] == "+").to_numpy()
+    end = np.where(plus_strand, end + padded_len_adj, end)
+    start = np.where(plus_strand, start, start - padded_len_adj)
+
+    rm = remap_batch(haps.intervals, hap_index, start, end)
+
+    n_variants_involved = np.where(
+        rm.first_variant_index >= 0,
+        rm.last_variant_index - rm.first_variant_index + 1,
+        0,
+    )
+
+    # Update DataFrame with results, maintaining original structure
+    columns = list(df.columns)
+    df["divref_sequence_id"] = batch_hap_ids[hap_index]
+    df["divref_start"] = df[START_FIELD]
+    df["divref_end"] = df[END_FIELD]
+    df[CHROM_FIELD] = haps.contig[hap_index]
+    df[START_FIELD] = rm.start
+    df[END_FIELD] = rm.end
+    df["genome_build"] = f"DivRef-v{index.version}"
+    df["n_variants_involved"] = n_variants_involved
+    df["popmax_empirical_AF"] = haps.popmax_empirical_AF[hap_index]
+    df["popmax_empirical_AC"] = haps.popmax_empirical_AC[hap_index]
+    df["max_pop"] = haps.max_pop[hap_index]
+    df["variant_source"] = haps.source[hap_index]
+    return RemappedChunk(
+        df, columns, haps, hap_index, rm.first_variant_index, rm.last_variant_index
+    )
+
+
+def _output_columns(columns: list[str], frequencies_column: str) -> list[str]:
+    # input columns in place, then the annotations, as assigning them in turn would order them
+    return list(
+        dict.fromkeys(
+            [
+                *columns,
+                "divref_sequence_id",
+                "divref_start",
+                "divref_end",
+                "genome_build",
+                "all_variants",
+                "variants_involved",
+                "n_variants_involved",
+                "popmax_empirical_AF",
+                "popmax_empirical_AC",
+                "max_pop",
+                "variant_source",
+                frequencies_column,
+            ]
+        )
+    )
+
+
+def calitas_tsv(chunk: RemappedChunk) -> pd.DataFrame:
+    """
+    The chunk with the per-variant annotations as text: `all_variants` and
+    `variants_involved` comma-delimited, and `population_frequencies_json`.
+    """
+    df, haps, hap_index = chunk.df, chunk.haps, chunk.hap_index
+    hap_variant_strs = [[v.strip() for v in x.split(",")] for x in haps.variants]
+    df["all_variants"] = haps.variants[hap_index]
+    df["variants_involved"] = [
+        ",".join(hap_variant_strs[h][first : last + 1]) if first >= 0 else ""
+        for h, first, last in zip(
+            hap_index.tolist(),
+            chunk.first_variant_index.tolist(),
+            chunk.last_variant_index.tolist(),
+        )
+    ]
+    df["population_frequencies_json"] = population_frequencies_json(
+        haps.intervals.offsets, haps.population_AFs
+    )[hap_index]
+    return df[_output_columns(chunk.columns, "population_frequencies_json")]
+
+
+def _list_array(values: pa.Array, starts: np.ndarray, lengths: np.ndarray) -> pa.Array:
+    # a list array of `values[starts[i] : starts[i] + lengths[i]]`
+    offsets = np.zeros(len(starts) + 1, dtype=np.int32)
+    np.cumsum(lengths, out=offsets[1:])
+    positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+    return pa.ListArray.from_arrays(pa.array(offsets), values.take(pa.array(positions)))
+
+
+def calitas_schema(columns: list[str]) -> pa.Schema:
+    """
+    The schema of `calitas_record_batch` for CALITAS input with `columns`.
+    """
+    types = {
+        START_FIELD: pa.int64(),
+        END_FIELD: pa.int64(),
+        "divref_start": pa.int64(),
+        "divref_end": pa.int64(),
+        "all_variants": pa.list_(pa.string()),
+        "variants_involved": pa.list_(pa.string()),
+        "n_variants_involved": pa.int64(),
+        "popmax_empirical_AF": pa.float64(),
+        "popmax_empirical_AC": pa.int64(),
+        "population_frequencies": pa.struct(
+            [(pop, pa.list_(pa.float32())) for pop in POPS]
+        ),
+    }
+    return pa.schema(
+        (name, types.get(name, pa.string()))
+        for name in _output_columns(columns, "population_frequencies")
+    )
+
+
+def calitas_record_batch(chunk: RemappedChunk) -> pa.RecordBatch:
+    """
+    The chunk as an Arrow record batch with native types: integer coordinates, `all_variants`
+    and `variants_involved` as lists of `chr:start:ref:alt` strings, and
+    `population_frequencies`, a struct of per-population lists of frequencies lining up with
+    `all_variants` (null where gnomAD has none).
+    """
+    df, haps, hap_index = chunk.df, chunk.haps, chunk.hap_index
+    variant_offsets = haps.intervals.offsets
+    variant_strs = pc.utf8_trim_whitespace(
+        pc.list_flatten(pc.split_pattern(pa.array(haps.variants, pa.string()), ","))
+    )
+    starts = variant_offsets[hap_index]
+    lengths = variant_offsets[hap_index + 1] - starts
+    first = np.maximum(chunk.first_variant_index, 0)
+    involved = np.where(
+        chunk.first_variant_index >= 0,
+        chunk.last_variant_index - chunk.first_variant_index + 1,
+        0,
+    )
+    annotations = {
+        "all_variants": _list_array(variant_strs, starts, lengths),
+        "variants_involved": _list_array(variant_strs, starts + first, involved),
+        "population_frequencies": pa.StructArray.from_arrays(
+            [
+                _list_array(
+                    pa.array(haps.population_AFs[:, j], pa.float32(), from_pandas=True),
+                    starts,
+                    lengths,
+                )
+                for j in range(len(POPS))
+            ],
+            names=POPS,
+        ),
+    }
+    schema = calitas_schema(chunk.columns)
+    arrays = []
+    for field in schema:
+        if field.name in annotations:
+            arrays.append(annotations[field.name])
+        elif field.type == pa.string():
+            arrays.append(pa.array(df[field.name].to_numpy(dtype=object), field.type))
+        else:
+            values = df[field.name].to_numpy(dtype=field.type.to_pandas_dtype())
+            arrays.append(pa.array(values, field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def read_calitas_columns(input_path: Path, sep: str) -> list[str]:
+    return list(
+        pd.read_csv(
+            input_path,
+            sep=sep,
+            nrows=0,
+            compression="gzip" if is_gzipped(input_path) else None,
+        ).columns
+    )
+
+
+def read_calitas_chunks(input_path: Path, sep: str, chunk_size: int):
+    # every column is read as text and written back verbatim, so that columns the remapper
+    # doesn't touch can't be re-typed differently from one chunk to the next
+    chunks = pd.read_csv(
+        input_path,
+        sep=sep,
+        dtype=str,
+        keep_default_na=False,
+        chunksize=chunk_size,
+        compression="gzip" if is_gzipped(input_path) else None,
+    )
+    for df in chunks:
+        # if any of these fields are absent, error
+        if not all(x in df.columns for x in (CHROM_FIELD, START_FIELD, END_FIELD)):
+            raise ValueError(
+                f"Required fields not found in the input file: {CHROM_FIELD}, {START_FIELD}, {END_FIELD}"
+            )
+        yield df
+
+
+def read_bed_chunks(input_path: Path, chunk_size: int):
+    # BED regions: chromosome, 0-based start and half-open end, and an optional name
+    chunks = pd.read_csv(
+        input_path,
+        sep="\t",
+        header=None,
+        comment="#",
+        dtype=str,
+        keep_default_na=False,
+        chunksize=chunk_size,
+        compression="gzip" if is_gzipped(input_path) else None,
+    )
+    for df in chunks:
+        df = df.iloc[:, :4]
+        df.columns = ["chromosome", "start", "end", "name"][: df.shape[1]]
+        yield df
+
+
+def find_region_sequences(
+    index: SequenceIndex, df: pd.DataFrame, covering: bool = False
+) -> pd.DataFrame:
+    """
+    Lists the sequences overlapping (or with `covering`, containing) each region of `df`, a
+    chunk of `read_bed_chunks`: one row per region and sequence, in region order.
+    """
+    contigs = df["chromosome"].to_numpy(dtype=object)
+    starts = df["start"].to_numpy(dtype=np.int64)
+    ends = df["end"].to_numpy(dtype=np.int64)
+    found = []
+    for contig in pd.unique(contigs):
+        spans = index.contig_spans(contig)
+        if spans is None:
+            continue
+        rows = np.flatnonzero(contigs == contig)
+        region, span = overlapping_spans(spans, starts[rows], ends[rows], covering)
+        found.append(
+            (
+                rows[region],
+                spans.sequence_idx[span],
+                spans.starts[span],
+                spans.ends[span],
+            )
+        )
+    if found:
+        rows, sequence_idx, span_starts, span_ends = map(np.concatenate, zip(*found))
+    else:
+        rows, sequence_idx, span_starts, span_ends = (
+            np.zeros(0, dtype=np.int64) for _ in range(4)
+        )
+    # each contig's pairs are in region order already; interleave the contigs
+    order = np.argsort(rows, kind="stable")
+    out = df.iloc[rows[order]].reset_index(drop=True)
+    out["sequence_id"] = index.sequence_id_prefix + pd.Series(
+        sequence_idx[order], dtype=np.int64
+    ).astype(str)
+    out["sequence_start"] = span_starts[order]
+    out["sequence_end"] = span_ends[order]
+    return out
+
+
+# per-process index for --workers, set up by `_init_worker`
+_worker_index: Optional[SequenceIndex] = None
+
+
+def _init_worker(index_path: Path, cache_size: int):
+    global _worker_index
+    _worker_index = open_index(index_path, cache_size)
+
+
+class ChunkResult(NamedTuple):
+    data: bytes | pa.RecordBatch
+    rows: int
+    seconds: float
+    cache_hits: int
+    cache_misses: int
+
+
+def _remap_and_format_chunk(
+    df: pd.DataFrame, sep: str, header: bool, output_format: str
+) -> ChunkResult:
+    """
+    Returns the formatted chunk, as text or for `output_format` "parquet" and "arrow" a record
+    batch, with the time and cache hits and misses spent remapping it.
+    """
+    started = time.perf_counter()
+    cache = _worker_index.cache
+    hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    rows = len(df)
+    chunk = remap_calitas_chunk(_worker_index, df)
+    if output_format == "tsv":
+        data = (
+            calitas_tsv(chunk)
+            .to_csv(sep=sep, index=False, header=header, quoting=csv.QUOTE_NONE)
+            .encode()
+        )
+    else:
+        data = calitas_record_batch(chunk)
+    if cache is not None:
+        hits, misses = cache.hits - hits, cache.misses - misses
+    return ChunkResult(data, rows, time.perf_counter() - started, hits, misses)
+
+
+def _ordered_map(executor: Optional[Executor], fn, args_iter, max_in_flight: int):
+    """
+    Like `executor.map`, but only pulls `max_in_flight` items ahead of the consumer so
+    memory stays bounded. Runs in-process if `executor` is None.
+    """
+    if executor is None:
+        for args in args_iter:
+            yield fn(*args)
+        return
+    pending = deque()
+    for args in args_iter:
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
 @app.command(
     name="calitas",
     help="Remap DivRef coordinates to reference genome coordinates for CALITAS output files",
 )
 def calitas(
-    input_path: Path = typer.Argument(..., help="Path to the CALITAS output file"),
-    output_path: Path = typer.Argument(..., help="Path to the remapped output file"),
+    input_path: Path = typer.Argument(
+        ..., help="Path to the CALITAS output file (optionally bgzipped)"
+    ),
+    output_path: Path = typer.Argument(
+        ...,
+        help="Path to the remapped output file (bgzipped if it ends in .gz or .bgz)",
+    ),
     index_path: Optional[Path] = typer.Option(
-        None, "-i", help="Path to the FASTA index file"
+        None,
+        "-i",
+        help="Path to the DuckDB index file, or a binary remap sidecar (.bin) built with create_fasta_and_index.py --remap-sidecar",
     ),
     sep: str = typer.Option("\t", "-s", help="Separator in the file"),
     batch_size: int = typer.Option(
-        25000, "-b", help="Number of rows to process in each batch"
+        25000,
+        "-b",
+        help="Number of rows to read, remap and write at a time; bounds memory usage",
+    ),
+    workers: int = typer.Option(
+        1, "--workers", "-w", help="Number of processes to remap batches in parallel"
+    ),
+    cache_size: int = typer.Option(
+        0,
+        "--cache-size",
+        help="Number of DivRef sequences each process keeps cached across batches (0 disables the cache)",
+    ),
+    stats_json: Optional[Path] = typer.Option(
+        None,
+        "--stats-json",
+        help="Write row count, total and per-batch remap times and cache counts to this JSON file",
+    ),
+    output_format: str = typer.Option(
+        "tsv",
+        "--output-format",
+        help="tsv, or parquet or arrow (IPC file) with typed and nested annotation columns",
     ),
 ):
-    conn = get_index_path(index_path)
-
-    df = pd.read_csv(input_path, sep=sep)
-    chrom_field = "chromosome"
-    start_field = "coordinate_start"
-    end_field = "coordinate_end"
-
-    # if any of these fields are absent, error
-    if not all(x in df.columns for x in (chrom_field, start_field, end_field)):
-        raise ValueError(
-            f"Required fields not found in the input file: {chrom_field}, {start_field}, {end_field}"
-        )
-
-    if df[chrom_field].dtype != str:
-        df[chrom_field] = df[chrom_field].astype(str)
-
-    version = conn.execute("SELECT * FROM VERSION").fetchone()[0]
-    window_size: int = conn.execute("SELECT * FROM window_size").fetchone()[0]
-
-    # Lists to store results
-    contigs = []
-    starts = []
-    ends = []
-    variants_involved = []
-    all_variants = []
-    n_variants_involved = []
-    popmax_empirical_AF = []
-    popmax_empirical_AC = []
-    max_pop = []
-    all_pop_freqs_json = []
-    source = []
-
-    # Process in batches
-    for batch_start in tqdm(range(0, len(df), batch_size)):
-        batch_end = min(batch_start + batch_size, len(df))
-
-        batch_df = df.iloc[batch_start:batch_end]
-        batch_hap_ids = batch_df[chrom_field].tolist()
-
-        # Query database for batch
-        results = conn.execute(
-            """
-            SELECT * FROM sequences 
-            WHERE sequences.sequence_id IN (SELECT unnest($1::STRING[]))
-            """,
-            [batch_hap_ids],
-        ).fetchall()
-
-        # pops_legend = get_pops_legend(conn)
-
-        columns = [desc[0] for desc in conn.description]
-        id_to_hap: dict[str, Haplotype] = {}
-        for row in results:
-            hap = Haplotype(**dict(zip(columns, row)))
-            id_to_hap[hap.sequence_id] = hap
-
-        # Process each row in the batch
-        for _, df_row in batch_df.iterrows():
-            start = df_row[start_field]
-            end = df_row[end_field]
-            hap_id = df_row[chrom_field]
-
-            strand = df_row["strand"]
-            padded_target = df_row["padded_target"]
-            target = df_row["unpadded_target_sequence"]
-
-            padded_len_adj = len(padded_target) - len(target)
-
-            # account for PAM in protospacer sequence
-            if strand == "+":
-                end += padded_len_adj
-            else:
-                start -= padded_len_adj
-
-            hap = id_to_hap.get(hap_id)
-            if hap is None:
-                typer.secho(
-                    f"ERROR: Unable to find haplotype for {hap_id} - ensure you are aligning against the same version of DivRef as this index (DivRef-v{version})",
-                    fg=typer.colors.BRIGHT_RED,
-                )
-                sys.exit(1)
-            rm = hap.reference_mapping(start, end, window_size)
-
-            # Append results to lists
-            contigs.append(rm.chromosome)
-            starts.append(rm.start)
-            ends.append(rm.end)
-            all_variants.append(hap.variants)
-            variants_involved.append(rm.variants_involved_str())
-            n_variants_involved.append(len(rm.variants_involved))
-            popmax_empirical_AF.append(hap.popmax_empirical_AF)
-            popmax_empirical_AC.append(hap.popmax_empirical_AC)
-            max_pop.append(hap.max_pop)
-            source.append(hap.source)
-            all_pop_freqs_json.append(
-                json.dumps(rm.population_frequencies).replace(" ", "")
+    if output_format not in OUTPUT_FORMATS:
+        raise typer.BadParameter(
+            f"--output-format must be one of {', '.join(OUTPUT_FORMATS)}"
+        )
+    index_path = find_index_path(index_path)
+
+    executor = None
+    if workers > 1:
+        # spawn rather than fork: forking a process with open DuckDB/Arrow thread pools is unsafe
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(index_path, cache_size),
+        )
+    else:
+        _init_worker(index_path, cache_size)
+
+    chunks = (
+        (df, sep, i == 0, output_format)
+        for i, df in enumerate(read_calitas_chunks(input_path, sep, batch_size))
+    )
+    started = time.perf_counter()
+    rows = 0
+    batch_seconds = []
+    cache_hits = 0
+    cache_misses = 0
+    schema = None
+    if output_format != "tsv":
+        schema = calitas_schema(read_calitas_columns(input_path, sep))
+    out = open_output(output_path, output_format, schema)
+    try:
+        with tqdm(unit=" batches") as progress:
+            # batches are written in input order, whichever worker finishes first
+            for result in _ordered_map(
+                executor, _remap_and_format_chunk, chunks, max_in_flight=2 * workers
+            ):
+                out.write(result.data)
+                rows += result.rows
+                batch_seconds.append(result.seconds)
+                cache_hits += result.cache_hits
+                cache_misses += result.cache_misses
+                progress.update()
+    finally:
+        out.close()
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    if cache_size > 0:
+        lookups = max(cache_hits + cache_misses, 1)
+        typer.echo(
+            f"sequence cache: {cache_hits} hits, {cache_misses} misses "
+            f"({cache_hits / lookups:.1%} hit rate)",
+            err=True,
+        )
+
+    if stats_json is not None:
+        with open(stats_json, "w") as f:
+            json.dump(
+                {
+                    "rows": rows,
+                    "seconds": time.perf_counter() - started,
+                    "batch_seconds": batch_seconds,
+                    "cache_hits": cache_hits,
+                    "cache_misses": cache_misses,
+                },
+                f,
             )
 
-    # Update DataFrame with results, maintaining original structure
-    df["divref_sequence_id"] = df[chrom_field]
-    df["divref_start"] = df[start_field]
-    df["divref_end"] = df[end_field]
-    df[chrom_field] = contigs
-    df[start_field] = starts
-    df[end_field] = ends
-    df["genome_build"] = f"DivRef-v{version}"
-    df["all_variants"] = all_variants
-    df["variants_involved"] = variants_involved
-    df["n_variants_involved"] = n_variants_involved
-    df["popmax_empirical_AF"] = popmax_empirical_AF
-    df["popmax_empirical_AC"] = popmax_empirical_AC
-    df["max_pop"] = max_pop
-    df["variant_source"] = source
-    df["population_frequencies_json"] = all_pop_freqs_json
 
-    df.to_csv(output_path, sep=sep, index=False, quoting=csv.QUOTE_NONE)
+@app.command(
+    name="region",
+    help="List the DivRef sequences overlapping GRCh38 regions",
+)
+def region(
+    input_path: Path = typer.Argument(
+        ..., help="BED file of GRCh38 regions (optionally gzipped)"
+    ),
+    output_path: Path = typer.Argument(
+        ...,
+        help="Path to the output file (bgzipped if it ends in .gz or .bgz)",
+    ),
+    index_path: Optional[Path] = typer.Option(
+        None,
+        "-i",
+        help="Path to the DuckDB index file, or a binary remap sidecar (.bin) built with create_fasta_and_index.py --remap-sidecar",
+    ),
+    covering: bool = typer.Option(
+        False,
+        "--covering",
+        help="Only list sequences that contain the whole region, rather than overlap it",
+    ),
+    batch_size: int = typer.Option(
+        1_000_000, "-b", help="Number of regions to read and look up at a time"
+    ),
+):
+    index = open_index(find_index_path(index_path))
+    out = open_output(output_path)
+    try:
+        for i, df in enumerate(read_bed_chunks(input_path, batch_size)):
+            df = find_region_sequences(index, df, covering)
+            out.write(
+                df.to_csv(
+                    sep="\t", index=False, header=i == 0, quoting=csv.QUOTE_NONE
+                ).encode()
+            )
+    finally:
+        out.close()
+
+
+@app.command(
+    name="sequence",
+    help="Print DivRef sequences, or slices of them, from a 2-bit sequence store",
+)
+def sequence(
+    store_path: Path = typer.Argument(
+        ...,
+        help="Path to the sequence store (.sequences.bin) built with create_fasta_and_index.py --sequence-store",
+    ),
+    regions: list[str] = typer.Argument(
+        ...,
+        help="Sequence IDs, optionally with a 0-based half-open slice: ID[:start-end]",
+    ),
+):
+    store = SequenceStore(store_path)
+    for region in regions:
+        sequence_id, _, bounds = region.partition(":")
+        start, end = 0, None
+        if bounds:
+            first, _, last = bounds.partition("-")
+            start, end = int(first or 0), int(last) if last else None
+        typer.echo(f">{region}")
+        typer.echo(store.fetch(sequence_id, start, end))
 
 
 @app.callback()
@@ -0,0 +1,299 @@
+import gzip
+import json
+from collections import defaultdict
+
+import numpy as np
+import polars
+import pytest
+
+from divref_haplotypes import (
+    common_gnomad_sites,
+    discover_haplotypes,
+    gnomad_pops,
+    haplotype_window_counts,
+    parse_genotypes,
+    split_haplotypes,
+)
+
+POPS = ["afr", "amr", "eas"]
+
+
+def random_dataset(rng, contig, n_sites, n_samples, start):
+    # gnomAD sites (some rare, some with missing AFs) and phased genotypes with missing calls
+    sites = []
+    position = start
+    for _ in range(n_sites):
+        position += int(rng.integers(1, 8))
+        afs = [
+            None if rng.random() < 0.05 else float(rng.choice([0.001, 0.01, 0.2]))
+            for _ in POPS
+        ]
+        sites.append((contig, position, "A", "C" if rng.random() < 0.8 else "CT", afs))
+    genotypes = [
+        [
+            None if rng.random() < 0.05 else tuple(rng.random(2) < 0.4)
+            for _ in range(n_samples)
+        ]
+        for _ in sites
+    ]
+    return sites, genotypes
+
+
+def write_vcf(path, samples, sites, genotypes, in_gnomad):
+    with gzip.open(path, "wt") as f:
+        f.write("##fileformat=VCFv4.2\n")
+        f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t")
+        f.write("\t".join(samples) + "\n")
+        for i, ((contig, position, ref, alt, _), calls) in enumerate(
+            zip(sites, genotypes)
+        ):
+            # a few sites that aren't in gnomAD
+            alt = alt if in_gnomad[i] else "G"
+            fields = ["./." if c is None else f"{int(c[0])}|{int(c[1])}" for c in calls]
+            if i % 2:
+                fields = [f"{x}:{i}" for x in fields]
+            f.write(
+                f"{contig}\t{position}\t.\t{ref}\t{alt}\t.\tPASS\t.\t"
+                + ("GT:DP" if i % 2 else "GT")
+                + "\t"
+                + "\t".join(fields)
+                + "\n"
+            )
+
+
+def reference_haplotypes(sites, genotypes, sample_pops, window_size, threshold):
+    # a direct transliteration of `compute_haplotypes.py`
+    rows = []
+    for site, calls in zip(sites, genotypes):
+        contig, position, ref, alt, afs = site
+        if max((af for af in afs if af is not None), default=0) < threshold:
+            continue
+        left, right = [], []
+        AC, AN = defaultdict(int), defaultdict(int)
+        for sample, (pop, call) in enumerate(zip(sample_pops, calls)):
+            if pop < 0 or call is None or afs[pop] is None or afs[pop] < threshold:
+                continue
+            if call[0]:
+                left.append((pop, sample))
+            if call[1]:
+                right.append((pop, sample))
+            AC[pop] += int(call[0]) + int(call[1])
+            AN[pop] += 2
+        rows.append((contig, position, ref, alt, afs, left, right, AC, AN))
+
+    found = {}
+    for offset in [0, window_size // 2]:
+        windows = defaultdict(list)
+        for row_idx, row in enumerate(rows):
+            windows[(row[0], row[1] - (row[1] + offset) % window_size)].append(row_idx)
+        for row_idxs in windows.values():
+            counts = defaultdict(int)
+            for side in (5, 6):
+                by_sample = defaultdict(list)
+                for row_idx in row_idxs:
+                    for pop, sample in rows[row_idx][side]:
+                        by_sample[(pop, sample)].append(row_idx)
+                for (pop, _), haplotype in by_sample.items():
+                    if len(haplotype) > 1:
+                        counts[(pop, tuple(sorted(haplotype)))] += 1
+            by_haplotype = defaultdict(list)
+            for (pop, haplotype), n in sorted(counts.items()):
+                AN = min(rows[r][8][pop] for r in haplotype)
+                mvf = min(rows[r][7][pop] / rows[r][8][pop] for r in haplotype)
+                by_haplotype[haplotype].append((pop, n, mvf, n / AN))
+            for haplotype, freqs in by_haplotype.items():
+                freqs.sort(key=lambda x: -x[3])
+                if haplotype not in found or freqs[0][3] > found[haplotype][0][3]:
+                    found[haplotype] = freqs
+    return found, rows
+
+
+def test_discover_haplotypes_matches_hail_logic(tmp_path):
+    rng = np.random.default_rng(1)
+    samples = [f"s{i}" for i in range(13)]
+    # one sample has a population that isn't used, one has none
+    sample_pop_names = [POPS[i % 3] for i in range(11)] + ["oth", None]
+    sample_pops = [POPS.index(p) if p in POPS else -1 for p in sample_pop_names]
+
+    sites21, genotypes21 = random_dataset(rng, "chr21", 80, len(samples), 1000)
+    sites22, genotypes22 = random_dataset(rng, "chr22", 40, len(samples), 5000)
+    in_gnomad21 = rng.random(len(sites21)) > 0.1
+    in_gnomad22 = rng.random(len(sites22)) > 0.1
+    # chr22 sorts first by file name but comes after chr21 in GRCh38
+    write_vcf(tmp_path / "a.vcf.gz", samples, sites22, genotypes22, in_gnomad22)
+    write_vcf(tmp_path / "b.vcf.gz", samples, sites21, genotypes21, in_gnomad21)
+
+    gnomad_sites = [s for s, keep in zip(sites21, in_gnomad21) if keep] + [
+        s for s, keep in zip(sites22, in_gnomad22) if keep
+    ]
+    polars.DataFrame(
+        {
+            "contig": [s[0] for s in gnomad_sites],
+            "position": [s[1] for s in gnomad_sites],
+            "ref": [s[2] for s in gnomad_sites],
+            "alt": [s[3] for s in gnomad_sites],
+            "pop_freqs": [
+                [{"AC": 1, "AF": af, "AN": 100, "homozygote_count": 0} for af in s[4]]
+                for s in gnomad_sites
+            ],
+        },
+        schema_overrides={"position": polars.Int32},
+    ).write_parquet(tmp_path / "va.parquet")
+    polars.DataFrame({"s": samples, "pop": sample_pop_names}).write_parquet(
+        tmp_path / "sa.parquet"
+    )
+
+    ht = discover_haplotypes(
+        [str(tmp_path / "a.vcf.gz"), str(tmp_path / "b.vcf.gz")],
+        str(tmp_path / "va.parquet"),
+        str(tmp_path / "sa.parquet"),
+        POPS,
+        10,
+        0.005,
+        workers=2,
+    )
+
+    sites = gnomad_sites
+    genotypes = [g for g, keep in zip(genotypes21, in_gnomad21) if keep] + [
+        g for g, keep in zip(genotypes22, in_gnomad22) if keep
+    ]
+    expected, rows = reference_haplotypes(sites, genotypes, sample_pops, 10, 0.005)
+
+    assert len(expected) > 20
+    assert [list(h) for h in sorted(expected)] == ht["haplotype"].to_list()
+    for row in ht.iter_rows(named=True):
+        freqs = expected[tuple(row["haplotype"])]
+        assert row["max_pop"] == freqs[0][0]
+        assert row["max_empirical_AC"] == freqs[0][1]
+        assert row["min_variant_frequency"] == pytest.approx(freqs[0][2])
+        assert row["max_empirical_AF"] == pytest.approx(freqs[0][3])
+        for actual, (pop, AC, mvf, AF) in zip(row["all_pop_freqs"], freqs, strict=True):
+            assert actual["pop"] == pop
+            assert actual["empirical_AC"] == AC
+            assert actual["min_variant_frequency"] == pytest.approx(mvf)
+            assert actual["empirical_AF"] == pytest.approx(AF)
+        assert row["variants"] == [
+            {
+                "locus": {"contig": rows[r][0], "position": rows[r][1]},
+                "alleles": [rows[r][2], rows[r][3]],
+            }
+            for r in row["haplotype"]
+        ]
+        assert [[f["AF"] for f in x] for x in row["gnomad_freqs"]] == [
+            rows[r][4] for r in row["haplotype"]
+        ]
+
+
+def test_gnomad_pops(tmp_path):
+    # laid out as Spark writes it, with the legend of extract_gnomad_afs.py alongside the parts
+    va_path = tmp_path / "va.parquet"
+    va_path.mkdir()
+    polars.DataFrame(
+        {
+            "contig": ["chr1"],
+            "position": [10],
+            "ref": ["A"],
+            "alt": ["T"],
+            "pop_freqs": [[{"AF": 0.1}, {"AF": 0.2}, {"AF": 0.0}]],
+        }
+    ).write_parquet(va_path / "part-00000.parquet")
+    with open(va_path / "_pops.json", "w") as f:
+        json.dump(POPS, f)
+
+    assert gnomad_pops(str(va_path)) == POPS
+    assert common_gnomad_sites(str(va_path), "chr1", 0.1)["position"].to_list() == [10]
+
+
+def test_parse_genotypes():
+    left, right, diploid = parse_genotypes(b"0|1:3\t.|.:0\t1/1\t1\t1|0\n", 5)
+    assert bytes(left) == b"0.111"
+    assert bytes(right) == b"1.1.0"
+    assert diploid.tolist() == [True, True, True, False, True]
+
+
+def random_haplotypes(rng, n):
+    # haplotype tables with overlapping row indices, so pieces of different haplotypes coincide
+    rows = []
+    for _ in range(n):
+        position = int(rng.integers(0, 50)) * 3
+        first = int(rng.integers(0, 30))
+        variants = []
+        for _ in range(int(rng.integers(1, 7))):
+            ref = "A" * int(rng.integers(1, 4))
+            variants.append(
+                {
+                    "locus": {"contig": "chr1", "position": position},
+                    "alleles": [ref, "C"],
+                }
+            )
+            position += len(ref) + int(rng.integers(-1, 30))
+        rows.append(
+            {
+                "haplotype": list(range(first, first + len(variants))),
+                "variants": variants,
+                "max_pop_freq": float(rng.choice([0.001, 0.005, 0.01, 0.05])),
+            }
+        )
+    return rows
+
+
+def reference_split(row, window_size):
+    # a direct transliteration of `split_haplotypes`
+    variants = row["variants"]
+    breakpoints = [
+        i
+        for i in range(1, len(variants))
+        if variants[i]["locus"]["position"]
+        - variants[i - 1]["locus"]["position"]
+        - len(variants[i - 1]["alleles"][0])
+        >= window_size
+    ]
+    bounds = [0, *breakpoints, len(variants)]
+    return [
+        list(range(start, end))
+        for start, end in zip(bounds[:-1], bounds[1:])
+        if end - start > 1
+    ]
+
+
+def test_haplotype_window_counts():
+    rows = random_haplotypes(np.random.default_rng(0), 400)
+    frequencies = [0.001, 0.005, 0.01, 0.05]
+    windows = [1, 5, 10, 25, 40]
+
+    counts = haplotype_window_counts(
+        polars.DataFrame(rows), "max_pop_freq", frequencies, windows
+    )
+
+    expected = []
+    for frequency in frequencies:
+        for window_size in windows:
+            pieces = {
+                tuple(row["haplotype"][i] for i in indices)
+                for row in rows
+                if row["max_pop_freq"] >= frequency
+                for indices in reference_split(row, window_size)
+            }
+            expected.append((frequency, window_size, len(pieces)))
+    assert counts.rows() == expected
+
+
+def test_split_haplotypes():
+    rows = random_haplotypes(np.random.default_rng(2), 300)
+    df = polars.DataFrame(rows).with_columns(
+        gnomad_freqs=polars.col("haplotype").list.eval(polars.element() * 0.5)
+    )
+
+    for window_size in [1, 10, 25]:
+        split = split_haplotypes(df, window_size)
+        expected = [
+            {
+                "haplotype": [row["haplotype"][i] for i in indices],
+                "variants": [row["variants"][i] for i in indices],
+                "max_pop_freq": row["max_pop_freq"],
+                "gnomad_freqs": [row["haplotype"][i] * 0.5 for i in indices],
+            }
+            for row in rows
+            for indices in reference_split(row, window_size)
+        ]
+        assert split.to_dicts() == expected
@@ -0,0 +1,510 @@
+import gzip
+import hashlib
+import os
+import random
+
+import numpy as np
+import polars
+import pytest
+
+import divref_index
+from divref_index import (
+    ReferenceFasta,
+    assign_sequence_ids,
+    build_contig_partitions,
+    fasta_rows,
+    haplotype_sequences,
+    sequence_id_mapping,
+    with_fasta_records,
+    with_variant_intervals,
+    write_contig_fastas,
+    write_sequence_store,
+)
+from remap_divref import Haplotype, MissingSequencesError, SequenceStore
+
+
+def test_with_variant_intervals_matches_remap_parsing():
+    rng = random.Random(0)
+    all_variants = []
+    for _ in range(100):
+        variants = []
+        position = rng.randint(100, 10_000)
+        for _ in range(rng.randint(1, 5)):
+            ref = rng.choice(["A", "AT", "ACGT"])
+            alt = rng.choice(["C", "CG", "CGTAC"])
+            variants.append(f"chr1:{position}:{ref}:{alt}")
+            position += len(ref) + rng.randint(0, 20)
+        all_variants.append(",".join(variants))
+
+    df = with_variant_intervals(polars.DataFrame({"variants": all_variants}), 25)
+
+    for row in df.iter_rows(named=True):
+        hap = Haplotype.model_construct(variants=row["variants"], variant_starts=None)
+        assert hap.variant_intervals(25) == (
+            row["variant_starts"],
+            row["variant_ends"],
+            row["variant_ref_starts"],
+            row["variant_ref_ends"],
+        )
+
+
+def test_haplotype_sequences_edge_cases(tmp_path):
+    # same cases as test_haplotype_generation.py, whose mocked reference has the base at
+    # position p equal to character p of "01234567891"; wrapped at 4 bases per line
+    fasta_path = str(tmp_path / "reference.fasta")
+    with open(fasta_path, "w") as f:
+        f.write(">chr1\n1234\n5678\n91\n")
+    with open(fasta_path + ".fai", "w") as f:
+        f.write("chr1\t10\t6\t4\t5\n")
+
+    sequences = haplotype_sequences(
+        ReferenceFasta(fasta_path),
+        polars.Series(
+            [
+                "chr1:4:A:T,chr1:6:G:C",
+                "chr1:4:A:AT,chr1:6:G:GC",
+                "chr1:7:GC:G,chr1:4:AT:A",
+            ]
+        ),
+        context_size=2,
+        batch_size=2,
+    )
+
+    assert sequences.to_list() == ["23T5C78", "23AT5GC78", "23A6G91"]
+
+
+def test_write_contig_fastas(tmp_path):
+    rng = random.Random(0)
+    records = polars.DataFrame(
+        {
+            "contig": [rng.choice(["chr1", "chr2"]) for _ in range(100)],
+            "sequence_id": [f"DR-1.1-{i}" for i in range(100)],
+            "sequence": [
+                "".join(rng.choice("ACGT") for _ in range(rng.randint(20, 80)))
+                for _ in range(100)
+            ],
+        }
+    )
+    records.write_parquet(tmp_path / "records.parquet")
+    paths = {contig: str(tmp_path / f"{contig}.fasta") for contig in ["chr1", "chr2"]}
+
+    write_contig_fastas(
+        str(tmp_path / "records.parquet"), paths, workers=2, write_dict=True
+    )
+
+    for contig, path in paths.items():
+        expected = records.filter(polars.col("contig") == contig)
+        with open(path) as f:
+            assert f.read() == "".join(
+                f">{sequence_id}\n{sequence}\n"
+                for sequence_id, sequence in expected.select(
+                    "sequence_id", "sequence"
+                ).iter_rows()
+            )
+        # the .fai written alongside must locate every sequence
+        reference = ReferenceFasta(path)
+        for sequence_id, sequence in expected.select(
+            "sequence_id", "sequence"
+        ).iter_rows():
+            contig_index = reference.contig_index[sequence_id]
+            bases = reference.gather(
+                np.full(len(sequence), contig_index), np.arange(len(sequence))
+            )
+            assert bases.tobytes().decode() == sequence
+
+        with open(path + ".dict") as f:
+            lines = f.read().splitlines()
+        assert lines[0] == "@HD\tVN:1.0\tSO:unsorted"
+        sequence_id, sequence = expected.select("sequence_id", "sequence").row(0)
+        assert lines[1] == (
+            f"@SQ\tSN:{sequence_id}\tLN:{len(sequence)}"
+            f"\tM5:{hashlib.md5(sequence.encode()).hexdigest()}\tUR:NA"
+        )
+        assert len(lines) == len(expected) + 1
+
+
+def test_build_contig_partitions_reuses_unchanged_contigs(tmp_path):
+    rng = random.Random(0)
+    fasta_path = str(tmp_path / "reference.fasta")
+    with open(fasta_path, "w") as f, open(fasta_path + ".fai", "w") as fai:
+        for contig in ["chr1", "chr2"]:
+            f.write(f">{contig}\n")
+            fai.write(f"{contig}\t1000\t{f.tell()}\t1000\t1001\n")
+            f.write("".join(rng.choice("ACGT") for _ in range(1000)) + "\n")
+    reference = ReferenceFasta(fasta_path)
+
+    def table(chr2_position):
+        return polars.DataFrame(
+            {
+                "sequence_id": ["DR-1.1-0", "DR-1.1-1", "DR-1.1-2"],
+                "variants": [
+                    "chr1:100:A:T",
+                    f"chr2:{chr2_position}:C:G",
+                    "chr1:300:G:GA,chr1:310:T:C",
+                ],
+            }
+        )
+
+    def build(df):
+        return build_contig_partitions(
+            df,
+            str(tmp_path / "DivRef"),
+            reference,
+            window_size=10,
+            workers=1,
+            write_dict=True,
+            export_tsv=True,
+        )
+
+    def mtimes():
+        return {
+            contig: os.stat(tmp_path / f"DivRef.{contig}.fasta").st_mtime_ns
+            for contig in ["chr1", "chr2"]
+        }
+
+    first = build(table(200))
+    before = mtimes()
+    assert build(table(200)).equals(first)
+    assert mtimes() == before
+
+    changed = build(table(250))
+    after = mtimes()
+    assert after["chr1"] == before["chr1"]
+    assert after["chr2"] != before["chr2"]
+    assert changed.filter(polars.col("contig") == "chr2")["sequence"].to_list() == (
+        haplotype_sequences(reference, polars.Series(["chr2:250:C:G"]), 10).to_list()
+    )
+    with gzip.open(tmp_path / "DivRef.tsv.bgz") as f:
+        tsv = polars.read_csv(f.read(), separator="\t")
+    assert tsv.equals(changed.drop("contig"))
+
+
+def write_reference(tmp_path, contigs, seed):
+    rng = random.Random(seed)
+    fasta_path = str(tmp_path / "reference.fasta")
+    with open(fasta_path, "w") as f, open(fasta_path + ".fai", "w") as fai:
+        for contig in contigs:
+            f.write(f">{contig}\n")
+            fai.write(f"{contig}\t1000\t{f.tell()}\t1000\t1001\n")
+            f.write("".join(rng.choice("ACGT") for _ in range(1000)) + "\n")
+    return ReferenceFasta(fasta_path)
+
+
+def spy_on_splicing(monkeypatch):
+    # the variants of every sequence build_contig_partitions splices
+    spliced = []
+
+    def spy(reference, variants, window_size):
+        spliced.extend(variants.to_list())
+        return haplotype_sequences(reference, variants, window_size)
+
+    monkeypatch.setattr(divref_index, "haplotype_sequences", spy)
+    return spliced
+
+
+def test_build_contig_partitions_renumbers_without_rebuilding(tmp_path, monkeypatch):
+    reference = write_reference(tmp_path, ["chr1", "chr2", "chr3"], seed=1)
+
+    def table(variants):
+        return polars.DataFrame(
+            {
+                "sequence_id": [f"DR-1.1-{i}" for i in range(len(variants))],
+                "variants": variants,
+            }
+        )
+
+    spliced = spy_on_splicing(monkeypatch)
+
+    def build(df):
+        return build_contig_partitions(
+            df,
+            str(tmp_path / "DivRef"),
+            reference,
+            window_size=10,
+            workers=1,
+            write_dict=False,
+            export_tsv=True,
+        )
+
+    def mtime(contig):
+        return os.stat(tmp_path / f"DivRef.{contig}.fasta").st_mtime_ns
+
+    first = build(
+        table(["chr1:100:A:T", "chr2:200:C:G", "chr3:300:G:C", "chr3:400:T:A"])
+    )
+    chr1_mtime = mtime("chr1")
+    spliced.clear()
+
+    # a sequence added on chr2 shifts the IDs of those on chr3
+    second = build(
+        table(
+            [
+                "chr1:100:A:T",
+                "chr2:200:C:G",
+                "chr2:250:A:C",
+                "chr3:300:G:C",
+                "chr3:400:T:A",
+            ]
+        )
+    )
+    assert spliced == ["chr2:200:C:G", "chr2:250:A:C"]
+    assert mtime("chr1") == chr1_mtime
+    chr3 = second.filter(polars.col("contig") == "chr3")
+    assert chr3["sequence_id"].to_list() == ["DR-1.1-3", "DR-1.1-4"]
+    assert chr3["sequence"].equals(
+        first.filter(polars.col("contig") == "chr3")["sequence"]
+    )
+    with open(tmp_path / "DivRef.chr3.fasta") as f:
+        assert f.read() == "".join(
+            f">{sequence_id}\n{sequence}\n"
+            for sequence_id, sequence in chr3.select("sequence_id", "sequence").rows()
+        )
+    with gzip.open(tmp_path / "DivRef.tsv.bgz") as f:
+        tsv = polars.read_csv(f.read(), separator="\t")
+    assert tsv.equals(second.drop("contig"))
+
+    # read back as renumbered
+    spliced.clear()
+    assert build(second.select("sequence_id", "variants")).equals(second)
+    assert spliced == []
+
+
+def test_build_contig_partitions_new_release_rebuilds_nothing(tmp_path, monkeypatch):
+    reference = write_reference(tmp_path, ["chr1", "chr2"], seed=2)
+    spliced = spy_on_splicing(monkeypatch)
+    variants = ["chr1:100:A:T", "chr1:300:G:GA,chr1:310:T:C", "chr2:200:C:G"]
+
+    def build(version):
+        return build_contig_partitions(
+            polars.DataFrame(
+                {
+                    "sequence_id": [f"DR-{version}-{i}" for i in range(len(variants))],
+                    "variants": variants,
+                }
+            ),
+            str(tmp_path / "DivRef"),
+            reference,
+            window_size=10,
+            workers=1,
+            write_dict=False,
+            export_tsv=False,
+        )
+
+    first = build("1.1")
+    spliced.clear()
+    second = build("1.2")
+
+    assert spliced == []
+    assert second["sequence"].equals(first["sequence"])
+    with open(tmp_path / "DivRef.chr2.fasta") as f:
+        assert f.read().startswith(">DR-1.2-2\n")
+
+
+def test_build_contig_partitions_empty_table(tmp_path):
+    reference = write_reference(tmp_path, ["chr1"], seed=3)
+    df = polars.DataFrame(
+        schema={"sequence_id": polars.String, "variants": polars.String}
+    )
+
+    result = build_contig_partitions(
+        df,
+        str(tmp_path / "DivRef"),
+        reference,
+        window_size=10,
+        workers=1,
+        write_dict=False,
+        export_tsv=True,
+    )
+
+    assert result.columns == [
+        "sequence",
+        "sequence_length",
+        "sequence_id",
+        "variants",
+        "contig",
+    ]
+    assert result.is_empty()
+    with gzip.open(tmp_path / "DivRef.tsv.bgz") as f:
+        assert f.read() == b"sequence\tsequence_length\tsequence_id\tvariants\n"
+
+
+def test_sequence_ids_are_deterministic_and_mappable():
+    def table(variants):
+        return polars.DataFrame(
+            {"n_variants": [v.count(",") + 1 for v in variants], "variants": variants}
+        )
+
+    previous = assign_sequence_ids(
+        table(["chr2:50:A:T", "chr1:20:C:G,chr1:10:A:T", "chr1:30:G:C"]), "DR-1.1-", 25
+    )
+    # same sequences in another order, listing variants differently, plus a new one
+    current = assign_sequence_ids(
+        table(["chr1:30:G:C", "chr1:5:T:A", "chr2:50:A:T", "chr1:10:A:T, chr1:20:C:G"]),
+        "DR-1.2-",
+        25,
+    )
+
+    assert previous.columns == ["sequence_id", "stable_id", "n_variants", "variants"]
+    assert previous["variants"].to_list() == [
+        "chr1:20:C:G,chr1:10:A:T",
+        "chr1:30:G:C",
+        "chr2:50:A:T",
+    ]
+    assert previous["sequence_id"].to_list() == ["DR-1.1-0", "DR-1.1-1", "DR-1.1-2"]
+    assert current["sequence_id"].to_list()[0] == "DR-1.2-0"
+    assert current["variants"][0] == "chr1:5:T:A"
+
+    def with_idx(df, prefix):
+        return df.with_columns(
+            sequence_idx=polars.col("sequence_id")
+            .str.strip_prefix(prefix)
+            .cast(polars.Int64)
+        )
+
+    mapping = sequence_id_mapping(
+        with_idx(previous, "DR-1.1-"), 25, with_idx(current, "DR-1.2-")
+    )
+    assert mapping.rows() == [(0, 1), (1, 2), (2, 3)]
+    # a different window size gives different sequences
+    assert (
+        len(
+            sequence_id_mapping(
+                with_idx(previous, "DR-1.1-"), 10, with_idx(current, "DR-1.2-")
+            )
+        )
+        == 0
+    )
+
+
+def test_sequence_ids_carry_over_from_previous_build():
+    def table(variants):
+        return polars.DataFrame(
+            {"n_variants": [v.count(",") + 1 for v in variants], "variants": variants}
+        )
+
+    previous = assign_sequence_ids(
+        table(["chr10:5:A:T", "chr2:50:A:T", "chr1:20:C:G", "chr1:30:G:C"]),
+        "DR-1.1-",
+        25,
+    ).select(
+        sequence_idx=polars.col("sequence_id").str.strip_prefix("DR-1.1-").cast(int),
+        variants="variants",
+    )
+    # contigs are numbered in GRCh38 order, not as strings
+    assert previous.rows() == [
+        (0, "chr1:20:C:G"),
+        (1, "chr1:30:G:C"),
+        (2, "chr2:50:A:T"),
+        (3, "chr10:5:A:T"),
+    ]
+
+    # chr1:30:G:C removed, chr1:25:T:A and chr2:10:G:A added
+    current = assign_sequence_ids(
+        table(
+            ["chr2:50:A:T", "chr10:5:A:T", "chr1:25:T:A", "chr2:10:G:A", "chr1:20:C:G"]
+        ),
+        "DR-1.2-",
+        25,
+        previous,
+        25,
+    )
+    assert current.select("variants", "sequence_id").rows() == [
+        ("chr1:20:C:G", "DR-1.2-0"),
+        ("chr1:25:T:A", "DR-1.2-4"),
+        ("chr2:10:G:A", "DR-1.2-5"),
+        ("chr2:50:A:T", "DR-1.2-2"),
+        ("chr10:5:A:T", "DR-1.2-3"),
+    ]
+    # a different window size gives different sequences, numbered after the previous ones
+    assert assign_sequence_ids(table(["chr1:20:C:G"]), "DR-1.2-", 10, previous, 25)[
+        "sequence_id"
+    ].to_list() == ["DR-1.2-4"]
+
+    # sequences that keep their number aren't listed in the mapping; a sequence the previous
+    # build had twice is carried over under its first number
+    previous = polars.concat(
+        [previous, polars.DataFrame({"sequence_idx": [4], "variants": ["chr1:20:C:G"]})]
+    )
+    current = assign_sequence_ids(
+        table(["chr1:20:C:G", "chr2:50:A:T"]), "DR-1.2-", 25, previous, 25
+    ).with_columns(
+        sequence_idx=polars.col("sequence_id")
+        .str.strip_prefix("DR-1.2-")
+        .cast(polars.Int64)
+    )
+    assert current["sequence_idx"].to_list() == [0, 2]
+    assert sequence_id_mapping(previous, 25, current).rows() == [(4, 0)]
+
+
+def test_sequence_store_round_trip(tmp_path):
+    rng = random.Random(3)
+    sequences = ["", "A", "NNNN", "acgtN", "ACGTNNnnRYacgt", "G" * 17]
+    for _ in range(40):
+        sequences.append(
+            "".join(rng.choice("ACGTACGTacgtNNR") for _ in range(rng.randint(1, 60)))
+        )
+    df = polars.DataFrame(
+        {
+            "sequence_id": [f"DR-1.1-{i}" for i in range(len(sequences))],
+            "sequence": sequences,
+            "sequence_idx": range(len(sequences)),
+        }
+    ).reverse()
+    write_sequence_store(df, tmp_path / "index.sequences.bin", "DR-1.1-")
+
+    store = SequenceStore(tmp_path / "index.sequences.bin")
+    assert store.n_sequences == len(sequences)
+    for i, sequence in enumerate(sequences):
+        sequence_id = f"DR-1.1-{i}"
+        assert store.length(sequence_id) == len(sequence)
+        assert store.fetch(sequence_id) == sequence
+        for _ in range(10):
+            start, end = rng.randint(-70, 70), rng.randint(-70, 70)
+            assert store.fetch(sequence_id, start, end) == sequence[start:end]
+
+    for sequence_id in ["DR-1.1-46", "DR-1.1-01", "DR-1.2-0"]:
+        with pytest.raises(MissingSequencesError):
+            store.fetch(sequence_id)
+
+
+def test_with_fasta_records():
+    df = polars.DataFrame(
+        {
+            "sequence_id": [f"DR-1.1-{i}" for i in range(5)],
+            "variants": [
+                "chr1:10:A:T",
+                "chr1:10:AC:TC",
+                "chr1:30:G:C",
+                "chr2:10:A:T",
+                "chr1:10:A:T,chr1:12:C:C",
+            ],
+            "sequence": ["ACTG", "ACTG", "GGCC", "ACTG", "ACTG"],
+        }
+    )
+    df = with_fasta_records(df)
+    # the same bases on another contig get their own record
+    assert df["fasta_record"].to_list() == [
+        "DR-1.1-0",
+        "DR-1.1-0",
+        "DR-1.1-2",
+        "DR-1.1-3",
+        "DR-1.1-0",
+    ]
+    assert fasta_rows(df)["sequence_id"].to_list() == [
+        "DR-1.1-0",
+        "DR-1.1-2",
+        "DR-1.1-3",
+    ]
+
+
+def test_sequence_store_unused_indices(tmp_path):
+    df = polars.DataFrame(
+        {"sequence": ["ACGT", "NNa", "GG"], "sequence_idx": [4, 0, 2]}
+    )
+    write_sequence_store(df, tmp_path / "index.sequences.bin", "DR-1.1-")
+
+    store = SequenceStore(tmp_path / "index.sequences.bin")
+    assert [store.fetch(f"DR-1.1-{i}") for i in [0, 2, 4]] == ["NNa", "GG", "ACGT"]
+    for sequence_id in ["DR-1.1-1", "DR-1.1-3", "DR-1.1-5"]:
+        with pytest.raises(MissingSequencesError):
+            store.fetch(sequence_id)
@@ -1,4 +1,8 @@
-from remap_divref import Haplotype
+import random
+
+import numpy as np
+
+from remap_divref import Haplotype, VariantIntervals, remap_batch
 
 
 def create_haplotype(
@@ -131,3 +135,42 @@ def test_variants_involved():
     # Population frequencies should now be a dictionary with lists
     expected_null_freqs = {"afr": [0], "amr": [0], "eas": [0], "nfe": [0], "sas": [0]}
     assert ref_mapping.population_frequencies == expected_null_freqs
+
+
+def test_remap_batch_matches_reference_mapping():
+    rng = random.Random(0)
+    haplotypes = []
+    for i in range(200):
+        variants = []
+        position = rng.randint(100, 10_000)
+        for _ in range(rng.randint(1, 5)):
+            ref = rng.choice(["A", "AT", "ACGT"])
+            alt = rng.choice(["C", "CG", "CGTAC"])
+            variants.append(f"chr1:{position}:{ref}:{alt}")
+            # occasionally overlap the next variant to exercise the scalar fallback
+            position += len(ref) + rng.choice([-1, 0, 0, 1, 5, 20])
+        haplotypes.append(
+            create_haplotype(
+                sequence_id=f"hap{i}",
+                variants=",".join(variants),
+                popmax_empirical_AC=10,
+                max_pop="afr",
+            )
+        )
+
+    hap_index = np.array([rng.randrange(len(haplotypes)) for _ in range(2000)])
+    starts = np.array([rng.randint(-5, 80) for _ in hap_index])
+    ends = starts + np.array([rng.randint(0, 25) for _ in hap_index])
+    intervals = VariantIntervals.from_lists(
+        [hap.variant_intervals(10) for hap in haplotypes]
+    )
+    result = remap_batch(intervals, hap_index, starts, ends)
+
+    for i, h in enumerate(hap_index):
+        rm = haplotypes[h].reference_mapping(int(starts[i]), int(ends[i]), 10)
+        assert result.start[i] == rm.start
+        assert result.end[i] == rm.end
+        expected_first = -1 if rm.first_variant_index is None else rm.first_variant_index
+        expected_last = -1 if rm.last_variant_index is None else rm.last_variant_index
+        assert result.first_variant_index[i] == expected_first
+        assert result.last_variant_index[i] == expected_last
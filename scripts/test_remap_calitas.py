@@ -0,0 +1,522 @@
+import gzip
+import json
+
+import duckdb
+import numpy as np
+import pandas as pd
+import polars
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from divref_index import (
+    sequence_spans,
+    with_typed_frequencies,
+    with_variant_intervals,
+    write_remap_sidecar,
+)
+from remap_divref import (
+    Haplotype,
+    MissingSequencesError,
+    SidecarIndex,
+    calitas,
+    calitas_schema,
+    open_index,
+    open_output,
+    region,
+)
+
+SEQUENCES = pd.DataFrame(
+    {
+        "sequence": ["A" * 21, "C" * 23, "G" * 30],
+        "sequence_length": [21, 23, 30],
+        "sequence_id": ["DR-1.1-0", "DR-1.1-1", "DR-1.1-2"],
+        "n_variants": [1, 1, 2],
+        "popmax_empirical_AF": [0.1, 0.2, 0.3],
+        "popmax_empirical_AC": [10, 20, 30],
+        "estimated_gnomad_AF": [0.1, 0.2, 0.3],
+        "fraction_phased": [1.0, 1.0, 0.5],
+        "source": ["gnomAD_variant", "gnomAD_variant", "HGDP_haplotype"],
+        "max_pop": ["afr", "amr", "eas"],
+        "variants": ["chr1:100:A:T", "chr2:200:C:CGT", "chr3:300:GA:G,chr3:305:T:C"],
+        "gnomAD_AF_afr": ["0.10000", "null", "0.30000,0.01000"],
+        "gnomAD_AF_amr": ["0.01000", "0.20000", "0.02000,0.02000"],
+        "gnomAD_AF_eas": ["0.01000", "0.02000", "0.30000,0.03000"],
+        "gnomAD_AF_nfe": ["0.01000", "0.02000", "0.03000,0.04000"],
+        "gnomAD_AF_sas": ["0.01000", "0.02000", "0.03000,0.05000"],
+    }
+)
+
+
+def write_index(path, integer_keys=False, fasta_records=None, typed=False):
+    con = duckdb.connect(str(path))
+    sequences = SEQUENCES
+    if typed:
+        sequences = with_typed_frequencies(polars.from_pandas(SEQUENCES))
+    con.execute("CREATE TABLE sequences AS SELECT * FROM sequences")
+    if integer_keys:
+        con.execute("ALTER TABLE sequences ADD COLUMN sequence_idx BIGINT")
+        con.execute(
+            "UPDATE sequences SET sequence_idx = split_part(sequence_id, '-', 3)"
+        )
+        con.execute(
+            "CREATE TABLE sequence_id_prefix AS SELECT 'DR-1.1-' AS sequence_id_prefix"
+        )
+    if fasta_records is not None:
+        con.execute("CREATE TABLE fasta_records AS SELECT * FROM fasta_records")
+    con.execute("CREATE TABLE window_size AS SELECT 10 AS window_size")
+    con.execute("CREATE TABLE VERSION AS SELECT 1.1 AS version")
+    con.close()
+
+
+def write_hits(path, n=50):
+    rows = []
+    for i in range(n):
+        rows.append(
+            {
+                "guide_id": f"g{i}",
+                "chromosome": f"DR-1.1-{i % 3}",
+                "coordinate_start": i % 8,
+                "coordinate_end": i % 8 + 12,
+                "strand": "+-"[i % 2],
+                "padded_target": "ACGTACGTAC" + "NGG",
+                "unpadded_target_sequence": "ACGTACGTAC",
+                "score": f"{i / 3:.2f}",
+            }
+        )
+    pd.DataFrame(rows).to_csv(path, sep="\t", index=False)
+
+
+def run_calitas(
+    input_path,
+    output_path,
+    index_path,
+    batch_size,
+    workers=1,
+    cache_size=0,
+    stats_json=None,
+    output_format="tsv",
+):
+    calitas(
+        input_path=input_path,
+        output_path=output_path,
+        index_path=index_path,
+        sep="\t",
+        batch_size=batch_size,
+        workers=workers,
+        cache_size=cache_size,
+        stats_json=stats_json,
+        output_format=output_format,
+    )
+
+
+def test_calitas_chunked_and_bgzipped(tmp_path):
+    index_path = tmp_path / "index.duckdb"
+    write_index(index_path)
+    write_hits(tmp_path / "hits.tsv")
+    with (
+        open(tmp_path / "hits.tsv", "rb") as f,
+        gzip.open(tmp_path / "hits.tsv.gz", "wb") as g,
+    ):
+        g.write(f.read())
+
+    run_calitas(tmp_path / "hits.tsv", tmp_path / "single.tsv", index_path, 1000)
+    run_calitas(
+        tmp_path / "hits.tsv.gz",
+        tmp_path / "chunked.tsv.bgz",
+        index_path,
+        7,
+        cache_size=2,
+    )
+
+    single = (tmp_path / "single.tsv").read_bytes()
+    assert gzip.decompress((tmp_path / "chunked.tsv.bgz").read_bytes()) == single
+
+    out = pd.read_csv(tmp_path / "single.tsv", sep="\t", keep_default_na=False)
+    assert len(out) == 50
+    first = out.iloc[0]
+    # DR-1.1-0 hit at [0, 15) with the PAM: context starts at chr1:90
+    assert first["chromosome"] == "chr1"
+    assert first["coordinate_start"] == 90
+    assert first["coordinate_end"] == 105
+    assert first["variants_involved"] == "chr1:100:A:T"
+    assert first["divref_start"] == 0
+    assert first["population_frequencies_json"] == (
+        '{"afr":[0.1],"amr":[0.01],"eas":[0.01],"nfe":[0.01],"sas":[0.01]}'
+    )
+
+
+def test_calitas_workers_preserve_order(tmp_path):
+    index_path = tmp_path / "index.duckdb"
+    write_index(index_path)
+    write_hits(tmp_path / "hits.tsv", n=200)
+
+    run_calitas(tmp_path / "hits.tsv", tmp_path / "serial.tsv", index_path, 9)
+    run_calitas(tmp_path / "hits.tsv", tmp_path / "parallel.tsv", index_path, 9, 3)
+
+    serial = (tmp_path / "serial.tsv").read_bytes()
+    assert (tmp_path / "parallel.tsv").read_bytes() == serial
+
+
+def test_calitas_integer_keyed_index(tmp_path):
+    write_index(tmp_path / "strings.duckdb")
+    write_index(tmp_path / "integers.duckdb", integer_keys=True)
+    write_hits(tmp_path / "hits.tsv")
+
+    run_calitas(
+        tmp_path / "hits.tsv", tmp_path / "a.tsv", tmp_path / "strings.duckdb", 8
+    )
+    run_calitas(
+        tmp_path / "hits.tsv", tmp_path / "b.tsv", tmp_path / "integers.duckdb", 8
+    )
+
+    assert (tmp_path / "a.tsv").read_bytes() == (tmp_path / "b.tsv").read_bytes()
+
+
+def test_calitas_typed_frequencies(tmp_path):
+    write_index(tmp_path / "strings.duckdb")
+    write_index(tmp_path / "typed.duckdb", integer_keys=True, typed=True)
+    write_hits(tmp_path / "hits.tsv")
+
+    run_calitas(
+        tmp_path / "hits.tsv", tmp_path / "a.tsv", tmp_path / "strings.duckdb", 8
+    )
+    run_calitas(
+        tmp_path / "hits.tsv",
+        tmp_path / "b.tsv",
+        tmp_path / "typed.duckdb",
+        8,
+        cache_size=2,
+    )
+
+    assert (tmp_path / "a.tsv").read_bytes() == (tmp_path / "b.tsv").read_bytes()
+    out = pd.read_csv(tmp_path / "b.tsv", sep="\t", keep_default_na=False)
+    # "null" frequencies are reported as 0
+    assert out["population_frequencies_json"][1] == (
+        '{"afr":[0.0],"amr":[0.2],"eas":[0.02],"nfe":[0.02],"sas":[0.02]}'
+    )
+
+
+def test_haplotype_from_typed_index_row(tmp_path):
+    write_index(tmp_path / "index.duckdb", integer_keys=True, typed=True)
+    con = duckdb.connect(str(tmp_path / "index.duckdb"), read_only=True)
+    rows = con.execute("SELECT * FROM sequences ORDER BY sequence_idx")
+    columns = [c[0] for c in rows.description]
+    haplotypes = [Haplotype(**dict(zip(columns, row))) for row in rows.fetchall()]
+    con.close()
+
+    assert isinstance(haplotypes[2].gnomAD_AF_afr, list)
+    frequencies = haplotypes[2].population_frequencies()
+    assert frequencies["afr"] == pytest.approx([0.3, 0.01])
+    assert frequencies["sas"] == pytest.approx([0.03, 0.05])
+    # null frequencies are reported as 0, as for the comma-joined strings of older indices
+    assert haplotypes[1].population_frequencies()["afr"] == [0.0]
+    mapping = haplotypes[2].reference_mapping(10, 12, 10)
+    assert mapping.chromosome == "chr3"
+    assert mapping.population_frequencies == frequencies
+
+
+def test_calitas_remap_sidecar(tmp_path):
+    write_index(tmp_path / "index.duckdb")
+    df = with_typed_frequencies(
+        with_variant_intervals(polars.from_pandas(SEQUENCES), 10)
+    ).with_columns(sequence_idx=polars.int_range(polars.len()))
+    write_remap_sidecar(df, tmp_path / "index.remap.bin", "1.1", 10, "DR-1.1-")
+    write_hits(tmp_path / "hits.tsv")
+
+    run_calitas(tmp_path / "hits.tsv", tmp_path / "a.tsv", tmp_path / "index.duckdb", 8)
+    run_calitas(
+        tmp_path / "hits.tsv",
+        tmp_path / "b.tsv",
+        tmp_path / "index.remap.bin",
+        8,
+        workers=2,
+        cache_size=2,
+    )
+
+    assert (tmp_path / "a.tsv").read_bytes() == (tmp_path / "b.tsv").read_bytes()
+
+    index = SidecarIndex(tmp_path / "index.remap.bin")
+    spans = index.contig_spans("chr3")
+    assert spans.starts.tolist() == [289]
+    assert spans.ends.tolist() == [315]
+    assert spans.sequence_idx.tolist() == [2]
+    assert index.contig_spans("chrX") is None
+
+
+def test_remap_sidecar_unused_indices(tmp_path):
+    df = with_typed_frequencies(
+        with_variant_intervals(polars.from_pandas(SEQUENCES), 10)
+    ).with_columns(
+        sequence_id=polars.Series(["DR-1.1-0", "DR-1.1-3", "DR-1.1-7"]),
+        sequence_idx=polars.Series([0, 3, 7]),
+    )
+    write_remap_sidecar(df, tmp_path / "index.remap.bin", "1.1", 10, "DR-1.1-")
+
+    index = SidecarIndex(tmp_path / "index.remap.bin")
+    rows = index.fetch(np.array(["DR-1.1-7", "DR-1.1-0", "DR-1.1-3"], dtype=object))
+    assert rows.variants.tolist() == [
+        "chr3:300:GA:G,chr3:305:T:C",
+        "chr1:100:A:T",
+        "chr2:200:C:CGT",
+    ]
+    assert rows.popmax_empirical_AC.tolist() == [30, 10, 20]
+    assert rows.intervals.offsets.tolist() == [0, 2, 3, 4]
+    assert np.allclose(
+        rows.population_AFs[:, 0], [0.3, 0.01, 0.1, np.nan], equal_nan=True
+    )
+    for sequence_id in ["DR-1.1-1", "DR-1.1-6", "DR-1.1-8"]:
+        with pytest.raises(MissingSequencesError):
+            index.fetch(np.array([sequence_id], dtype=object))
+
+
+def test_calitas_expands_shared_fasta_records(tmp_path):
+    # DR-1.1-1 and DR-1.1-2 are written as DR-1.1-0's FASTA record
+    fasta_records = polars.DataFrame(
+        {"sequence_idx": [2, 1], "fasta_record_idx": [0, 0]}
+    )
+    write_index(tmp_path / "plain.duckdb", integer_keys=True)
+    write_index(
+        tmp_path / "shared.duckdb", integer_keys=True, fasta_records=fasta_records
+    )
+    df = with_typed_frequencies(
+        with_variant_intervals(polars.from_pandas(SEQUENCES), 10)
+    ).with_columns(sequence_idx=polars.int_range(polars.len()))
+    write_remap_sidecar(
+        df, tmp_path / "shared.remap.bin", "1.1", 10, "DR-1.1-", fasta_records
+    )
+    write_hits(tmp_path / "hits.tsv")
+    hits = pd.read_csv(tmp_path / "hits.tsv", sep="\t", dtype=str)
+    hits = hits[hits["chromosome"] == "DR-1.1-0"]
+    # what the aligner would report without deduplication
+    expanded = pd.concat(
+        [hits.assign(chromosome=f"DR-1.1-{i}") for i in range(3)]
+    ).sort_index(kind="stable")
+    hits.to_csv(tmp_path / "hits.tsv", sep="\t", index=False)
+    expanded.to_csv(tmp_path / "expanded.tsv", sep="\t", index=False)
+
+    run_calitas(
+        tmp_path / "expanded.tsv", tmp_path / "a.tsv", tmp_path / "plain.duckdb", 8
+    )
+    run_calitas(
+        tmp_path / "hits.tsv", tmp_path / "b.tsv", tmp_path / "shared.duckdb", 3
+    )
+    run_calitas(
+        tmp_path / "hits.tsv",
+        tmp_path / "c.tsv",
+        tmp_path / "shared.remap.bin",
+        5,
+        workers=2,
+        cache_size=2,
+    )
+
+    a = pd.read_csv(tmp_path / "a.tsv", sep="\t", keep_default_na=False)
+    assert len(a) == 3 * len(hits)
+    assert a["divref_sequence_id"].tolist()[:3] == ["DR-1.1-0", "DR-1.1-1", "DR-1.1-2"]
+    assert a["chromosome"].tolist()[:3] == ["chr1", "chr2", "chr3"]
+    for path in ["b.tsv", "c.tsv"]:
+        assert (tmp_path / path).read_bytes() == (tmp_path / "a.tsv").read_bytes()
+
+
+def test_calitas_parquet_and_arrow_output(tmp_path):
+    write_index(tmp_path / "index.duckdb", integer_keys=True, typed=True)
+    write_hits(tmp_path / "hits.tsv")
+
+    run_calitas(
+        tmp_path / "hits.tsv", tmp_path / "out.tsv", tmp_path / "index.duckdb", 8
+    )
+    run_calitas(
+        tmp_path / "hits.tsv",
+        tmp_path / "out.parquet",
+        tmp_path / "index.duckdb",
+        8,
+        workers=2,
+        output_format="parquet",
+    )
+    run_calitas(
+        tmp_path / "hits.tsv",
+        tmp_path / "out.arrow",
+        tmp_path / "index.duckdb",
+        8,
+        output_format="arrow",
+    )
+
+    tsv = pd.read_csv(tmp_path / "out.tsv", sep="\t", keep_default_na=False)
+    parquet = pq.ParquetFile(tmp_path / "out.parquet")
+    # one row group per batch
+    assert parquet.metadata.num_row_groups == 7
+    table = parquet.read()
+    with pa.ipc.open_file(tmp_path / "out.arrow") as reader:
+        assert reader.read_all().equals(table)
+
+    frequencies = table.column("population_frequencies").to_pylist()
+    assert table.column_names == [
+        *tsv.columns[:-1],
+        "population_frequencies",
+    ]
+    assert table.schema.field("coordinate_start").type == pa.int64()
+    assert table.column("variants_involved").to_pylist() == [
+        x.split(",") if x else [] for x in tsv["variants_involved"]
+    ]
+    assert table.column("all_variants").to_pylist() == [
+        x.split(",") for x in tsv["all_variants"]
+    ]
+    for column in ["coordinate_start", "divref_end", "popmax_empirical_AF"]:
+        assert table.column(column).to_pylist() == tsv[column].tolist()
+    # other input columns are passed through as text
+    assert table.column("score").to_pylist()[:2] == ["0.00", "0.33"]
+    assert frequencies[1]["afr"] == [None]
+    for row, expected in zip(frequencies, tsv["population_frequencies_json"]):
+        assert {
+            pop: [round(x or 0.0, 5) for x in values] for pop, values in row.items()
+        } == json.loads(expected)
+
+
+def test_calitas_parquet_output_without_rows(tmp_path):
+    write_index(tmp_path / "index.duckdb", integer_keys=True, typed=True)
+    write_hits(tmp_path / "hits.tsv", n=1)
+    with open(tmp_path / "hits.tsv") as f:
+        header = f.readline()
+    (tmp_path / "empty.tsv").write_text(header)
+
+    run_calitas(
+        tmp_path / "hits.tsv",
+        tmp_path / "one.parquet",
+        tmp_path / "index.duckdb",
+        8,
+        output_format="parquet",
+    )
+    run_calitas(
+        tmp_path / "empty.tsv",
+        tmp_path / "empty.parquet",
+        tmp_path / "index.duckdb",
+        8,
+        output_format="parquet",
+    )
+    empty = pq.read_table(tmp_path / "empty.parquet")
+    assert empty.num_rows == 0
+    assert empty.schema == pq.read_schema(tmp_path / "one.parquet")
+
+    # closing an output no batch was written to still leaves an empty table
+    schema = calitas_schema(header.strip().split("\t"))
+    for output_format in ["parquet", "arrow"]:
+        path = tmp_path / f"unwritten.{output_format}"
+        open_output(path, output_format, schema).close()
+        if output_format == "parquet":
+            table = pq.read_table(path)
+        else:
+            with pa.ipc.open_file(path) as reader:
+                table = reader.read_all()
+        assert table.num_rows == 0
+        assert table.schema == schema
+
+
+def test_calitas_stats_json(tmp_path):
+    write_index(tmp_path / "index.duckdb")
+    write_hits(tmp_path / "hits.tsv", n=20)
+
+    run_calitas(
+        tmp_path / "hits.tsv",
+        tmp_path / "out.tsv",
+        tmp_path / "index.duckdb",
+        8,
+        cache_size=10,
+        stats_json=tmp_path / "stats.json",
+    )
+
+    with open(tmp_path / "stats.json") as f:
+        stats = json.load(f)
+    assert stats["rows"] == 20
+    assert len(stats["batch_seconds"]) == 3
+    assert stats["cache_hits"] + stats["cache_misses"] == 3 + 3 + 3
+
+
+def test_sequence_cache_matches_uncached_fetch(tmp_path):
+    write_index(tmp_path / "index.duckdb")
+    uncached = open_index(tmp_path / "index.duckdb")
+    cached = open_index(tmp_path / "index.duckdb", cache_size=2)
+
+    batches = [[2, 0], [0, 1], [1, 2, 0], [2]]
+    for batch in batches:
+        ids = np.array([f"DR-1.1-{i}" for i in batch], dtype=object)
+        expected = uncached.fetch(ids)
+        actual = cached.fetch(ids)
+        for name in ["sequence_id", "variants", "popmax_empirical_AC", "max_pop"]:
+            assert list(getattr(actual, name)) == list(getattr(expected, name))
+        assert [actual.intervals.intervals(h) for h in range(len(ids))] == [
+            expected.intervals.intervals(h) for h in range(len(ids))
+        ]
+        np.testing.assert_array_equal(actual.population_AFs, expected.population_AFs)
+    # [2, 0] evicted for 1, then 1 and 0 kept for the three-sequence batch, which is never
+    # evicted even though it is larger than the cache
+    assert (cached.cache.hits, cached.cache.misses) == (4, 4)
+    assert list(cached.cache.columns.sequence_id) == [
+        "DR-1.1-0",
+        "DR-1.1-1",
+        "DR-1.1-2",
+    ]
+
+
+def test_region_lookup(tmp_path):
+    rng = np.random.default_rng(4)
+    variants = []
+    for _ in range(300):
+        contig = rng.choice(["chr1", "chr2"])
+        position = int(rng.integers(1, 2000))
+        n = int(rng.integers(1, 4))
+        variants.append(
+            ",".join(
+                f"{contig}:{position + 7 * i}:{'A' * int(rng.integers(1, 40))}:C"
+                for i in range(n)
+            )
+        )
+    df = polars.DataFrame({"variants": variants, "sequence_idx": range(len(variants))})
+    spans = sequence_spans(df, 10)
+    con = duckdb.connect(str(tmp_path / "index.duckdb"))
+    con.execute("CREATE TABLE sequences AS SELECT * FROM df")
+    con.execute(
+        "CREATE TABLE sequence_id_prefix AS SELECT 'DR-1.1-' AS sequence_id_prefix"
+    )
+    con.execute("CREATE TABLE sequence_spans AS SELECT * FROM spans")
+    con.execute("CREATE TABLE window_size AS SELECT 10 AS window_size")
+    con.execute("CREATE TABLE VERSION AS SELECT 1.1 AS version")
+    con.close()
+
+    regions = []
+    for i in range(500):
+        start = int(rng.integers(0, 2100))
+        regions.append(
+            (
+                rng.choice(["chr1", "chr2", "chr3"]),
+                start,
+                start + int(rng.integers(1, 30)),
+            )
+        )
+    with open(tmp_path / "regions.bed", "w") as f:
+        f.write("# a comment\n")
+        for i, (contig, start, end) in enumerate(regions):
+            f.write(f"{contig}\t{start}\t{end}\tr{i}\n")
+
+    for covering in [False, True]:
+        region(
+            input_path=tmp_path / "regions.bed",
+            output_path=tmp_path / "out.tsv",
+            index_path=tmp_path / "index.duckdb",
+            covering=covering,
+            batch_size=64,
+        )
+        out = pd.read_csv(tmp_path / "out.tsv", sep="\t", keep_default_na=False)
+
+        expected = []
+        for i, (contig, start, end) in enumerate(regions):
+            for row in spans.filter(polars.col("contig") == contig).iter_rows(
+                named=True
+            ):
+                if covering:
+                    hit = row["span_start"] <= start and row["span_end"] >= end
+                else:
+                    hit = row["span_start"] < end and row["span_end"] > start
+                if hit:
+                    expected.append((f"r{i}", f"DR-1.1-{row['sequence_idx']}"))
+        assert len(expected) > 100
+        assert list(zip(out["name"], out["sequence_id"])) == expected